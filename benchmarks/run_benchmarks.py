@@ -0,0 +1,276 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from busybody import BusyBody, SqliteConnector
+from busybody.database import PROFILES
+from busybody.database.models import *
+from busybody.fullcontact import SyntheticProfiles
+from busybody.fullcontact.fullcontact_interface import FullContactInterface
+
+logger = logging.getLogger(__name__)
+
+
+class StubFullContact(FullContactInterface):
+    """ FullContact stand-in that answers from SyntheticProfiles after a fixed delay """
+
+    def __init__(self, profiles, size='medium', latency=0.0):
+        self.profiles = profiles
+        self.size = size
+        self.latency = latency
+
+    def get_person(self, email):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.profiles.person(email, size=self.size)
+
+
+def percentile(sorted_values, pct):
+    """ Nearest-rank percentile of an already sorted list
+
+    @param sorted_values: Sorted list of numbers
+    @param pct: Percentile between 0 and 100
+    @return: float
+    """
+    if not sorted_values:
+        return None
+    rank = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+
+def summarize(latencies, records, elapsed):
+    """ Build the result entry for one benchmark
+
+    @param latencies: Seconds taken by each timed call
+    @param records: Number of records processed
+    @param elapsed: Total wall-clock seconds
+    @return: dict
+    """
+    latencies = sorted(latencies)
+    return {
+        'records': records,
+        'seconds': round(elapsed, 4),
+        'records_per_sec': round(records / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+    }
+
+
+def timed(func, items):
+    """ Call func on every item, timing each call
+
+    @param func: Callable taking one item
+    @param items: Items to call func with
+    @return: tuple of per-call latencies and total elapsed seconds
+    """
+    latencies = []
+    started = timer()
+    for item in items:
+        call_started = timer()
+        func(item)
+        latencies.append(timer() - call_started)
+    return latencies, timer() - started
+
+
+class BenchmarkSuite(object):
+
+    def __init__(self, workdir, count, profile, seed=0):
+        self.workdir = workdir
+        self.count = count
+        self.profile = profile
+        self.profiles = SyntheticProfiles(seed)
+        self._databases = 0
+
+    def fresh_database(self):
+        """ Create an empty busybody database in the work directory
+
+        @return: SqliteConnector
+        """
+        self._databases += 1
+        db = SqliteConnector(os.path.join(self.workdir, 'bench{}.sqlite'.format(self._databases)), profile=self.profile)
+        db.client.create_tables(MODELS)
+        return db
+
+    def emails(self, prefix='user'):
+        return ['{}{}@example.com'.format(prefix, i) for i in xrange(self.count)]
+
+    def bench_insert(self, size):
+        db = self.fresh_database()
+        records = [(email, self.profiles.person(email, size)) for email in self.emails()]
+        latencies, elapsed = timed(lambda record: db.insert_user_record(*record), records)
+        return summarize(latencies, len(records), elapsed)
+
+    def bench_insert_batch(self, size, batch_size=500):
+        db = self.fresh_database()
+        records = [(email, self.profiles.person(email, size)) for email in self.emails()]
+        batches = [records[i:i + batch_size] for i in xrange(0, len(records), batch_size)]
+        latencies, elapsed = timed(db.insert_user_records, batches)
+        return summarize(latencies, len(records), elapsed)
+
+    def bench_insert_deferred(self, size, batch_size=500):
+        # as bench_insert_batch, but with the secondary indexes rebuilt once at the end
+        db = self.fresh_database()
+        records = [(email, self.profiles.person(email, size)) for email in self.emails()]
+        batches = [records[i:i + batch_size] for i in xrange(0, len(records), batch_size)]
+        start = time.time()
+        with db.deferred_indexes():
+            latencies, _ = timed(db.insert_user_records, batches)
+        return summarize(latencies, len(records), time.time() - start)
+
+    def bench_refresh(self, size, batch_size=500):
+        # the common quarterly case: most users come back unchanged
+        db = self.fresh_database()
+        emails = self.emails()
+        db.insert_user_records((email, self.profiles.person(email, size)) for email in emails)
+        records = [(email, self.profiles.person(email, size, request_id='refresh')) for email in emails]
+        batches = [records[i:i + batch_size] for i in xrange(0, len(records), batch_size)]
+        latencies, elapsed = timed(db.upsert_user_records, batches)
+        return summarize(latencies, len(records), elapsed)
+
+    def bench_retry_queue(self, page_size=500):
+        db = self.fresh_database()
+        db.log_failures((email, self.profiles.failure(email, 202)) for email in self.emails())
+        FailureLog.update(next_attempt_dt=None).execute()
+
+        results = {}
+        pages = []
+        latencies, elapsed = timed(
+            lambda after_id: pages.append(db.fetch_retry_queue(limit=page_size, after_id=after_id)),
+            self._page_starts(db, page_size)
+        )
+        results['fetch_retry_queue'] = summarize(latencies, sum(len(p) for p in pages), elapsed)
+
+        rows = [row for page in pages for row in page]
+        latencies, elapsed = timed(
+            lambda row: db.update_retry_row(row, self.profiles.failure(row['email'], 202)),
+            rows[:len(rows) // 2]
+        )
+        results['update_retry_row'] = summarize(latencies, len(latencies), elapsed)
+
+        remaining = rows[len(rows) // 2:]
+        batches = [remaining[i:i + page_size] for i in xrange(0, len(remaining), page_size)]
+        latencies, elapsed = timed(
+            lambda batch: db.update_retry_rows((row, self.profiles.failure(row['email'], 202)) for row in batch),
+            batches
+        )
+        results['update_retry_rows'] = summarize(latencies, len(remaining), elapsed)
+        return results
+
+    @staticmethod
+    def _page_starts(db, page_size):
+        ids = [row[0] for row in FailureLog.select(FailureLog.failure_log_id).order_by(FailureLog.failure_log_id).tuples()]
+        return [0] + ids[page_size - 1::page_size][:-1] if ids else []
+
+    def bench_dump_user_data(self, size, extensions=('csv', 'csv.gz', 'jsonl.gz', 'npz', 'parquet'), repeats=5):
+        # each export is one call, so it is run several times for its latencies to mean anything
+        db = self.fresh_database()
+        db.insert_user_records((email, self.profiles.person(email, size)) for email in self.emails())
+
+        results = {}
+        for extension in extensions:
+            outf_path = os.path.join(self.workdir, 'users.' + extension)
+            try:
+                latencies, elapsed = timed(db.dump_user_data, [outf_path] * repeats)
+            except ImportError:
+                logger.warn('Skipping the {} export, its library is not installed'.format(extension))
+                continue
+            name = 'dump_user_data.{}'.format(size) if extension == 'csv' else 'dump_user_data.{}.{}'.format(extension, size)
+            results[name] = dict(summarize(latencies, self.count * repeats, elapsed), bytes=os.path.getsize(outf_path))
+        return results
+
+    def bench_process_person(self, size, latency):
+        db = self.fresh_database()
+        bb = BusyBody(db, StubFullContact(self.profiles, size, latency))
+        latencies, elapsed = timed(bb.process_person, self.emails())
+        return summarize(latencies, self.count, elapsed)
+
+    def bench_process_many(self, size, latency, concurrency):
+        db = self.fresh_database()
+        bb = BusyBody(db, StubFullContact(self.profiles, size, latency))
+        started = timer()
+        processed = sum(1 for _ in bb.process_many(self.emails(), concurrency=concurrency))
+        return summarize([], processed, timer() - started)
+
+    def run(self, sizes, api_latency, concurrency):
+        results = {}
+        for size in sizes:
+            logger.info('Benchmarking inserts of {} profiles'.format(size))
+            results['insert_user_record.{}'.format(size)] = self.bench_insert(size)
+            results['insert_user_records.{}'.format(size)] = self.bench_insert_batch(size)
+            results['insert_user_records.deferred.{}'.format(size)] = self.bench_insert_deferred(size)
+            results['upsert_user_records.{}'.format(size)] = self.bench_refresh(size)
+            results.update(self.bench_dump_user_data(size))
+            results['process_person.{}'.format(size)] = self.bench_process_person(size, api_latency)
+            results['process_many.{}'.format(size)] = self.bench_process_many(size, api_latency, concurrency)
+
+        logger.info('Benchmarking the retry queue')
+        results.update(self.bench_retry_queue())
+        return results
+
+
+def compare(baseline, current):
+    """ Log the change in throughput between two result files
+
+    @param baseline: Results loaded from an earlier run
+    @param current: Results of this run
+    @return: None
+    """
+    for name in sorted(current['results']):
+        new = current['results'][name].get('records_per_sec')
+        old = baseline['results'].get(name, {}).get('records_per_sec')
+        if new and old:
+            logger.info('{:<36} {:>10.1f} -> {:>10.1f} records/sec ({:+.1f}%)'.format(name, old, new, (new - old) / old * 100))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    parser = argparse.ArgumentParser(description='Benchmark the busybody fetch, parse, insert, retry and export paths')
+    parser.add_argument('-n', '--count', type=int, default=2000, help='Number of records per benchmark')
+    parser.add_argument('-s', '--sizes', nargs='+', default=['small', 'medium', 'large'], help='Synthetic profile sizes to benchmark')
+    parser.add_argument('-p', '--profile', choices=sorted(PROFILES), default='safe', help='Sqlite performance profile')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='Seconds the stub API waits before answering')
+    parser.add_argument('--concurrency', type=int, default=8, help='Worker threads for the process_many benchmark')
+    parser.add_argument('--label', default=None, help='Label stored with the results, e.g. a version or commit')
+    parser.add_argument('-o', '--output', default='bench_results.json', help='File to write the JSON results to')
+    parser.add_argument('--compare', default=None, help='Earlier results file to compare against')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Keep busybody\'s per-record logging')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger('busybody').setLevel(logging.WARNING)
+
+    workdir = tempfile.mkdtemp(prefix='busybody-bench-')
+    try:
+        suite = BenchmarkSuite(workdir, args.count, args.profile)
+        results = {
+            'label': args.label,
+            'timestamp': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'count': args.count,
+            'profile': args.profile,
+            'api_latency': args.api_latency,
+            'results': suite.run(args.sizes, args.api_latency, args.concurrency)
+        }
+    finally:
+        shutil.rmtree(workdir)
+
+    with open(args.output, 'w') as outf:
+        json.dump(results, outf, indent=2, sort_keys=True)
+    logger.info('Wrote benchmark results to {}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare, 'r') as inf:
+            compare(json.load(inf), results)
@@ -1,6 +1,34 @@
 # busybody
+#
+# Every name is imported from its submodule the first time it is used, so
+# importing busybody (or running the busybody command) does not load peewee,
+# requests or pymongo until something needs them.
 
-from utils import *
-from fullcontact import FullContact
-from busybody import BusyBody, BusyBodyFactory
-from database import MongoDbConnector, SqliteConnector
+from utils.lazy import lazy_exports
+
+lazy_exports(__name__, {
+    'EMAIL_RE': '.utils',
+    'EmailParser': '.utils',
+    'YamlConfigParser': '.utils',
+    'EmailCanonicalizer': '.utils',
+    'EmailDeduplicator': '.utils',
+    'SeekableDict': '.utils',
+    'BloomFilter': '.utils',
+    'chunked': '.utils',
+    'Colors': '.utils',
+    'bounded_imap': '.utils',
+    'Future': '.utils',
+    'FutureTimeout': '.utils',
+    'MetricsRegistry': '.utils',
+    'REGISTRY': '.utils',
+    'serve_metrics': '.utils',
+    'SnapshotWriter': '.utils',
+    'FullContact': '.fullcontact',
+    'BusyBody': '.busybody',
+    'BusyBodyFactory': '.busybody',
+    'KnownEmailFilter': '.busybody',
+    'ShardedIngest': '.busybody',
+    'MongoDbConnector': '.database',
+    'SqliteConnector': '.database',
+    'UserAnalytics': '.analytics',
+})
@@ -0,0 +1,7 @@
+from __future__ import absolute_import
+
+import sys
+
+from busybody.cli import main
+
+sys.exit(main())
@@ -0,0 +1,207 @@
+""" Aggregates over the enriched users of a sqlite database
+
+Counts are grouped in SQL, on the indexed columns of the normalized tables.
+Distributions pull one numeric column at a time into a NumPy array and
+compute histograms and quantiles there. Every result is cached until the
+database changes, so a dashboard polling the same questions only queries
+sqlite after new rows arrive.
+"""
+import logging
+from collections import OrderedDict
+
+from database.models import *
+from database.reconcile import NATURAL_KEYS
+from utils.colors import Colors
+
+logger = logging.getLogger(__name__)
+
+# percentiles reported when none are asked for
+DEFAULT_PERCENTILES = (25, 50, 75, 90, 99)
+
+# age buckets of the FullContact age ranges, plus everything past the last one
+AGE_BINS = (0, 18, 25, 35, 45, 55, 65, 120)
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        logger.error(Colors.FAIL + 'BusyBody requires numpy to be installed to compute distributions' + Colors.ENDC)
+        raise
+    return numpy
+
+
+def _column(field):
+    return field.model_class._meta.db_table, field.db_column
+
+
+def _group_key(group_by):
+    # fields compare into query expressions, so results are cached under column names
+    return group_by and _column(group_by)
+
+
+class UserAnalytics(object):
+    """
+    Aggregate queries over a SqliteConnector's users.
+
+    Results are kept until anything writes to the database: the cache is
+    keyed by sqlite's data_version, which moves when another connection
+    commits, and by the total changes made through this thread's connection.
+    Both are read without touching a table, so a cache hit costs one PRAGMA.
+    """
+
+    def __init__(self, db):
+        """ Run analytics against a database
+
+        @param db: SqliteConnector
+        @return: None
+        """
+        self.db = db
+        self.client = db.client
+        self._cache = {}
+
+    def _stamp(self):
+        conn = self.client.get_conn()
+        (version,) = self.client.execute_sql('PRAGMA data_version', require_commit=False).fetchone()
+        return id(conn), version, conn.total_changes
+
+    def _cached(self, key, compute):
+        stamp = self._stamp()
+        hit = self._cache.get(key)
+        if hit is not None and hit[0] == stamp:
+            return hit[1]
+        value = compute()
+        self._cache[key] = (stamp, value)
+        return value
+
+    def clear_cache(self):
+        """ Forget every cached result
+
+        @return: None
+        """
+        self._cache.clear()
+
+    def _query(self, sql, params=None):
+        return self.client.execute_sql(sql, params, require_commit=False)
+
+    def group_counts(self, field, limit=None):
+        """ Count the users by the value of a column, largest group first
+
+        @param field: Column to group by, e.g. UserAddress.country_code
+        @param limit: Only return this many groups
+        @return: list of (value, number of users) tuples; users without a value are counted under None
+        """
+        return self._cached(('group_counts', _column(field), limit), lambda: self._group_counts(field, limit))
+
+    def _group_counts(self, field, limit):
+        table, column = _column(field)
+        # tables holding one row per user count rows straight off the column's index
+        users = 'COUNT(*)' if not NATURAL_KEYS.get(field.model_class) else 'COUNT(DISTINCT user_id)'
+        sql = 'SELECT "{column}", {users} AS users FROM "{table}" GROUP BY "{column}" ORDER BY users DESC, "{column}"'.format(
+            column=column, users=users, table=table
+        )
+        if limit is not None:
+            sql += ' LIMIT {:d}'.format(limit)
+        return [tuple(row) for row in self._query(sql).fetchall()]
+
+    def users_by_country(self, limit=None):
+        """ @return: list of (country code, number of users) tuples, largest first """
+        return self.group_counts(UserAddress.country_code, limit)
+
+    def users_by_state(self, limit=None):
+        """ @return: list of (state code, number of users) tuples, largest first """
+        return self.group_counts(UserAddress.state_code, limit)
+
+    def users_by_gender(self):
+        """ @return: list of (gender, number of users) tuples, largest first """
+        return self.group_counts(UserDemography.gender)
+
+    def users_by_network(self, limit=None):
+        """ @return: list of (network name, number of users with a profile there) tuples, largest first """
+        return self.group_counts(UserProfile.network_name, limit)
+
+    def values(self, field, group_by=None):
+        """ Read the non-null values of a numeric column into arrays
+
+        @param field: Numeric column, e.g. UserDemography.age
+        @param group_by: Column of the same table to split the values by
+        @return: numpy float64 array, or an OrderedDict of group value to array
+            when grouped, in the order sqlite sorts the groups
+        """
+        return self._cached(('values', _column(field), _group_key(group_by)), lambda: self._values(field, group_by))
+
+    def _values(self, field, group_by):
+        np = _numpy()
+        table, column = _column(field)
+        where = ' WHERE "{}" IS NOT NULL'.format(column)
+
+        if group_by is None:
+            cursor = self._query('SELECT "{}" FROM "{}"{}'.format(column, table, where))
+            return np.fromiter((value for (value,) in cursor), dtype=np.float64)
+
+        if group_by.model_class is not field.model_class:
+            raise ValueError('{} and {} are not columns of the same table'.format(field.name, group_by.name))
+        group_column = group_by.db_column
+
+        # the sizes of the groups come off the group column's index, so the
+        # values are read without their labels and split at the boundaries
+        groups = self._query('SELECT "{group}", COUNT(*) FROM "{table}"{where} GROUP BY "{group}" ORDER BY "{group}"'.format(
+            group=group_column, table=table, where=where
+        )).fetchall()
+        cursor = self._query('SELECT "{}" FROM "{}"{} ORDER BY "{}"'.format(column, table, where, group_column))
+        values = np.fromiter((value for (value,) in cursor), dtype=np.float64)
+
+        sizes = np.array([size for _, size in groups], dtype=np.int64)
+        return OrderedDict(zip((group for group, _ in groups), np.split(values, np.cumsum(sizes)[:-1])))
+
+    def histogram(self, field, bins=10, range=None):
+        """ Histogram of a numeric column
+
+        @param field: Numeric column
+        @param bins: Number of equal-width bins, or the bin edges
+        @param range: (low, high) of the equal-width bins, defaults to the column's range
+        @return: tuple of (counts, bin edges) numpy arrays, as numpy.histogram
+        """
+        bins = tuple(bins) if isinstance(bins, (list, tuple)) else bins
+        return self._cached(('histogram', _column(field), bins, range), lambda: _numpy().histogram(self.values(field), bins, range))
+
+    def age_distribution(self, bins=AGE_BINS):
+        """ Number of users in each age bucket
+
+        @param bins: Bucket edges
+        @return: OrderedDict of (low, high) bucket to number of users
+        """
+        counts, edges = self.histogram(UserDemography.age, bins=bins)
+        return OrderedDict(((int(low), int(high)), int(count)) for low, high, count in zip(edges[:-1], edges[1:], counts))
+
+    def percentiles(self, field, q=DEFAULT_PERCENTILES, group_by=None):
+        """ Percentiles of a numeric column, overall or for every group
+
+        @param field: Numeric column
+        @param q: Percentiles to compute, between 0 and 100
+        @param group_by: Column of the same table to compute them per value of
+        @return: OrderedDict of percentile to value, or of group value to such
+            a dict when grouped. Percentiles of an empty column are NaN.
+        """
+        q = tuple(q)
+        return self._cached(('percentiles', _column(field), q, _group_key(group_by)), lambda: self._percentiles(field, q, group_by))
+
+    def _percentiles(self, field, q, group_by):
+        np = _numpy()
+
+        def compute(values):
+            result = np.percentile(values, q) if len(values) else np.full(len(q), np.nan)
+            return OrderedDict(zip(q, result.tolist()))
+
+        values = self.values(field, group_by)
+        if group_by is None:
+            return compute(values)
+        return OrderedDict((group, compute(group_values)) for group, group_values in values.items())
+
+    def follower_percentiles(self, q=DEFAULT_PERCENTILES):
+        """ Percentiles of the follower counts of the profiles on each network
+
+        @param q: Percentiles to compute
+        @return: OrderedDict of network name to OrderedDict of percentile to followers
+        """
+        return self.percentiles(UserProfile.followers, q, group_by=UserProfile.network_name)
@@ -1,3 +1,6 @@
 # busybody.busybody
 
 from busybody import BusyBodyFactory, BusyBody
+from known_emails import KnownEmailFilter
+from sharded import ShardedIngest
+from journal import RunJournal
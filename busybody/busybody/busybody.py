@@ -1,9 +1,17 @@
 import logging
+import threading
+import time
 
-from playhouse.csv_loader import dump_csv
+import requests
 
 from ..database.models import *
+from ..fullcontact.fullcontact_interface import unavailable_response
 from ..utils.colors import Colors
+from ..utils.concurrency import bounded_imap
+from ..utils.metrics import PERSONS_PROCESSED, RETRY_QUEUE_DEPTH
+from ..utils.parsers import EmailParser
+from journal import RunJournal
+from known_emails import KnownEmailFilter
 
 logger = logging.getLogger(__name__)
 
@@ -15,17 +23,38 @@ class BusyBodyFactory:
 
 
 class BusyBody:
-    def __init__(self, database, fc_api):
+    def __init__(self, database, fc_api, refresh=False):
+        """ Tie a database to the FullContact API
+
+        @param database: Database connector results are stored with
+        @param fc_api: FullContact API object
+        @param refresh: Reconcile users that are already stored with their new
+            response, instead of skipping them as duplicates
+        @return: None
+        """
         self.api = fc_api
         self.db = database
+        self.refresh = refresh
+
+    def _get_person(self, email):
+        # a lookup that fails on the network is logged as a failure, not raised, so the rest of a batch goes on
+        try:
+            return self.api.get_person(email)
+        except requests.RequestException, e:
+            return unavailable_response(e)
 
     def process_person(self, email):
-        response = self.api.get_person(email)
+        started = time.time()
+        response = self._get_person(email)
 
         if response.status == 200:
             try:
-                logger.info()
-                self.db.insert_user_record(email, response)
+                if self.refresh:
+                    logger.info('Refreshing user record for {}'.format(email))
+                    self.db.upsert_user_record(email, response)
+                else:
+                    logger.info('Inserting user record for {}'.format(email))
+                    self.db.insert_user_record(email, response)
             except IntegrityError, e:
                 logger.warn(Colors.FAIL + 'Error inserting user record: {}'.format(e) + Colors.ENDC)
         else:
@@ -38,14 +67,152 @@ class BusyBody:
 
             self.db.log_failure(email, response)
 
+        PERSONS_PROCESSED.observe(time.time() - started, status=response.status)
         return response
 
+    def process_many(self, emails, concurrency=4, backlog=None, skip_known=False, dedupe=None):
+        """ Look up and store many emails, overlapping the API round trips.
+
+        Emails are read lazily from the input and handed to a pool of worker
+        threads, each running process_person. At most `backlog` emails are read
+        ahead of the workers, so the input can be an arbitrarily large generator.
+        Results are yielded as soon as each lookup finishes, which is not
+        necessarily the input order. A lookup that times out or can't connect
+        is logged as a 503 failure for the retry queue, and the rest go on.
+
+        @param emails: Iterable of emails to process
+        @param concurrency: Maximum number of requests in flight at once
+        @param backlog: Maximum number of emails buffered ahead of the workers.
+            Defaults to twice the concurrency.
+        @param skip_known: Drop emails that are already in the database before
+            they are looked up
+        @param dedupe: EmailDeduplicator; each address is then looked up once,
+            under its canonical form, and the deduplicator holds every spelling
+            of it that was read
+        @return: generator of (email, response) tuples
+        """
+        if dedupe is not None:
+            emails = dedupe.dedupe(emails)
+        if skip_known:
+            emails = self.known_email_filter().filter(emails)
+
+        logger.info('Processing emails with {} workers'.format(concurrency))
+        return bounded_imap(self.process_person, emails, concurrency=concurrency, backlog=backlog)
+
+    def process_file(self, fname, journal_path=None, resume=False, column='email', fmt=None, concurrency=4, dedupe=None, **kwargs):
+        """ Look up and store every email in a file, journaling progress so the run can be resumed.
+
+        @param fname: Path of a CSV or JSON Lines file of emails
+        @param journal_path: Path of the run journal. Defaults to the input path with '.journal' appended.
+        @param resume: Continue from the journal of an earlier, interrupted run
+        @param column: Name of the CSV column or JSON key holding the email
+        @param fmt: One of 'csv' or 'jsonl', overriding the file extension
+        @param concurrency: Maximum number of requests in flight at once
+        @param dedupe: EmailDeduplicator; rows repeating an address already read
+            are marked done without a lookup, and the rest are looked up under
+            their canonical form. Repeats of an address read before a resume
+            point are not known to a resumed run.
+        @param kwargs: Options passed to RunJournal
+        @return: generator of (email, response) tuples
+        """
+        journal = RunJournal(journal_path or fname + '.journal', fname, resume=resume, **kwargs)
+        if journal.complete:
+            logger.info(Colors.OKGREEN + 'All {} rows of {} were already processed'.format(journal.rows_done, fname) + Colors.ENDC)
+            journal.close()
+            return
+
+        rows = journal.pending(EmailParser.iter_email_offsets(fname, column=column, fmt=fmt, start=journal.offset))
+        if dedupe is not None:
+            rows = self._first_occurrences(rows, journal, dedupe)
+        canonical = dedupe.canonicalize if dedupe is not None else (lambda email: email)
+
+        finished = False
+        try:
+            for (offset, email), response in bounded_imap(lambda row: self.process_person(canonical(row[1])), rows, concurrency=concurrency):
+                # the journal identifies rows by the email as read
+                journal.done(offset, email)
+                yield canonical(email), response
+            finished = True
+        finally:
+            journal.close(complete=finished)
+
+    @staticmethod
+    def _first_occurrences(rows, journal, dedupe):
+        # a repeated row is done as soon as it is read; the journal still holds
+        # its watermark at the first occurrence until that lookup finishes
+        for offset, email in rows:
+            if dedupe.add(email) is None:
+                journal.done(offset, email)
+                continue
+            yield offset, email
+
+    def known_email_filter(self, **kwargs):
+        """ Build a filter of the emails that are already in the database
+
+        @param kwargs: Options passed to KnownEmailFilter
+        @return: KnownEmailFilter
+        """
+        return KnownEmailFilter(self.db, **kwargs)
+
     def retry_person(self, retry_state):
+        email, response = self._retry_lookup(retry_state)
+        self.db.update_retry_row(retry_state, response)
+
+        return response
+
+    def retry_failures(self, concurrency=4, page_size=500):
+        """ Retry every failed lookup that is due, a page of the retry queue at a time.
+
+        Lookups within a page run concurrently, and the new status of every row
+        in the page is written back in one batch, which reschedules the rows
+        that need another attempt.
+
+        @param concurrency: Maximum number of requests in flight at once
+        @param page_size: Number of failures read from the retry queue at once
+        @return: int, number of lookups retried
+        """
+        RETRY_QUEUE_DEPTH.set(self.db.count_retry_queue())
+
+        retried = 0
+        for page in self.db.iter_retry_queue(page_size=page_size):
+            results = list(bounded_imap(self._retry_lookup, page, concurrency=concurrency))
+            self.db.update_retry_rows((row, response) for row, (_, response) in results)
+            retried += len(results)
+            RETRY_QUEUE_DEPTH.dec(len(results))
+
+        RETRY_QUEUE_DEPTH.set(self.db.count_retry_queue())
+
+        logger.info('Retried {} failed lookups'.format(retried))
+        return retried
+
+    def run_retry_daemon(self, poll_interval=60, stop_event=None, **kwargs):
+        """ Keep retrying failed lookups as they fall due, until stop_event is set.
+
+        @param poll_interval: Seconds to wait when nothing is due
+        @param stop_event: threading.Event used to stop the daemon
+        @param kwargs: Options passed to retry_failures
+        @return: None
+        """
+        stop_event = stop_event or threading.Event()
+        logger.info('Starting retry daemon, polling every {} seconds'.format(poll_interval))
+
+        while not stop_event.is_set():
+            if not self.retry_failures(**kwargs):
+                stop_event.wait(poll_interval)
+
+    def _retry_lookup(self, retry_state):
         email = retry_state['email']
-        response = self.api.get_person(email)
+        response = self._get_person(email)
 
         if response.status == 200:
-            self.db.insert_user_record(email, response)
+            try:
+                if self.refresh:
+                    logger.info('Refreshing user record for {}'.format(email))
+                    self.db.upsert_user_record(email, response)
+                else:
+                    self.db.insert_user_record(email, response)
+            except IntegrityError, e:
+                logger.warn(Colors.FAIL + 'Error inserting user record: {}'.format(e) + Colors.ENDC)
         else:
             if response.status == 202:
                 logger.warn(Colors.WARNING + '  202 ACCEPTED: ' + Colors.ENDC + 'will need to retry lookup for ' + email)
@@ -54,66 +221,14 @@ class BusyBody:
             else:
                 logger.error(Colors.FAIL + '  ' + str(response.status) + ' ' + self.api.status_map[response.status] + ': ' + Colors.ENDC + 'failed to return a result for ' + email)
 
-        self.db.update_retry_row(retry_state, response)
-
-        return response
+        return email, response
 
-    def dump_failures(self, outf_path, include_completed=False):
-        self.db.dump_failure_table(outf_path, include_completed=include_completed)
+    def dump_failures(self, outf_path, include_completed=False, **kwargs):
+        return self.db.dump_failures(outf_path, include_completed=include_completed, **kwargs)
 
     def get_failures(self):
-        failures = self.db.fetch_retry_queue()
+        failures = self.db.fetch_retry_queue(due_only=False)
         return failures
 
-    def dump_user_data(self, outf_path):
-        FacebookProfile = (UserProfile
-            .select(UserProfile)
-            .where(UserProfile.network_name == 'Facebook')
-            .alias('FacebookProfile')
-        )
-
-        TwitterProfile = (UserProfile
-            .select(UserProfile)
-            .where(UserProfile.network_name == 'Twitter')
-            .alias('TwitterProfile')
-        )
-
-        Website = (UserProfile
-            .select(UserProfile)
-            .where(UserProfile.network_name == 'Web')
-            .alias('Website')
-        )
-
-        query = (User
-            .select(
-                User.user_id.alias('user_id'),
-                User.first_name.alias('first_name'),
-                User.last_name.alias('last_name'),
-                User.email.alias('email'),
-                UserAddress.location_general.alias('location'),
-                UserDemography.age.alias('age'),
-                UserDemography.age_range_min.alias('age_range_min'),
-                UserDemography.age_range_max.alias('age_range_max'),
-                UserModelScore.score_value.alias('klout_score'),
-                FacebookProfile.c.profile_id.alias('facebook_id'),
-                FacebookProfile.c.user_name.alias('facebook_username'),
-                FacebookProfile.c.profile_url.alias('facebook_profile'),
-                TwitterProfile.c.profile_id.alias('twitter_id'),
-                TwitterProfile.c.user_name.alias('twitter_screen_name'),
-                TwitterProfile.c.followers.alias('twitter_followers'),
-                TwitterProfile.c.following.alias('twitter_following'),
-                Website.c.profile_url.alias('website'),
-                User.create_dt.alias('scraped_on')
-            )
-            .join(UserAddress, JOIN.LEFT_OUTER).switch(User)
-            .join(UserModelScore, JOIN.LEFT_OUTER).switch(User)
-            .join(UserDemography, JOIN.LEFT_OUTER).switch(User)
-            .join(UserTopic, JOIN.LEFT_OUTER).switch(User)
-            .join(FacebookProfile, JOIN.LEFT_OUTER, on=(User.user_id==FacebookProfile.c.user_id)).switch(User)
-            .join(TwitterProfile, JOIN.LEFT_OUTER, on=(User.user_id==TwitterProfile.c.user_id)).switch(User)
-            .join(Website, JOIN.LEFT_OUTER, on=(User.user_id==Website.c.user_id))
-            .group_by(User)
-        )
-
-        with open(outf_path, 'w') as outf:
-            dump_csv(query, outf)
+    def dump_user_data(self, outf_path, **kwargs):
+        return self.db.dump_user_data(outf_path, **kwargs)
@@ -0,0 +1,185 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from ..utils.colors import Colors
+
+logger = logging.getLogger(__name__)
+
+# number of bytes at the start of the input hashed to recognize it
+_HEAD_BYTES = 64 * 1024
+
+
+def input_identity(fname):
+    """ Describe an input file well enough to tell whether it changed
+
+    @param fname: Path of the input file
+    @return: dict
+    """
+    stat = os.stat(fname)
+    with open(fname, 'rb') as inf:
+        head = hashlib.md5(inf.read(_HEAD_BYTES)).hexdigest()
+    return {
+        'path': os.path.abspath(fname),
+        'size': stat.st_size,
+        'mtime': int(stat.st_mtime),
+        'head_md5': head
+    }
+
+
+def email_hash(email):
+    return hashlib.md5(email.strip().lower().encode('utf-8')).hexdigest()[:16]
+
+
+class RunJournal(object):
+    """
+    Append-only record of how far an enrichment run got through its input.
+
+    The journal starts with the identity of the input file, followed by
+    checkpoints. Each checkpoint holds the byte offset before which every row
+    is done, plus hashes of the rows after that offset that finished early;
+    with concurrent lookups rows finish out of order. A checkpoint is written
+    every `checkpoint_every` rows or `checkpoint_interval` seconds, and each
+    write is fsync'd. A run killed at any point therefore loses at most one
+    batch of progress, and a torn last line is ignored on resume.
+
+    On resume, reading starts with one seek to the saved offset, and rows that
+    finished early are skipped without being looked up again.
+    """
+
+    def __init__(self, path, input_fname, resume=False, checkpoint_every=100, checkpoint_interval=5.0):
+        """ Open a journal for a run over an input file
+
+        @param path: Path of the journal file
+        @param input_fname: Path of the input file
+        @param resume: Continue from the journal's last checkpoint. Otherwise any
+            existing journal is replaced.
+        @param checkpoint_every: Number of finished rows that triggers a checkpoint
+        @param checkpoint_interval: Maximum seconds between checkpoints while rows finish
+        @return: None
+        """
+        self.path = path
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_interval = checkpoint_interval
+        self.identity = input_identity(input_fname)
+
+        self.offset = 0
+        self.rows_done = 0
+        self.complete = False
+        self._ahead = {}
+        self._skip = set()
+        self._issued = collections.deque()
+        self._finished = set()
+        self._since_checkpoint = 0
+        self._last_checkpoint = time.time()
+        self._lock = threading.Lock()
+
+        if resume and os.path.exists(path):
+            self._load()
+            self._journal = open(path, 'ab')
+        else:
+            if os.path.exists(path):
+                logger.warn(Colors.WARNING + 'Replacing existing run journal {}'.format(path) + Colors.ENDC)
+            self._journal = open(path, 'wb')
+            self._append(dict(self.identity, type='run', started=time.time()))
+
+    def _load(self):
+        records = []
+        with open(self.path, 'rb') as inf:
+            for line in inf:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # a checkpoint torn by a crash; everything before it is intact
+                    break
+
+        if not records or records[0].get('type') != 'run':
+            raise ValueError('{} is not a run journal'.format(self.path))
+        header = records[0]
+        for key in ('size', 'mtime', 'head_md5'):
+            if header[key] != self.identity[key]:
+                raise ValueError('The input file has changed since {} was written ({} differs)'.format(self.path, key))
+
+        for record in records[1:]:
+            if record['type'] == 'checkpoint':
+                self.offset = record['offset']
+                self.rows_done = record['rows']
+                self._skip = set(record['ahead'])
+            elif record['type'] == 'complete':
+                self.complete = True
+
+        logger.info('Resuming from offset {} with {} rows done'.format(self.offset, self.rows_done))
+
+    def _append(self, record):
+        self._journal.write(json.dumps(record) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def pending(self, rows):
+        """ Register rows as they are read, dropping the ones that finished in an earlier run
+
+        @param rows: Iterable of (offset, email) tuples, starting at self.offset
+        @return: generator of (offset, email) tuples still to process
+        """
+        for offset, email in rows:
+            with self._lock:
+                self._issued.append(offset)
+                if self._skip and email_hash(email) in self._skip:
+                    self._skip.discard(email_hash(email))
+                    self._finish(offset, email, count=False)
+                    continue
+            yield offset, email
+
+    def done(self, offset, email):
+        """ Record that a row has been processed, checkpointing if a batch is complete
+
+        @param offset: Offset of the row, as read
+        @param email: Email of the row
+        @return: None
+        """
+        with self._lock:
+            self._finish(offset, email)
+            self._since_checkpoint += 1
+            if (self._since_checkpoint >= self.checkpoint_every or
+                    time.time() - self._last_checkpoint >= self.checkpoint_interval):
+                self._checkpoint()
+
+    def _finish(self, offset, email, count=True):
+        if count:
+            self.rows_done += 1
+        self._finished.add(offset)
+        self._ahead[offset] = email_hash(email)
+
+        # move the watermark past every row finished in input order
+        while self._issued and self._issued[0] in self._finished:
+            self.offset = self._issued.popleft()
+            self._finished.discard(self.offset)
+            self._ahead.pop(self.offset, None)
+
+    def _checkpoint(self):
+        self._append({
+            'type': 'checkpoint',
+            'offset': self.offset,
+            'rows': self.rows_done,
+            'ahead': sorted(self._ahead.values()),
+            'time': time.time()
+        })
+        self._since_checkpoint = 0
+        self._last_checkpoint = time.time()
+
+    def close(self, complete=False):
+        """ Write a final checkpoint and close the journal
+
+        @param complete: Whether the whole input was processed
+        @return: None
+        """
+        with self._lock:
+            self._checkpoint()
+            if complete:
+                self._append({'type': 'complete', 'rows': self.rows_done, 'time': time.time()})
+                self.complete = True
+            self._journal.close()
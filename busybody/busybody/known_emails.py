@@ -0,0 +1,85 @@
+import logging
+
+from ..utils.colors import Colors
+from ..utils.data_structures import BloomFilter
+
+logger = logging.getLogger(__name__)
+
+
+class KnownEmailFilter(object):
+    """
+    Pre-flight filter that drops emails which are already in the database, so
+    that no paid lookup is made for them.
+
+    The existing emails are loaded once into a set. Above `bloom_threshold`
+    users they go into a BloomFilter instead to bound memory; a Bloom filter
+    hit is then confirmed against the database, so a false positive costs one
+    indexed query rather than a skipped email. The Bloom filter only ever
+    holds the stored emails, so it keeps the error rate it was sized for
+    however long the input is.
+
+    The Bloom filter bounds the memory of the stored emails only. Repeats
+    within the input are found with an exact set of the emails yielded, which
+    grows with the number of new emails read; a new email can't be confirmed
+    against the database, so a filter there would drop emails outright. Pass
+    track_repeats=False for inputs too large for that set, e.g. ones already
+    deduplicated.
+    """
+
+    def __init__(self, database, bloom_threshold=5000000, error_rate=0.001, track_repeats=True):
+        """ Load the emails already stored in a database.
+
+        @param database: Database connector to read existing users from
+        @param bloom_threshold: Number of users above which a BloomFilter is used
+        @param error_rate: False positive rate of the BloomFilter
+        @param track_repeats: Also drop emails repeated within the input
+        @return: None
+        """
+        self.db = database
+        self.skipped = 0
+        # emails yielded by filter(), kept apart from the stored ones
+        self.seen = set() if track_repeats else None
+
+        count = database.count_users()
+        if count > bloom_threshold:
+            logger.info('Loading {} known emails into a bloom filter'.format(count))
+            self.index = BloomFilter(count, error_rate=error_rate)
+            self.exact = False
+        else:
+            logger.info('Loading {} known emails'.format(count))
+            self.index = set()
+            self.exact = True
+
+        for email in database.iter_known_emails():
+            self.index.add(email)
+
+    def __contains__(self, email):
+        if email not in self.index:
+            return False
+        return self.exact or self.db.user_exists(email)
+
+    def filter(self, emails):
+        """ Yield only the emails that are not in the database yet.
+
+        Unless repeats aren't tracked, emails are remembered in an exact set as
+        they are yielded, so repeats within the input are dropped as well,
+        without a database query.
+
+        @param emails: Iterable of emails
+        @return: generator of emails
+        """
+        for email in emails:
+            if self.seen is not None and email in self.seen:
+                self.skipped += 1
+                logger.debug('Skipping {}, repeated in the input'.format(email))
+                continue
+            if email in self:
+                self.skipped += 1
+                logger.debug('Skipping {}, already in the database'.format(email))
+                continue
+
+            if self.seen is not None:
+                self.seen.add(email)
+            yield email
+
+        logger.info(Colors.OKGREEN + 'Skipped {} emails that were already in the database'.format(self.skipped) + Colors.ENDC)
@@ -0,0 +1,135 @@
+import logging
+import multiprocessing
+import os
+import traceback
+from Queue import Full
+
+from ..database import SqliteConnector
+from ..database.models import MODELS
+from ..database.shards import shard_for, shard_paths, merge_shards
+from ..utils.colors import Colors
+from busybody import BusyBody
+
+logger = logging.getLogger(__name__)
+
+
+def _ingest_shard(index, path, api_factory, profile, concurrency, inbox, results):
+    # runs in a worker process: the process has its own copy of the models, so
+    # binding them to this shard's connector does not affect any other shard
+    try:
+        db = SqliteConnector(path, profile=profile)
+        db.client.create_tables(MODELS, safe=True)
+        # a shard is only ever copied whole into the merged database, so it
+        # never needs the indexes that serve queries
+        db.drop_secondary_indexes()
+        bb = BusyBody(db, api_factory())
+
+        processed = 0
+        for _ in bb.process_many(iter(inbox.get, None), concurrency=concurrency):
+            processed += 1
+
+        results.put({'shard': index, 'processed': processed, 'users': db.count_users()})
+    except Exception:
+        # the parent stops feeding this shard once the process has exited
+        results.put({'shard': index, 'error': traceback.format_exc()})
+
+
+class ShardedIngest(object):
+    """
+    Looks up emails with several worker processes, each writing to its own
+    sqlite shard, so ingestion is not limited to sqlite's single writer or to
+    one core. Emails are hash-partitioned across the shards, then merge()
+    combines the shards into one database.
+
+    ingest = ShardedIngest('shards/', 8, lambda: FullContact(key, rate_limiter=RateLimiter(rate=1.0 / 8, share=1.0 / 8)))
+    ingest.run(EmailParser.iter_emails('emails.csv'))
+    ingest.merge('busybody.sqlite')
+
+    The worker processes do not share a rate limiter, so give each API
+    object's RateLimiter a `share` of one over the number of shards; the
+    limits it reads from the rate limit headers are scaled down by it.
+    """
+
+    def __init__(self, directory, shards, api_factory, profile='bulk-load', concurrency=4, backlog=1000):
+        """ Configure a sharded ingestion
+
+        @param directory: Directory the shard databases are written to
+        @param shards: Number of worker processes and shard databases
+        @param api_factory: Function called in each worker to create its FullContact API object
+        @param profile: Sqlite profile of the shards
+        @param concurrency: Number of concurrent lookups within each worker
+        @param backlog: Maximum number of emails queued for each worker
+        @return: None
+        """
+        self.directory = directory
+        self.shards = shards
+        self.api_factory = api_factory
+        self.profile = profile
+        self.concurrency = concurrency
+        self.backlog = backlog
+        self.paths = shard_paths(directory, shards)
+
+    def run(self, emails):
+        """ Look up every email, each in the worker process of its shard
+
+        @param emails: Iterable of emails
+        @return: list of dicts with the number of lookups and users of each shard
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        inboxes = [multiprocessing.Queue(self.backlog) for _ in range(self.shards)]
+        results = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(
+                target=_ingest_shard,
+                args=(i, path, self.api_factory, self.profile, self.concurrency, inboxes[i], results),
+                name='busybody-shard-{}'.format(i)
+            )
+            for i, path in enumerate(self.paths)
+        ]
+        for worker in workers:
+            worker.start()
+        logger.info('Started {} shard workers writing to {}'.format(self.shards, self.directory))
+
+        try:
+            for email in emails:
+                shard = shard_for(email, self.shards)
+                self._send(workers[shard], inboxes[shard], email)
+        finally:
+            for worker, inbox in zip(workers, inboxes):
+                self._send(worker, inbox, None)
+
+        # collect results before joining, so no worker blocks on a full results queue
+        stats = sorted((results.get() for _ in workers), key=lambda s: s['shard'])
+        for worker in workers:
+            worker.join()
+
+        failed = [s for s in stats if 'error' in s]
+        for s in failed:
+            logger.error(Colors.FAIL + 'Shard {} failed:\n{}'.format(s['shard'], s['error']) + Colors.ENDC)
+        if failed:
+            raise RuntimeError('{} of {} shard workers failed'.format(len(failed), self.shards))
+
+        logger.info(Colors.OKGREEN + 'Looked up {} emails across {} shards'.format(sum(s['processed'] for s in stats), self.shards) + Colors.ENDC)
+        return stats
+
+    @staticmethod
+    def _send(worker, inbox, item):
+        # put an item on a worker's queue, dropping it if the worker has died
+        while worker.is_alive():
+            try:
+                inbox.put(item, timeout=1)
+                return
+            except Full:
+                continue
+
+    def merge(self, target_path, profile='bulk-load', defer_indexes=False):
+        """ Combine the shards into one database
+
+        @param target_path: Path of the database to merge into
+        @param profile: Sqlite profile used for the target while merging
+        @param defer_indexes: Drop the target's secondary indexes while merging and rebuild them after
+        @return: dict with the number of users and failures merged
+        """
+        return merge_shards(target_path, self.paths, profile=profile, defer_indexes=defer_indexes)
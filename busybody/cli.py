@@ -0,0 +1,287 @@
+""" The busybody command line tool
+
+Only argparse and logging are imported up front. Each command imports the
+backends and the HTTP stack it uses when it runs, so short jobs such as
+`busybody stats` start without loading requests or pymongo.
+"""
+import argparse
+import contextlib
+import glob
+import json
+import logging
+import os
+
+from database.sqlite_pragmas import PROFILES
+from utils.colors import Colors
+
+logger = logging.getLogger('busybody')
+
+
+class ApiFactory(object):
+    """ Creates each shard worker's FullContact client with its share of the key's rate """
+
+    def __init__(self, fc_key, base_url, shards):
+        self.fc_key = fc_key
+        self.base_url = base_url
+        self.shards = shards
+
+    def __call__(self):
+        from fullcontact import FullContact, RateLimiter
+
+        share = 1.0 / self.shards
+        return FullContact(self.fc_key, base_url=self.base_url, rate_limiter=RateLimiter(rate=share, share=share))
+
+
+def _connect(args, profile='safe'):
+    """ Open the database selected on the command line, creating the sqlite tables if needed
+
+    @param args: Parsed arguments
+    @param profile: Sqlite profile to open the database with
+    @return: database connector
+    """
+    if args.mongo:
+        from database.mongo_db import MongoDbConnector
+        return MongoDbConnector(args.mongo, args.collection)
+
+    from database.models import MODELS
+    from database.sqlite_db import SqliteConnector
+    db = SqliteConnector(args.database, profile=profile)
+    db.client.create_tables(MODELS, safe=True)
+    return db
+
+
+@contextlib.contextmanager
+def _nothing():
+    yield
+
+
+def _close(db):
+    # the mongo connector buffers writes until it is closed
+    if hasattr(db, 'close'):
+        db.close()
+
+
+def _api_key(args):
+    from utils.parsers import YamlConfigParser
+    return YamlConfigParser.read_config(args.config)['fc_api_key']
+
+
+def _base_url(args):
+    from fullcontact.fullcontact import API_URL
+    return args.base_url or API_URL
+
+
+def ingest(args):
+    """ Look up the emails in a file and store the results """
+    from busybody import BusyBody
+    from fullcontact import FullContact
+
+    dedupe = _deduplicator(args)
+    if args.shards:
+        return _ingest_sharded(args, dedupe)
+
+    db = _connect(args, profile=args.profile)
+    try:
+        bb = BusyBody(db, FullContact(_api_key(args), base_url=_base_url(args)), refresh=args.refresh)
+        with db.deferred_indexes() if args.defer_indexes and not args.mongo else _nothing():
+            processed = 0
+            for _ in bb.process_file(args.input, journal_path=args.journal, resume=args.resume, column=args.column, fmt=args.format,
+                                     concurrency=args.concurrency, dedupe=dedupe, checkpoint_every=args.checkpoint_every):
+                processed += 1
+    finally:
+        _close(db)
+
+    logger.info(Colors.OKGREEN + 'SUCCESS: Looked up {} emails'.format(processed) + Colors.ENDC)
+    _report_duplicates(args, dedupe)
+
+
+def _deduplicator(args):
+    if not (args.dedupe or args.strip_tags or args.aliases):
+        return None
+
+    from utils.canonical import EmailCanonicalizer, EmailDeduplicator
+    return EmailDeduplicator(EmailCanonicalizer(strip_tags=args.strip_tags))
+
+
+def _report_duplicates(args, dedupe):
+    if dedupe is None:
+        return
+    logger.info('Skipped {} repeated emails'.format(dedupe.duplicates))
+    if args.aliases:
+        dedupe.write_aliases(args.aliases)
+
+
+def _ingest_sharded(args, dedupe):
+    from busybody import ShardedIngest
+    from utils.parsers import EmailParser
+
+    sharded = ShardedIngest(args.shard_dir, args.shards, ApiFactory(_api_key(args), _base_url(args), args.shards),
+                            profile=args.profile, concurrency=args.concurrency)
+    emails = EmailParser.iter_emails(args.input, column=args.column, fmt=args.format)
+    sharded.run(dedupe.dedupe(emails) if dedupe is not None else emails)
+    counts = sharded.merge(args.database, defer_indexes=args.defer_indexes)
+    logger.info(Colors.OKGREEN + 'SUCCESS: Merged {users} users and {failures} failures'.format(**counts) + Colors.ENDC)
+    _report_duplicates(args, dedupe)
+
+
+def retry(args):
+    """ Retry the failed lookups that are due """
+    from busybody import BusyBody
+    from fullcontact import FullContact
+
+    db = _connect(args)
+    try:
+        bb = BusyBody(db, FullContact(_api_key(args), base_url=_base_url(args)))
+        if args.daemon:
+            try:
+                bb.run_retry_daemon(poll_interval=args.poll_interval, concurrency=args.concurrency, page_size=args.page_size)
+            except KeyboardInterrupt:
+                logger.info('Stopping retry daemon')
+        else:
+            retried = bb.retry_failures(concurrency=args.concurrency, page_size=args.page_size)
+            logger.info(Colors.OKGREEN + 'SUCCESS: Retried {} lookups'.format(retried) + Colors.ENDC)
+    finally:
+        _close(db)
+
+
+def export(args):
+    """ Write users or failures to a file """
+    db = _connect(args)
+    try:
+        if args.table == 'users':
+            rows = db.dump_user_data(args.output, fmt=args.format)
+        else:
+            rows = db.dump_failures(args.output, include_completed=args.include_completed, fmt=args.format)
+    finally:
+        _close(db)
+    logger.info(Colors.OKGREEN + 'SUCCESS: Exported {} {} to {}'.format(rows, args.table, args.output) + Colors.ENDC)
+
+
+def stats(args):
+    """ Print the size of the database and of the retry queue """
+    db = _connect(args)
+    try:
+        counts = {
+            'users': db.count_users(),
+            'retry_due': db.count_retry_queue(due_only=True),
+            'retry_pending': db.count_retry_queue(due_only=False),
+        }
+    finally:
+        _close(db)
+
+    if args.json:
+        print json.dumps(counts, sort_keys=True)
+    else:
+        print 'users          {users}'.format(**counts)
+        print 'retries due    {retry_due}'.format(**counts)
+        print 'retries queued {retry_pending}'.format(**counts)
+
+
+def merge(args):
+    """ Merge shard databases into the database """
+    from database.shards import merge_shards
+
+    paths = []
+    for path in args.shards:
+        paths.extend(sorted(glob.glob(os.path.join(path, '*.sqlite'))) if os.path.isdir(path) else [path])
+    counts = merge_shards(args.database, paths, defer_indexes=args.defer_indexes)
+    logger.info(Colors.OKGREEN + 'SUCCESS: Merged {users} users and {failures} failures'.format(**counts) + Colors.ENDC)
+
+
+def reparse(args):
+    """ Rebuild the parsed tables from the archive of raw responses """
+    from database.mongo_db import MongoDbConnector
+    from database.sqlite_db import SqliteConnector
+
+    db = SqliteConnector(args.database, profile='bulk-load')
+    db.upgrade_schema()
+    source = MongoDbConnector(args.from_mongo, args.collection) if args.from_mongo else None
+    rebuilt = db.reparse_archive(source=source, processes=args.processes, batch_size=args.batch_size)
+    logger.info(Colors.OKGREEN + 'SUCCESS: Rebuilt {} users'.format(rebuilt) + Colors.ENDC)
+
+
+def build_parser():
+    """ Build the argument parser of the busybody command
+
+    @return: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(prog='busybody', description='Enrich user data with the FullContact API')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every record')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Only log warnings and errors')
+    parser.add_argument('--database', default='busybody.sqlite', help='Sqlite database to use')
+    parser.add_argument('--mongo', default=None, help='Use this MongoDb instance instead of sqlite')
+    parser.add_argument('--collection', default='people', help='MongoDb collection holding the users')
+    parser.add_argument('--config', default='config.yaml', help='Configuration file holding the FullContact API key')
+    parser.add_argument('--base-url', default=None, help='FullContact API address, e.g. a local stand-in server')
+    subparsers = parser.add_subparsers(dest='command')
+
+    sub = subparsers.add_parser('ingest', help='Look up the emails in a file')
+    sub.add_argument('input', help='CSV or JSON Lines file of emails, optionally gzipped')
+    sub.add_argument('--column', default='email', help='Column or key holding the email')
+    sub.add_argument('--format', choices=['csv', 'jsonl'], default=None, help='Input format, if not given by the file extension')
+    sub.add_argument('-c', '--concurrency', type=int, default=4, help='Number of concurrent lookups')
+    sub.add_argument('--profile', choices=sorted(PROFILES), default='safe', help='Sqlite performance profile')
+    sub.add_argument('--journal', default=None, help='Run journal; defaults to the input path with .journal appended')
+    sub.add_argument('--resume', action='store_true', help='Continue from the journal of an interrupted run')
+    sub.add_argument('--checkpoint-every', type=int, default=100, help='Rows between journal checkpoints')
+    sub.add_argument('--refresh', action='store_true', help='Bring users that are already stored up to date instead of skipping them')
+    sub.add_argument('--shards', type=int, default=0, help='Look up with this many worker processes, each writing a shard, then merge')
+    sub.add_argument('--shard-dir', default='shards', help='Directory the shards are written to')
+    sub.add_argument('--dedupe', action='store_true', help='Look up each address once, lowercased and with provider aliases folded together')
+    sub.add_argument('--strip-tags', action='store_true', help='Also strip +tags from addresses on every domain; implies --dedupe')
+    sub.add_argument('--aliases', default=None, help='Write a CSV mapping every spelling read to the address it was looked up as; implies --dedupe')
+    sub.add_argument('--defer-indexes', action='store_true', help='Drop the secondary indexes for the load and rebuild them after (sqlite only)')
+    sub.set_defaults(func=ingest)
+
+    sub = subparsers.add_parser('retry', help='Retry failed lookups that are due')
+    sub.add_argument('-c', '--concurrency', type=int, default=4, help='Number of concurrent lookups')
+    sub.add_argument('--page-size', type=int, default=500, help='Failures read from the retry queue at once')
+    sub.add_argument('--daemon', action='store_true', help='Keep retrying as failures fall due')
+    sub.add_argument('--poll-interval', type=float, default=60, help='Seconds the daemon waits when nothing is due')
+    sub.set_defaults(func=retry)
+
+    sub = subparsers.add_parser('export', help='Write users or failures to a file')
+    sub.add_argument('table', choices=['users', 'failures'], help='What to export')
+    sub.add_argument('output', help='File to write: .csv or .jsonl, optionally with .gz, .npz or .parquet')
+    sub.add_argument('--format', choices=['csv', 'jsonl', 'npz', 'parquet'], default=None, help='Output format, if not given by the file extension')
+    sub.add_argument('--include-completed', action='store_true', help='Include failures that are no longer retried')
+    sub.set_defaults(func=export)
+
+    sub = subparsers.add_parser('stats', help='Show the number of users and queued retries')
+    sub.add_argument('--json', action='store_true', help='Print the counts as JSON')
+    sub.set_defaults(func=stats)
+
+    sub = subparsers.add_parser('merge', help='Merge shard databases into the database')
+    sub.add_argument('shards', nargs='+', help='Shard databases, or directories of them')
+    sub.add_argument('--defer-indexes', action='store_true', help='Drop the secondary indexes for the merge and rebuild them after')
+    sub.set_defaults(func=merge)
+
+    sub = subparsers.add_parser('reparse', help='Rebuild the parsed tables from archived responses')
+    sub.add_argument('-p', '--processes', type=int, default=None, help='Number of parser processes; defaults to the number of CPUs')
+    sub.add_argument('-b', '--batch-size', type=int, default=500, help='Responses parsed and written at once')
+    sub.add_argument('--from-mongo', default=None, help='Read the archive from this MongoDb instance')
+    sub.set_defaults(func=reparse)
+
+    return parser
+
+
+def main(argv=None):
+    """ Run the busybody command
+
+    @param argv: Arguments, defaulting to the process's
+    @return: int, exit status
+    """
+    args = build_parser().parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARNING if args.quiet else logging.INFO,
+        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    try:
+        args.func(args)
+    except KeyboardInterrupt:
+        logger.error(Colors.FAIL + 'Interrupted' + Colors.ENDC)
+        return 130
+    return 0
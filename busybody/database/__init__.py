@@ -1,4 +1,18 @@
 # busybody.database
 
-from mongo_db import MongoDbConnector
-from sqlite_db import SqliteConnector
+from ..utils.lazy import lazy_exports
+
+lazy_exports(__name__, {
+    'MongoDbConnector': '.mongo_db',
+    'SqliteConnector': '.sqlite_db',
+    'RetryPolicy': '.retry_policy',
+    'ProfiledSqliteDatabase': '.sqlite_profiles',
+    'PROFILES': '.sqlite_pragmas',
+    'BatchingWriter': '.writer',
+    'shard_for': '.shards',
+    'shard_paths': '.shards',
+    'merge_shards': '.shards',
+    'compress_response': '.archive',
+    'decompress_response': '.archive',
+    'parse_archive': '.archive',
+})
@@ -0,0 +1,77 @@
+import json
+import zlib
+
+from record_parser import parse_record
+from ..utils import chunked
+
+# zlib level used for archived responses; past 6 the output barely shrinks while compression slows down
+COMPRESSION_LEVEL = 6
+
+
+def compress_response(record, level=COMPRESSION_LEVEL):
+    """ Serialize a FullContact response and compress it for the archive
+
+    @param record: Response returned by FullContact
+    @param level: zlib compression level
+    @return: str of compressed bytes
+    """
+    return zlib.compress(json.dumps(record, separators=(',', ':')), level)
+
+
+def decompress_response(body):
+    """ Restore a response stored by compress_response
+
+    @param body: Compressed bytes, as a str or buffer
+    @return: dict
+    """
+    return json.loads(zlib.decompress(body))
+
+
+def archive_row(email, record):
+    """ Build the archive entry for a response
+
+    @param email: Email that was searched
+    @param record: Response returned by FullContact
+    @return: tuple of (email, request_id, status, compressed body)
+    """
+    return email, record.get('requestId'), record.get('status'), compress_response(record)
+
+
+def _parse_archived(entry):
+    # runs in a pool process: decompressing and mapping are where the time goes
+    email, create_dt, body = entry
+    return email, parse_record(email, decompress_response(body), now=create_dt)
+
+
+def parse_archive(entries, processes=None, batch_size=500):
+    """ Decompress and parse archived responses with a pool of processes
+
+    Batches are parsed one ahead of the caller: while the caller writes a
+    batch, the pool is already working on the next, and `entries` is only
+    read from the calling thread, so it can be a live database cursor.
+
+    @param entries: Iterable of (email, create_dt, compressed body) tuples
+    @param processes: Number of parser processes. Defaults to the number of CPUs.
+    @param batch_size: Number of responses per batch
+    @return: generator of lists of (email, (user row, child rows)) tuples, as returned by parse_record
+    """
+    import multiprocessing
+
+    # buffers from sqlite can't be pickled
+    batches = chunked(((email, create_dt, str(body)) for email, create_dt, body in entries), batch_size)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        chunksize = max(1, batch_size // (4 * (processes or multiprocessing.cpu_count())))
+        pending = None
+        for batch in batches:
+            submitted = pool.map_async(_parse_archived, batch, chunksize)
+            if pending is not None:
+                yield pending.get()
+            pending = submitted
+        if pending is not None:
+            yield pending.get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
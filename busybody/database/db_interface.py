@@ -16,5 +16,26 @@ class AbstractDatabaseConnector:
     def insert_user_record(self, email, response):
         raise NotImplementedError
 
+    def insert_user_records(self, records):
+        raise NotImplementedError
+
+    def upsert_user_record(self, email, response):
+        raise NotImplementedError
+
+    def upsert_user_records(self, records):
+        raise NotImplementedError
+
+    def count_users(self):
+        raise NotImplementedError
+
+    def iter_known_emails(self):
+        raise NotImplementedError
+
+    def user_exists(self, email):
+        raise NotImplementedError
+
     def log_failure(self, email, failure_response):
         raise NotImplementedError
+
+    def log_failures(self, failures):
+        raise NotImplementedError
@@ -267,6 +267,10 @@ class FailureLog(BaseModel):
 
     class Meta:
         db_table = 'failure_log'
+        indexes = (
+            # the retry scheduler pages through open failures in due order
+            (('retry_complete', 'next_attempt_dt'), False),
+        )
 
     failure_log_id = PrimaryKeyField()
     email = CharField(
@@ -277,7 +281,7 @@ class FailureLog(BaseModel):
     )
     message = TextField()
     request_id = CharField(
-        max_length=255
+        null=True, max_length=255
     )
     create_dt = DateTimeField(
         default=datetime.datetime.now, index=True
@@ -294,3 +298,102 @@ class FailureLog(BaseModel):
     retry_complete = BooleanField(
         default=False, index=True
     )
+    next_attempt_dt = DateTimeField(
+        null=True, default=None
+    )
+
+
+class UserFlat(BaseModel):
+    """ Model for the 'user_flat' table, one denormalized row per user, used for exports """
+
+    class Meta:
+        db_table = 'user_flat'
+
+    user = ForeignKeyField(
+        User, primary_key=True, related_name='flat'
+    )
+    first_name = CharField(
+        null=True, max_length=32
+    )
+    last_name = CharField(
+        null=True, max_length=32
+    )
+    email = CharField()
+    location = CharField(
+        null=True, max_length=255
+    )
+    age = IntegerField(
+        null=True
+    )
+    age_range_min = IntegerField(
+        null=True
+    )
+    age_range_max = IntegerField(
+        null=True
+    )
+    klout_score = DecimalField(
+        null=True, decimal_places=2
+    )
+    facebook_id = CharField(
+        null=True, max_length=255
+    )
+    facebook_username = CharField(
+        null=True, max_length=64
+    )
+    facebook_profile = CharField(
+        null=True
+    )
+    twitter_id = CharField(
+        null=True, max_length=255
+    )
+    twitter_screen_name = CharField(
+        null=True, max_length=64
+    )
+    twitter_followers = IntegerField(
+        null=True
+    )
+    twitter_following = IntegerField(
+        null=True
+    )
+    website = CharField(
+        null=True
+    )
+    scraped_on = DateTimeField()
+
+
+class RawResponse(BaseModel):
+    """ Model for the 'raw_response' table, every FullContact response stored whole and zlib-compressed """
+
+    class Meta:
+        db_table = 'raw_response'
+        indexes = (
+            (('email', 'request_id'), True),
+        )
+
+    raw_response_id = PrimaryKeyField()
+    email = CharField(
+        null=False, index=True, max_length=255
+    )
+    request_id = CharField(
+        null=True, max_length=255
+    )
+    status = IntegerField()
+    body = BlobField()
+    create_dt = DateTimeField(
+        default=datetime.datetime.now
+    )
+
+
+# every table in a busybody database, in creation order
+MODELS = [
+    User,
+    UserAddress,
+    UserDemography,
+    UserProfile,
+    UserTopic,
+    UserOrganization,
+    UserModelScore,
+    FailureLog,
+    UserFlat,
+    RawResponse
+]
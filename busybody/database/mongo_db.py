@@ -1,18 +1,142 @@
+import datetime
 import logging
+import threading
 
 from ..utils import Colors
+from ..utils.exporters import export_batches, model_columns
+from ..utils.metrics import DB_WRITE_LATENCY, ROWS_WRITTEN
+from archive import archive_row
 from db_interface import AbstractDatabaseConnector
+from models import FailureLog, UserFlat
+from record_parser import parse_record
+from retry_policy import RetryPolicy
 
 logger = logging.getLogger(__name__)
 
+# columns written by the exports, in the order of the sqlite tables; documents are keyed by ObjectId
+FAILURE_COLUMNS = model_columns(FailureLog, {'failure_log_id': 'str'})
+USER_COLUMNS = model_columns(UserFlat, {'user_id': 'str'})
+
+
+class BulkBuffer(object):
+    """
+    Buffers write operations for a collection and sends them with a single
+    unordered bulk_write once `size` operations are queued, or once the oldest
+    one has waited `interval` seconds.
+
+    Operations that a failed write may not have applied go back to the front
+    of the buffer, so a network error or timeout delays them to the next flush
+    instead of losing them. close() raises if they still can't be written.
+    """
+
+    def __init__(self, collection, size=1000, interval=1.0):
+        """ Create a write buffer for a collection
+
+        @param collection: pymongo Collection to write to
+        @param size: Number of operations that triggers a flush
+        @param interval: Maximum number of seconds an operation stays buffered
+        @return: None
+        """
+        self.collection = collection
+        self.size = size
+        self.interval = interval
+
+        self._ops = []
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._timer = threading.Thread(target=self._flush_periodically, name='busybody-mongo-flush')
+        self._timer.daemon = True
+        self._timer.start()
+
+    def add(self, op):
+        with self._lock:
+            self._ops.append(op)
+            if len(self._ops) >= self.size:
+                self.flush()
+
+    def flush(self):
+        """ Send every buffered operation to the server
+
+        @return: None
+        """
+        from pymongo.errors import BulkWriteError
+
+        with self._lock:
+            ops, self._ops = self._ops, []
+            if not ops:
+                return
+
+            try:
+                with DB_WRITE_LATENCY.time(table=self.collection.name):
+                    self.collection.bulk_write(ops, ordered=False)
+            except BulkWriteError, e:
+                # duplicates are expected when an email is enriched twice; anything else is not
+                errors = e.details.get('writeErrors', [])
+                duplicates = [err for err in errors if err.get('code') == 11000]
+                if e.details.get('writeConcernErrors'):
+                    # the server may not have kept any of them
+                    self._requeue(ops)
+                    raise
+                if len(duplicates) != len(errors):
+                    self._requeue([ops[err['index']] for err in errors if err.get('code') != 11000])
+                    raise
+                logger.warn(Colors.WARNING + 'Skipped {} duplicate documents in {}'.format(len(duplicates), self.collection.name) + Colors.ENDC)
+            except Exception:
+                self._requeue(ops)
+                raise
+
+            ROWS_WRITTEN.inc(len(ops), table=self.collection.name)
+            logger.debug('Flushed {} operations to {}'.format(len(ops), self.collection.name))
+
+    def _requeue(self, ops):
+        self._ops[:0] = ops
+        logger.error(Colors.FAIL + 'Kept {} unwritten operations for {} to retry'.format(len(ops), self.collection.name) + Colors.ENDC)
+
+    def close(self):
+        """ Stop the background flushing and send every buffered operation
+
+        @return: None
+        @raise: the error of the final flush, if any operation could not be written
+        """
+        self._stopped.set()
+        self._timer.join()
+        self.flush()
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception, e:
+                logger.error(Colors.FAIL + 'Failed to flush buffered writes: {}'.format(e) + Colors.ENDC)
+
 
 class MongoDbConnector(AbstractDatabaseConnector):
 
-    def __init__(self, connection_string, collection):
+    def __init__(self, connection_string, collection, database='busybody', failure_collection=None,
+                 archive_collection=None, archive_responses=True, retry_policy=None, buffer_size=1000,
+                 flush_interval=1.0, max_pool_size=100, connect_timeout_ms=20000, socket_timeout_ms=None,
+                 **client_options):
         """ Class for using MongoDb as a backing for BusyBody
 
+        Writes are buffered and sent as unordered bulk writes, so call close()
+        (or flush()) when done to send the last of them.
+
         @param connection_string: Address of a mongodb instance
         @param collection: Name of the collection to insert records into
+        @param database: Name of the database holding the collections
+        @param failure_collection: Name of the collection to log failures in.
+            Defaults to the record collection name suffixed with '_failures'.
+        @param archive_collection: Name of the collection raw responses are archived in.
+            Defaults to the record collection name suffixed with '_raw'.
+        @param archive_responses: Keep every response compressed in the archive
+            collection, where SqliteConnector.reparse_archive can read it
+        @param retry_policy: RetryPolicy used to schedule failed lookups
+        @param buffer_size: Number of buffered writes that triggers a bulk write
+        @param flush_interval: Maximum number of seconds a write stays buffered
+        @param max_pool_size: Maximum number of connections to the server
+        @param connect_timeout_ms: Milliseconds to wait when opening a connection
+        @param socket_timeout_ms: Milliseconds to wait for a reply, or None to wait forever
+        @param client_options: Other options passed to MongoClient
         @return: None
         """
         try:
@@ -22,8 +146,67 @@ class MongoDbConnector(AbstractDatabaseConnector):
             logger.error(Colors.FAIL + 'BusyBody requires pymongo to be installed to use the MongoDb Connector' + Colors.ENDC)
             raise
 
-        self.client = MongoClient(connection_string)
-        self.db = self.client[collection]
+        self.retry_policy = retry_policy or RetryPolicy()
+
+        self.client = MongoClient(
+            connection_string,
+            maxPoolSize=max_pool_size,
+            connectTimeoutMS=connect_timeout_ms,
+            socketTimeoutMS=socket_timeout_ms,
+            **client_options
+        )
+        self.db = self.client[database]
+        self.users = self.db[collection]
+        self.failures = self.db[failure_collection or collection + '_failures']
+        self.archive = self.db[archive_collection or collection + '_raw']
+        self.archive_responses = archive_responses
+
+        self.ensure_indexes()
+
+        self._buffers = [
+            BulkBuffer(self.users, size=buffer_size, interval=flush_interval),
+            BulkBuffer(self.failures, size=buffer_size, interval=flush_interval),
+            BulkBuffer(self.archive, size=buffer_size, interval=flush_interval)
+        ]
+        self._user_buffer, self._failure_buffer, self._archive_buffer = self._buffers
+
+    def ensure_indexes(self):
+        """ Create the indexes used for lookups and the retry queue, if they don't exist
+
+        @return: None
+        """
+        from pymongo import ASCENDING
+
+        self.users.create_index([('email', ASCENDING)], unique=True)
+        self.failures.create_index([('email', ASCENDING)])
+        self.failures.create_index([('request_id', ASCENDING)])
+        self.failures.create_index([('initial_status', ASCENDING)])
+        self.failures.create_index([('retry_complete', ASCENDING), ('next_attempt_dt', ASCENDING)])
+        self.archive.create_index([('email', ASCENDING), ('request_id', ASCENDING)], unique=True)
+
+    def flush(self):
+        """ Send all buffered writes to the server
+
+        @return: None
+        """
+        for buf in self._buffers:
+            buf.flush()
+
+    def close(self):
+        """ Send all buffered writes and stop the background flushing
+
+        @return: None
+        @raise: the first error met flushing a buffer, once every buffer has been closed
+        """
+        error = None
+        for buf in self._buffers:
+            try:
+                buf.close()
+            except Exception, e:
+                logger.error(Colors.FAIL + 'Failed to write buffered operations to {}: {}'.format(buf.collection.name, e) + Colors.ENDC)
+                error = error or e
+        if error is not None:
+            raise error
 
     def insert_user_record(self, email, record):
         """ Insert a Person API result into the database
@@ -32,8 +215,111 @@ class MongoDbConnector(AbstractDatabaseConnector):
         @param record: User record returned by FullContact
         @return: None
         """
+        from pymongo import InsertOne
+
+        self._archive_record(email, record)
+        record['email'] = email
+        self._user_buffer.add(InsertOne(record))
+
+    def _archive_record(self, email, record):
+        from bson import Binary
+        from pymongo import InsertOne
+
+        if not self.archive_responses:
+            return
+        _, request_id, status, body = archive_row(email, record)
+        self._archive_buffer.add(InsertOne({
+            'email': email,
+            'request_id': request_id,
+            'status': status,
+            'body': Binary(body),
+            'create_dt': datetime.datetime.now()
+        }))
+
+    def insert_user_records(self, records):
+        """ Insert many Person API results into the database at once
+
+        @param records: Iterable of (email, record) tuples
+        @return: int, number of records queued
+        """
+        count = 0
+        for email, record in records:
+            self.insert_user_record(email, record)
+            count += 1
+        return count
+
+    def iter_archive(self, latest_only=True):
+        """ Stream the archived responses, grouped by email
+
+        @param latest_only: Only return the most recent response for each email
+        @return: generator of (email, create_dt, compressed body) tuples
+        """
+        self._archive_buffer.flush()
+
+        previous = None
+        for doc in self.archive.find({}, {'_id': False, 'request_id': False}).sort([('email', 1), ('_id', 1)]):
+            entry = (doc['email'], doc['create_dt'], doc['body'])
+            if latest_only and previous is not None and previous[0] != entry[0]:
+                yield previous
+            elif not latest_only:
+                yield entry
+            previous = entry
+        if latest_only and previous is not None:
+            yield previous
+
+    def upsert_user_record(self, email, record):
+        """ Insert a Person API result, or replace the stored document for the email
+
+        The document keeps its _id, so its creation time stays the time the
+        user was first stored.
+
+        @param email: Email of the user
+        @param record: User record returned by FullContact
+        @return: None
+        """
+        from pymongo import ReplaceOne
+
+        self._archive_record(email, record)
         record['email'] = email
-        self.db.insert_one(record)
+        record['update_dt'] = datetime.datetime.now()
+        self._user_buffer.add(ReplaceOne({'email': email}, record, upsert=True))
+
+    def upsert_user_records(self, records):
+        """ Insert or replace many Person API results at once
+
+        @param records: Iterable of (email, record) tuples
+        @return: int, number of records queued
+        """
+        count = 0
+        for email, record in records:
+            self.upsert_user_record(email, record)
+            count += 1
+        return count
+
+    def count_users(self):
+        """ Return the number of users in the database
+
+        @return: int
+        """
+        self._user_buffer.flush()
+        return self.users.count()
+
+    def iter_known_emails(self):
+        """ Stream the email of every user in the database
+
+        @return: generator of emails
+        """
+        self._user_buffer.flush()
+        return (doc['email'] for doc in self.users.find({}, {'email': True, '_id': False}))
+
+    def user_exists(self, email):
+        """ Check whether a user with this email is already in the database
+
+        @param email: Email to look for
+        @return: bool
+        """
+        self._user_buffer.flush()
+        return self.users.find_one({'email': email}, {'_id': True}) is not None
 
     def log_failure(self, email, failure_response):
         """ Log a failure response in the database
@@ -42,5 +328,180 @@ class MongoDbConnector(AbstractDatabaseConnector):
         @param failure_response: Failure response returned by FullContact
         @return: None
         """
-        failure_response['email'] = email
-        self.db.insert_one(failure_response)
+        from pymongo import InsertOne
+
+        self._failure_buffer.add(InsertOne({
+            'email': email,
+            'initial_status': failure_response.status,
+            'message': failure_response.get('message'),
+            'request_id': failure_response.get('requestId'),
+            'create_dt': datetime.datetime.now(),
+            'most_recent_retry_dt': None,
+            'most_recent_retry_status': None,
+            'retry_count': 0,
+            'retry_complete': self.retry_policy.is_complete(failure_response.status),
+            'next_attempt_dt': self.retry_policy.next_attempt(failure_response.status),
+        }))
+
+    def log_failures(self, failures):
+        """ Log many failure responses in the database at once
+
+        @param failures: Iterable of (email, failure_response) tuples
+        @return: None
+        """
+        for email, failure_response in failures:
+            self.log_failure(email, failure_response)
+
+    def fetch_retry_queue(self, limit=None, after_id=None, due_only=True):
+        """ Return failures that still need to be retried, in insertion order
+
+        @param limit: Maximum number of failures to return
+        @param after_id: Only return failures after this failure_log_id
+        @param due_only: Only return failures whose next attempt is due
+        @return: list of dicts
+        """
+        self._failure_buffer.flush()
+
+        query = self._retry_queue_query(due_only)
+        if after_id is not None:
+            query['_id'] = {'$gt': after_id}
+
+        cursor = self.failures.find(query).sort('_id')
+        if limit:
+            cursor = cursor.limit(limit)
+
+        rows = []
+        for doc in cursor:
+            doc['failure_log_id'] = doc.pop('_id')
+            rows.append(doc)
+        return rows
+
+    def count_retry_queue(self, due_only=True):
+        """ Return the number of failures that still need to be retried
+
+        @param due_only: Only count failures whose next attempt is due
+        @return: int
+        """
+        self._failure_buffer.flush()
+        return self.failures.find(self._retry_queue_query(due_only)).count()
+
+    def _retry_queue_query(self, due_only):
+        query = {
+            'initial_status': {'$in': self.retry_policy.retried_statuses},
+            'retry_complete': False
+        }
+        if due_only:
+            query['$or'] = [
+                {'next_attempt_dt': {'$lte': datetime.datetime.now()}},
+                {'next_attempt_dt': None}
+            ]
+        return query
+
+    def iter_retry_queue(self, page_size=500, due_only=True):
+        """ Page through the failures that still need to be retried
+
+        @param page_size: Number of failures per page
+        @param due_only: Only return failures whose next attempt is due
+        @return: generator of lists of dicts
+        """
+        after_id = None
+        while True:
+            page = self.fetch_retry_queue(limit=page_size, after_id=after_id, due_only=due_only)
+            if not page:
+                return
+            yield page
+            after_id = page[-1]['failure_log_id']
+
+    def update_retry_row(self, current_row_obj, new_result):
+        """ Record the result of retrying a failed lookup
+
+        @param current_row_obj: Row returned by fetch_retry_queue
+        @param new_result: Response from the FullContact API
+        @return: None
+        """
+        self.update_retry_rows([(current_row_obj, new_result)])
+
+    def update_retry_rows(self, results):
+        """ Record the results of retrying many failed lookups with one bulk write
+
+        @param results: Iterable of (row, response) tuples, where row was returned by fetch_retry_queue
+        @return: None
+        """
+        from pymongo import UpdateOne
+
+        now = datetime.datetime.now()
+        for row, new_result in results:
+            retry_count = row['retry_count'] + 1
+            self._failure_buffer.add(UpdateOne({'_id': row['failure_log_id']}, {'$set': {
+                'most_recent_retry_status': new_result.status,
+                'retry_count': retry_count,
+                'retry_complete': self.retry_policy.is_complete(new_result.status, retry_count),
+                'most_recent_retry_dt': now,
+                'next_attempt_dt': self.retry_policy.next_attempt(new_result.status, retry_count, now)
+            }}))
+        self._failure_buffer.flush()
+
+    def iter_failures(self, include_completed=False, batch_size=1000):
+        """ Stream the failures in insertion order, a batch at a time
+
+        @param include_completed: Whether to include completed retries
+        @param batch_size: Number of documents per batch
+        @return: generator of lists of tuples in the order of FAILURE_COLUMNS
+        """
+        self._failure_buffer.flush()
+        query = {} if include_completed else {'retry_complete': False}
+        names = [name for name, _ in FAILURE_COLUMNS]
+
+        rows = []
+        for doc in self.failures.find(query).sort('_id').batch_size(batch_size):
+            doc['failure_log_id'] = doc.pop('_id')
+            rows.append(tuple(doc.get(column) for column in names))
+            if len(rows) == batch_size:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+
+    def dump_failures(self, outf_path, include_completed=False, batch_size=1000, fmt=None):
+        """ Export failures to the specified location
+
+        @param outf_path: Path of output file, in any format dump_user_data writes
+        @param include_completed: Whether to include completed retries
+        @param batch_size: Number of documents fetched from the server and written at once
+        @param fmt: Export format, overriding the extension
+        @return: int, number of rows written
+        """
+        return export_batches(outf_path, FAILURE_COLUMNS, self.iter_failures(include_completed, batch_size), fmt)
+
+    def iter_user_flat(self, batch_size=1000):
+        """ Stream one flattened row per user, a batch at a time
+
+        The stored responses are flattened into the same columns as the sqlite
+        user_flat table while streaming through the collection.
+
+        @param batch_size: Number of documents per batch
+        @return: generator of lists of tuples in the order of USER_COLUMNS
+        """
+        self._user_buffer.flush()
+
+        rows = []
+        for doc in self.users.find().sort('_id').batch_size(batch_size):
+            _, child_rows = parse_record(doc['email'], doc)
+            flat_row = [table_rows[0] for model, _, table_rows in child_rows if model is UserFlat][0]
+            # the document id stands in for the user_id, and records when it was stored (in UTC)
+            rows.append((doc['_id'],) + flat_row[:-1] + (doc['_id'].generation_time.replace(tzinfo=None),))
+            if len(rows) == batch_size:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+
+    def dump_user_data(self, outf_path, batch_size=1000, fmt=None):
+        """ Export one row per user to the specified location
+
+        @param outf_path: Path of output file, in any format SqliteConnector.dump_user_data writes
+        @param batch_size: Number of documents fetched from the server and written at once
+        @param fmt: Export format, overriding the extension
+        @return: int, number of rows written
+        """
+        return export_batches(outf_path, USER_COLUMNS, self.iter_user_flat(batch_size), fmt)
@@ -0,0 +1,90 @@
+import collections
+
+from models import *
+
+# columns that record when a row was written rather than what the response said
+STAMP_COLUMNS = ('create_dt', 'update_dt', 'scraped_on')
+
+# columns identifying a row among the rows of the same user; tables keyed by ()
+# hold one row per user
+NATURAL_KEYS = {
+    User: (),
+    UserAddress: (),
+    UserDemography: (),
+    UserFlat: (),
+    UserProfile: ('profile_type', 'network_id', 'profile_url'),
+    UserTopic: ('provider', 'topic'),
+    UserOrganization: ('organization_name', 'title', 'start_date'),
+    UserModelScore: ('provider', 'type'),
+}
+
+_NUMERIC = ('int', 'bool', 'decimal', 'float', 'double', 'primary_key')
+
+
+def _numeric(value):
+    # sqlite stores numeric-looking text in a numeric column as a number
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, basestring):
+        for convert in (int, float):
+            try:
+                return convert(value)
+            except ValueError:
+                pass
+    return value
+
+
+def _text(value):
+    # and stores numbers in a text column as text
+    if value is None or isinstance(value, basestring):
+        return value
+    if isinstance(value, bool):
+        value = int(value)
+    return unicode(value)
+
+
+def row_normalizer(model, columns):
+    """ Build a function that puts a row in the form sqlite hands it back
+
+    Parsed rows hold values as they came in the response, e.g. True for a
+    boolean or '25' for an integer; once stored, these read back as 1 and 25.
+    Normalizing both sides makes stored and parsed rows comparable.
+
+    @param model: Model the row belongs to
+    @param columns: Names of the columns, in the order of the values in the row
+    @return: function taking a row tuple and returning a tuple
+    """
+    fields = dict((field.db_column, field) for field in model._meta.get_fields())
+    converts = [_numeric if fields[column].get_db_field() in _NUMERIC else _text for column in columns]
+    return lambda row: tuple(convert(value) for convert, value in zip(converts, row))
+
+
+def diff_rows(stored, parsed, key):
+    """ Match a user's parsed rows against its stored rows by natural key
+
+    Rows with the same key are paired in order, so a key that appears twice is
+    matched twice rather than collapsed.
+
+    @param stored: List of (primary key, normalized row) tuples read from the database
+    @param parsed: List of normalized rows from the new response
+    @param key: Indexes of the natural key columns within a row
+    @return: tuple of (list of (primary key, index into parsed) to update,
+        list of indexes into parsed to insert, list of primary keys to delete)
+    """
+    by_key = collections.defaultdict(collections.deque)
+    for pk, row in stored:
+        by_key[tuple(row[i] for i in key)].append((pk, row))
+
+    updates = []
+    inserts = []
+    for index, row in enumerate(parsed):
+        matches = by_key.get(tuple(row[i] for i in key))
+        if not matches:
+            inserts.append(index)
+            continue
+        pk, old = matches.popleft()
+        if old != row:
+            updates.append((pk, index))
+
+    deletes = [pk for matches in by_key.values() for pk, _ in matches]
+    return updates, inserts, deletes
@@ -0,0 +1,289 @@
+import datetime
+from collections import OrderedDict
+
+from models import *
+
+
+class Column(object):
+    """ One column of a table mapping: where its value comes from in the response """
+
+    def __init__(self, name, path=None, default=None, convert=None, value=None):
+        """ Describe a mapped column
+
+        @param name: Name of the model field
+        @param path: Tuple of keys leading to the value, relative to the response
+            or, for repeated tables, to the item. None for a constant column.
+        @param default: Value used when the path is missing
+        @param convert: Function applied to the value found (or the default)
+        @param value: Constant value of a column without a path
+        @return: None
+        """
+        self.name = name
+        self.path = tuple(path) if path is not None else None
+        self.default = default
+        self.convert = convert
+        self.value = value
+
+
+def compile_accessor(columns):
+    """ Compile columns into one function that pulls a row tuple out of a response
+
+    The function is generated as Python source, so each response is walked
+    with plain dict lookups: every intermediate object along the paths is
+    fetched once and shared by all the columns below it, and a missing or
+    non-dict node short-circuits to the column default instead of raising.
+
+    @param columns: List of Columns
+    @return: function taking a dict and returning a tuple
+    """
+    env = {'_dict': dict}
+    lines = []
+    nodes = {(): 'node'}
+    values = []
+
+    def node_var(prefix):
+        if prefix not in nodes:
+            parent = node_var(prefix[:-1])
+            var = 'n{}'.format(len(nodes))
+            lines.append('    {var} = {p}.get({key!r}) if isinstance({p}, _dict) else None'.format(var=var, p=parent, key=prefix[-1]))
+            nodes[prefix] = var
+        return nodes[prefix]
+
+    for i, column in enumerate(columns):
+        if column.path is None:
+            env['c{}'.format(i)] = column.value
+            expr = 'c{}'.format(i)
+        else:
+            parent = node_var(column.path[:-1])
+            env['d{}'.format(i)] = column.default
+            expr = '({p}.get({key!r}, d{i}) if isinstance({p}, _dict) else d{i})'.format(p=parent, key=column.path[-1], i=i)
+
+        if column.convert is not None:
+            env['f{}'.format(i)] = column.convert
+            expr = 'f{}({})'.format(i, expr)
+        values.append(expr)
+
+    source = 'def accessor(node):\n{}\n    return ({},)\n'.format('\n'.join(lines) or '    pass', ', '.join(values))
+    exec compile(source, '<record mapping>', 'exec') in env
+    return env['accessor']
+
+
+class TableMapping(object):
+    """
+    Declarative mapping from a FullContact response onto rows of one table.
+
+    A mapping without `each` produces one row per response. With `each`, it
+    produces a row for every item of a list in the response, and column paths
+    are relative to the item. `each` is either the path of the list or a
+    function returning the items.
+    """
+
+    def __init__(self, model, columns, each=None):
+        self.model = model
+        self.columns = columns
+        self.db_columns = tuple(model._meta.fields[column.name].db_column for column in columns)
+        self.each = each
+        self._row = compile_accessor(columns)
+
+        if each is None or callable(each):
+            self._items = each
+        else:
+            items = compile_accessor([Column('items', each)])
+            self._items = lambda record: items(record)[0]
+
+    def rows(self, record):
+        """ Map a response onto rows
+
+        @param record: Response returned by FullContact
+        @return: list of tuples, in the order of the mapping's columns
+        """
+        if self._items is None:
+            return [self._row(record)]
+
+        items = self._items(record)
+        if not isinstance(items, (list, tuple)):
+            return []
+        row = self._row
+        return [row(item) for item in items if isinstance(item, dict)]
+
+
+def _range_bound(index):
+    def bound(age_range):
+        if not age_range:
+            return None
+        return age_range.split('-')[index]
+    return bound
+
+
+def _social_profiles(record):
+    # socialProfiles is a dict of lists keyed by network with style=dictionary, and a flat list otherwise
+    profiles = record.get('socialProfiles')
+    if isinstance(profiles, dict):
+        return [profile for network in profiles.values() if isinstance(network, list) for profile in network]
+    return profiles
+
+
+def _location(*keys):
+    return ('demographics', 'locationDeduced') + keys
+
+
+USER_MAPPING = TableMapping(User, [
+    Column('first_name', ('contactInfo', 'givenName')),
+    Column('last_name', ('contactInfo', 'familyName')),
+    Column('match_likelihood', ('likelihood',)),
+])
+
+CHILD_MAPPINGS = [
+    TableMapping(UserAddress, [
+        Column('location_general', ('demographics', 'locationGeneral')),
+        Column('city_name', _location('city', 'name')),
+        Column('city_is_deduced', _location('city', 'deduced')),
+        Column('county_name', _location('county', 'name')),
+        Column('county_is_deduced', _location('county', 'deduced')),
+        Column('state_name', _location('state', 'name')),
+        Column('state_code', _location('state', 'code')),
+        Column('state_is_deduced', _location('state', 'deduced')),
+        Column('country_name', _location('country', 'name')),
+        Column('country_code', _location('country', 'code')),
+        Column('country_is_deduced', _location('country', 'deduced')),
+        Column('continent_name', _location('continent', 'name')),
+        Column('continent_is_deduced', _location('continent', 'deduced')),
+        Column('address_likelihood', _location('likelihood')),
+    ]),
+    TableMapping(UserDemography, [
+        Column('gender', ('demographics', 'gender')),
+        Column('age', ('demographics', 'age')),
+        Column('age_range_min', ('demographics', 'ageRange'), convert=_range_bound(0)),
+        Column('age_range_max', ('demographics', 'ageRange'), convert=_range_bound(1)),
+    ]),
+    TableMapping(UserOrganization, [
+        Column('organization_name', ('name',), default=''),
+        Column('title', ('title',), default=''),
+        Column('start_date', ('startDate',)),
+        Column('end_date', ('endDate',)),
+        Column('is_current', ('current',), default=0),
+        Column('is_primary', ('isPrimary',), default=0),
+    ], each=('organizations',)),
+    TableMapping(UserTopic, [
+        Column('provider', ('provider',), default=''),
+        Column('topic', ('value',), default=''),
+    ], each=('digitalFootprint', 'topics', 'klout')),
+    TableMapping(UserModelScore, [
+        Column('provider', ('provider',), default=''),
+        Column('type', ('type',), default=''),
+        Column('score_value', ('value',)),
+    ], each=('digitalFootprint', 'scores', 'klout')),
+    # websites and social profiles share a table and a column list, so both go
+    # out in the same multi-row insert
+    TableMapping(UserProfile, [
+        Column('profile_type', value='website'),
+        Column('network_id', value='website'),
+        Column('network_name', value='website'),
+        Column('profile_id', value=None),
+        Column('profile_url', ('url',)),
+        Column('user_name', value=None),
+        Column('user_bio', value=None),
+        Column('followers', value=None),
+        Column('following', value=None),
+        Column('user_feed', value=None),
+    ], each=('contactInfo', 'websites')),
+    TableMapping(UserProfile, [
+        Column('profile_type', value='social'),
+        Column('network_id', ('typeId',), default=''),
+        Column('network_name', ('typeName',)),
+        Column('profile_id', ('id',), default=''),
+        Column('profile_url', ('url',), default=''),
+        Column('user_name', ('username',), default=''),
+        Column('user_bio', ('bio',), default=''),
+        Column('followers', ('followers',), default=0),
+        Column('following', ('following',), default=0),
+        Column('user_feed', ('rss',), default=''),
+    ], each=_social_profiles),
+]
+
+# columns of the row tuples returned by parse_record; the user_id column that
+# links child rows to their user is not included
+USER_COLUMNS = ('email',) + USER_MAPPING.db_columns + ('create_dt',)
+# every model parse_record writes rows for, children before their user
+PARSED_MODELS = list(OrderedDict.fromkeys([m.model for m in CHILD_MAPPINGS] + [UserFlat, User]))
+FLAT_COLUMNS = tuple(field.db_column for field in UserFlat._meta.get_fields() if field.name != 'user')
+
+
+def _index(model):
+    # position of every column in the rows a model's mapping produces
+    mapping = [m for m in [USER_MAPPING] + CHILD_MAPPINGS if m.model is model][0]
+    return dict((column, i) for i, column in enumerate(mapping.db_columns))
+
+_USER, _ADDRESS, _DEMOGRAPHY, _SCORE, _PROFILE = [
+    _index(model) for model in (User, UserAddress, UserDemography, UserModelScore, UserProfile)
+]
+_NO_PROFILE = (None,) * len(_PROFILE)
+
+
+def _flat_row(email, user, address, demography, scores, profiles, now):
+    # the export row takes the first score and the first profile on each network
+    networks = {}
+    for profile in profiles:
+        networks.setdefault(profile[_PROFILE['network_name']], profile)
+    facebook = networks.get('Facebook', _NO_PROFILE)
+    twitter = networks.get('Twitter', _NO_PROFILE)
+    website = networks.get('website', _NO_PROFILE)
+
+    return (
+        user[_USER['first_name']],
+        user[_USER['last_name']],
+        email,
+        address[_ADDRESS['location_general']],
+        demography[_DEMOGRAPHY['age']],
+        demography[_DEMOGRAPHY['age_range_min']],
+        demography[_DEMOGRAPHY['age_range_max']],
+        scores[0][_SCORE['score_value']] if scores else None,
+        facebook[_PROFILE['profile_id']],
+        facebook[_PROFILE['user_name']],
+        facebook[_PROFILE['profile_url']],
+        twitter[_PROFILE['profile_id']],
+        twitter[_PROFILE['user_name']],
+        twitter[_PROFILE['followers']],
+        twitter[_PROFILE['following']],
+        website[_PROFILE['profile_url']],
+        now
+    )
+
+
+def parse_record(email, record, now=None):
+    """ Map a FullContact response onto rows for each table, in one pass over the response
+
+    @param email: Email that was searched
+    @param record: Response returned by FullContact
+    @param now: Creation time given to the rows. Defaults to the current time.
+    @return: tuple of the user row and a list of (model, columns, rows) for the
+        child tables. Rows are tuples in the order of USER_COLUMNS and of the
+        columns given for their table.
+    """
+    now = now or datetime.datetime.now()
+    user = USER_MAPPING.rows(record)[0]
+
+    tables = []
+    rows_by_model = {}
+    for mapping in CHILD_MAPPINGS:
+        rows = mapping.rows(record)
+        if mapping.model in rows_by_model:
+            rows_by_model[mapping.model].extend(rows)
+        else:
+            rows_by_model[mapping.model] = rows
+            tables.append((mapping.model, mapping.db_columns + ('create_dt',), rows))
+
+    flat = _flat_row(
+        email, user,
+        rows_by_model[UserAddress][0],
+        rows_by_model[UserDemography][0],
+        rows_by_model[UserModelScore],
+        rows_by_model[UserProfile],
+        now
+    )
+
+    for _, _, rows in tables:
+        rows[:] = [row + (now,) for row in rows]
+    tables.append((UserFlat, FLAT_COLUMNS, [flat]))
+
+    return (email,) + user + (now,), tables
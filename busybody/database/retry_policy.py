@@ -0,0 +1,75 @@
+import datetime
+import random
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with jitter for failed FullContact lookups.
+
+    Each retryable status has its own base delay: a 202 means FullContact is
+    still gathering data and needs a few minutes, a 403 means the rate limit
+    window has to reset, and a 500 is given more room to recover. A 503 is a
+    lookup that timed out or couldn't connect. A 400 or 422 rarely turns into
+    a match, so those are only tried again hourly. Statuses without a delay
+    are not retried at all, so every open failure is always scheduled. Every
+    further attempt doubles the delay, up to `max_delay`, and the delay is
+    randomly spread by +/- `jitter` so retries of a large batch don't all fall
+    due at the same moment. After `max_retries` attempts a failure is given up
+    on.
+    """
+
+    # seconds to wait before the first retry, for each status that is retried
+    base_delays = {
+        202: 5 * 60,
+        403: 60,
+        500: 10 * 60,
+        503: 5 * 60,
+        400: 60 * 60,
+        422: 60 * 60
+    }
+
+    def __init__(self, base_delays=None, factor=2, max_delay=24 * 3600, jitter=0.25, max_retries=10):
+        """ Configure the backoff schedule.
+
+        @param base_delays: dict of status code to delay in seconds before the
+            first retry, overriding the defaults
+        @param factor: Multiplier applied to the delay after every attempt
+        @param max_delay: Longest delay in seconds between two attempts
+        @param jitter: Fraction by which delays are randomly spread
+        @param max_retries: Number of retries after which a failure is abandoned
+        @return: None
+        """
+        self.base_delays = dict(self.base_delays, **(base_delays or {}))
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.max_retries = max_retries
+
+    @property
+    def retried_statuses(self):
+        """ @return: sorted list of the initial statuses whose failures are retried """
+        return sorted(self.base_delays)
+
+    def is_complete(self, status, retry_count=0):
+        """ Whether a failure needs no further attempts
+
+        @param status: Most recent status returned for the email
+        @param retry_count: Number of retries made so far
+        @return: bool
+        """
+        return status not in self.base_delays or retry_count >= self.max_retries
+
+    def next_attempt(self, status, retry_count=0, now=None):
+        """ When to retry a lookup next
+
+        @param status: Most recent status returned for the email
+        @param retry_count: Number of retries made so far
+        @param now: Time of the most recent attempt, defaults to now
+        @return: datetime, or None if the lookup should not be retried
+        """
+        if self.is_complete(status, retry_count):
+            return None
+
+        delay = min(self.max_delay, self.base_delays[status] * self.factor ** retry_count)
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return (now or datetime.datetime.now()) + datetime.timedelta(seconds=delay)
@@ -0,0 +1,170 @@
+import hashlib
+import logging
+import os
+
+from ..utils import Colors
+from models import *
+from sqlite_db import SqliteConnector
+
+logger = logging.getLogger(__name__)
+
+
+def shard_for(email, shards):
+    """ Pick the shard an email belongs to
+
+    The hash is stable across processes and runs, so an email always lands in
+    the same shard for a given number of shards.
+
+    @param email: Email to place
+    @param shards: Number of shards
+    @return: int between 0 and shards - 1
+    """
+    digest = hashlib.md5(email.strip().lower().encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) % shards
+
+
+def shard_paths(directory, shards, prefix='shard'):
+    """ Paths of the sqlite files of a set of shards
+
+    @param directory: Directory holding the shards
+    @param shards: Number of shards
+    @param prefix: File name prefix
+    @return: list of paths
+    """
+    return [os.path.join(directory, '{}-{:03d}.sqlite'.format(prefix, i)) for i in range(shards)]
+
+
+def _table_columns(model):
+    return [field.db_column for field in model._meta.get_fields()]
+
+
+def merge_shards(target_path, paths, profile='bulk-load', defer_indexes=False):
+    """ Combine shard databases into one database
+
+    Each shard is attached to the target and copied table by table with
+    INSERT ... SELECT, entirely inside sqlite. Primary keys are remapped by
+    offsetting them past the largest key already in the target, and user_id
+    references are offset the same way, so rows keep pointing at their user.
+    Users whose email is already in the target are skipped with their rows,
+    and so are failures logged there before, so merging a shard twice adds
+    nothing the second time.
+
+    The models are bound to the target only while merging; afterwards they
+    point at whatever database they were bound to before the call.
+
+    @param target_path: Path of the database to merge into; created if needed
+    @param paths: Paths of the shard databases
+    @param profile: Sqlite profile used for the target while merging
+    @param defer_indexes: Drop the target's secondary indexes while merging and
+        rebuild them once every shard is in; worth it when the shards hold
+        more rows than the target
+    @return: dict with the number of users and failures merged
+    """
+    # opening the connector binds every model to the target
+    previous = db_proxy.obj
+    db = SqliteConnector(target_path, profile=profile)
+    try:
+        db.client.create_tables(MODELS, safe=True)
+        if defer_indexes:
+            with db.deferred_indexes():
+                return _merge_paths(db, paths)
+        return _merge_paths(db, paths)
+    finally:
+        db.client.close()
+        db_proxy.initialize(previous)
+
+
+def _merge_paths(db, paths):
+    execute = db.client.execute_sql
+    merged = {'users': 0, 'failures': 0}
+    for path in paths:
+        if not os.path.exists(path):
+            logger.warn(Colors.WARNING + 'Skipping missing shard {}'.format(path) + Colors.ENDC)
+            continue
+
+        logger.info('Merging shard {}'.format(path))
+        # ATTACH is not allowed inside a transaction
+        execute('ATTACH DATABASE ? AS shard', (path,))
+        try:
+            with db.client.atomic():
+                counts = _merge_attached(execute)
+        finally:
+            execute('DETACH DATABASE shard')
+
+        logger.info(Colors.OKGREEN + '  Merged {users} users and {failures} failures'.format(**counts) + Colors.ENDC)
+        for key in merged:
+            merged[key] += counts[key]
+
+    return merged
+
+
+def _merge_attached(execute):
+    def scalar(sql, params=()):
+        return execute(sql, params).fetchone()[0]
+
+    # users that are already in the target, e.g. from an earlier merge of the same shard
+    execute('DROP TABLE IF EXISTS temp.merge_skipped')
+    execute(
+        'CREATE TEMP TABLE merge_skipped AS '
+        'SELECT s.user_id FROM shard."user" s JOIN main."user" m ON m.email = s.email'
+    )
+
+    # failures belong to no user; one logged for the same lookup at the same moment was merged before.
+    # request ids are often missing from failures, and NULL never equals NULL, so they are compared with IS
+    execute('DROP TABLE IF EXISTS temp.merge_skipped_failures')
+    execute(
+        'CREATE TEMP TABLE merge_skipped_failures AS '
+        'SELECT s.failure_log_id FROM shard.failure_log s JOIN main.failure_log m '
+        'ON m.email = s.email AND m.request_id IS s.request_id AND m.create_dt = s.create_dt'
+    )
+
+    # archived responses are keyed by email and request id, but the unique index never matches a
+    # missing request id, so those are told apart by when they were stored
+    execute('DROP TABLE IF EXISTS temp.merge_skipped_responses')
+    execute(
+        'CREATE TEMP TABLE merge_skipped_responses AS '
+        'SELECT s.raw_response_id FROM shard.raw_response s JOIN main.raw_response m '
+        'ON m.email = s.email AND m.request_id IS s.request_id '
+        'AND (s.request_id IS NOT NULL OR m.create_dt = s.create_dt)'
+    )
+
+    user_offset = scalar('SELECT COALESCE(MAX(user_id), 0) FROM main."user"')
+    counts = {
+        'users': scalar('SELECT COUNT(*) FROM shard."user"') - scalar('SELECT COUNT(*) FROM temp.merge_skipped'),
+        'failures': scalar('SELECT COUNT(*) FROM shard.failure_log') - scalar('SELECT COUNT(*) FROM temp.merge_skipped_failures')
+    }
+
+    for model in MODELS:
+        table = model._meta.db_table
+        pk = model._meta.primary_key.db_column
+        columns = _table_columns(model)
+
+        select = []
+        for column in columns:
+            if column == 'user_id':
+                select.append('user_id + {}'.format(user_offset))
+            elif column == pk:
+                offset = scalar('SELECT COALESCE(MAX("{}"), 0) FROM main."{}"'.format(pk, table))
+                select.append('"{}" + {}'.format(pk, offset))
+            else:
+                select.append('"{}"'.format(column))
+
+        where = ''
+        if 'user_id' in columns:
+            where = ' WHERE user_id NOT IN (SELECT user_id FROM temp.merge_skipped)'
+        elif model is FailureLog:
+            where = ' WHERE failure_log_id NOT IN (SELECT failure_log_id FROM temp.merge_skipped_failures)'
+        elif model is RawResponse:
+            where = ' WHERE raw_response_id NOT IN (SELECT raw_response_id FROM temp.merge_skipped_responses)'
+
+        execute('INSERT INTO main."{table}" ({columns}) SELECT {select} FROM shard."{table}"{where}'.format(
+            table=table,
+            columns=', '.join('"{}"'.format(c) for c in columns),
+            select=', '.join(select),
+            where=where
+        ))
+
+    execute('DROP TABLE temp.merge_skipped')
+    execute('DROP TABLE temp.merge_skipped_failures')
+    execute('DROP TABLE temp.merge_skipped_responses')
+    return counts
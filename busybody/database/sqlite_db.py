@@ -1,27 +1,63 @@
+import contextlib
 import logging
-from playhouse.csv_loader import dump_csv
+import sqlite3
+from collections import OrderedDict
+from playhouse.migrate import SqliteMigrator, migrate
 from playhouse.shortcuts import model_to_dict
 
+from archive import archive_row, parse_archive
 from db_interface import AbstractDatabaseConnector
 from models import *
-from ..utils import SeekableDict, Colors
+from reconcile import diff_rows, row_normalizer, NATURAL_KEYS, STAMP_COLUMNS
+from record_parser import parse_record, PARSED_MODELS, USER_COLUMNS
+from retry_policy import RetryPolicy
+from sqlite_profiles import ProfiledSqliteDatabase
+from ..utils import Colors, chunked
+from ..utils.exporters import export_batches, model_columns
+from ..utils.metrics import DB_WRITE_LATENCY, PARSE_LATENCY, ROWS_WRITTEN
 
 logger = logging.getLogger(__name__)
 
+# sqlite refuses statements with more bound parameters than this
+SQLITE_MAX_VARIABLES = 999
+
+ARCHIVE_COLUMNS = ('email', 'request_id', 'status', 'body', 'create_dt')
+
+
+def _declared_indexes(model):
+    """ List the indexes a model declares, on single fields and in Meta.indexes
+
+    @param model: Model to list the indexes of
+    @return: list of (list of fields, unique) tuples
+    """
+    declared = [([field], field.unique) for field in model._fields_to_index()]
+    declared.extend(
+        ([model._meta.fields[name] for name in names], unique)
+        for names, unique in model._meta.indexes
+    )
+    return declared
+
 
 class SqliteConnector(AbstractDatabaseConnector):
 
-    def __init__(self, connection_string):
+    def __init__(self, connection_string, retry_policy=None, profile='safe', archive_responses=True):
         """ Set up a Sqlite database connection.
 
         @param connection_string: Name of Sqlite database to connect to
+        @param retry_policy: RetryPolicy used to schedule failed lookups
+        @param profile: Name of the sqlite performance profile applied to every
+            connection, one of 'safe', 'concurrent' or 'bulk-load'
+        @param archive_responses: Keep every response compressed in the raw_response
+            table, so the other tables can be rebuilt with reparse_archive
         @return: None
         """
-        self.client = SqliteDatabase(connection_string, threadlocals=True)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.archive_responses = archive_responses
+        self.client = ProfiledSqliteDatabase(connection_string, profile=profile, threadlocals=True)
         db_proxy.initialize(self.client)
 
         # explicitly check that the connection is ok
-        logger.debug('Connecting to sqlite database {}'.format(connection_string))
+        logger.debug('Connecting to sqlite database {} with the {} profile'.format(connection_string, profile))
         try:
             self.client.connect()
         except Exception, e:
@@ -29,6 +65,125 @@ class SqliteConnector(AbstractDatabaseConnector):
             logger.error(Colors.FAIL + str(e) + Colors.ENDC)
             raise
 
+    def upgrade_schema(self):
+        """ Add the columns and indexes introduced since an existing database was created
+
+        @return: None
+        """
+        migrator = SqliteMigrator(self.client)
+        tables = set(self.client.get_tables())
+
+        for model in MODELS:
+            table = model._meta.db_table
+            if table not in tables:
+                logger.info('Creating table {}'.format(table))
+                model.create_table()
+                if model is UserFlat:
+                    self.rebuild_user_flat()
+                continue
+
+            columns = dict((c.name, c) for c in self.client.get_columns(table))
+            for field in model._meta.get_fields():
+                if field.db_column not in columns:
+                    logger.info('Adding column {}.{}'.format(table, field.db_column))
+                    migrate(migrator.add_column(table, field.db_column, field))
+                elif field.null and not columns[field.db_column].null:
+                    logger.info('Allowing NULL in {}.{}'.format(table, field.db_column))
+                    migrate(migrator.drop_not_null(table, field.db_column))
+
+            self._create_missing_indexes(model)
+
+    def _create_missing_indexes(self, model):
+        """ Create the indexes a model declares that are not in the database
+
+        @param model: Model whose table to index
+        @return: int, number of indexes created
+        """
+        compiler = self.client.compiler()
+        table = model._meta.db_table
+        indexes = set(self._index_names(table))
+
+        created = 0
+        for fields, unique in _declared_indexes(model):
+            if compiler.index_name(table, [f.db_column for f in fields]) not in indexes:
+                logger.info('Adding index on {}({})'.format(table, ', '.join(f.db_column for f in fields)))
+                self.client.create_index(model, fields, unique)
+                created += 1
+        return created
+
+    def drop_secondary_indexes(self):
+        """ Drop the indexes that only speed up queries, ahead of a large load
+
+        Every row inserted has to be added to every index of its table, and on a
+        first-time load that upkeep costs more than the rows themselves. Unique
+        indexes stay, so a repeated email is still refused, and so do the
+        user_id indexes, which inserts and refreshes read through to find a
+        user's rows. Everything else is dropped until rebuild_secondary_indexes
+        puts it back.
+
+        @return: int, number of indexes dropped
+        """
+        compiler = self.client.compiler()
+        dropped = 0
+        with self.client.atomic():
+            for model in MODELS:
+                table = model._meta.db_table
+                indexes = set(self._index_names(table))
+                for fields, unique in _declared_indexes(model):
+                    name = compiler.index_name(table, [f.db_column for f in fields])
+                    if unique or any(isinstance(f, ForeignKeyField) for f in fields) or name not in indexes:
+                        continue
+                    self.client.execute_sql('DROP INDEX "{}"'.format(name))
+                    dropped += 1
+
+        logger.info('Dropped {} secondary indexes for a bulk load'.format(dropped))
+        return dropped
+
+    def rebuild_secondary_indexes(self):
+        """ Create every declared index that is missing, e.g. after drop_secondary_indexes
+
+        Each index is built with one sorted pass over its table, which is far
+        cheaper than keeping it up to date row by row. Since the models say
+        which indexes should exist, this also finishes the job after a load
+        that was interrupted before its indexes came back.
+
+        @return: int, number of indexes created
+        """
+        with self.client.atomic():
+            created = sum(self._create_missing_indexes(model) for model in MODELS)
+        logger.info(Colors.OKGREEN + 'Rebuilt {} secondary indexes'.format(created) + Colors.ENDC)
+        return created
+
+    @contextlib.contextmanager
+    def deferred_indexes(self):
+        """ Drop the secondary indexes for the duration of a bulk load
+
+        with db.deferred_indexes():
+            for batch in batches:
+                db.insert_user_records(batch)
+
+        The indexes are rebuilt on the way out, even if the load fails, so the
+        database is always left fully indexed.
+
+        @return: context manager
+        """
+        self.drop_secondary_indexes()
+        try:
+            yield self
+        finally:
+            self.rebuild_secondary_indexes()
+
+    def _index_names(self, table):
+        """ Return the names of the indexes on a table
+
+        @param table: Name of the table
+        @return: list of index names
+        """
+        cursor = self.client.execute_sql(
+            'SELECT name FROM sqlite_master WHERE type = ? AND tbl_name = ?', ('index', table)
+        )
+        return [name for (name,) in cursor.fetchall()]
+
     def insert_user_record(self, email, record):
         """ Parse a user record returned by FullContact and insert it into the database
 
@@ -36,109 +191,495 @@ class SqliteConnector(AbstractDatabaseConnector):
         @param record: Response returned by FullContact
         @return: None
         """
-        record = SeekableDict(record)
+        now = datetime.datetime.now()
+        with PARSE_LATENCY.time():
+            user_row, child_rows = parse_record(email, record, now=now)
 
-        user_obj = User.create(
-            email=email,
-            first_name=record['contactInfo', 'givenName'],
-            last_name=record['contactInfo', 'familyName'],
-            match_likelihood=record['likelihood']
+        with self.client.atomic():
+            user_id = self._insert_rows(User, USER_COLUMNS, [user_row])
+            for model, columns, rows in child_rows:
+                self._insert_rows(model, ('user_id',) + columns, [(user_id,) + row for row in rows])
+            if self.archive_responses:
+                self._archive([archive_row(email, record)], now)
+
+    def insert_user_records(self, records):
+        """ Parse many user records returned by FullContact and insert them in a single transaction
+
+        Rows are written with one multi-row INSERT per table rather than one
+        statement per row. Emails that are already in the database, or that are
+        repeated within the batch, are skipped with a warning instead of
+        aborting the whole batch.
+
+        @param records: Iterable of (email, response) tuples
+        @return: int, number of users inserted
+        """
+        now = datetime.datetime.now()
+        parsed = OrderedDict()
+        archived = []
+        for email, record in records:
+            if self.archive_responses:
+                archived.append(archive_row(email, record))
+            if email in parsed:
+                logger.warn(Colors.WARNING + 'Skipping duplicate record for {} in batch'.format(email) + Colors.ENDC)
+                continue
+            with PARSE_LATENCY.time():
+                parsed[email] = parse_record(email, record, now=now)
+
+        if not parsed:
+            return 0
+
+        with self.client.atomic():
+            for email in self._fetch_user_ids(parsed.keys()):
+                logger.warn(Colors.WARNING + 'Skipping record for {}, user already exists'.format(email) + Colors.ENDC)
+                del parsed[email]
+
+            self._write_parsed(parsed)
+            self._archive(archived, now)
+
+        logger.debug('Inserted {} user records in one transaction'.format(len(parsed)))
+        return len(parsed)
+
+    def upsert_user_record(self, email, record):
+        """ Insert a user record, or bring a stored user up to date with a new response
+
+        @param email: Email that was searched
+        @param record: Response returned by FullContact
+        @return: dict with the number of users inserted, updated and unchanged
+        """
+        return self.upsert_user_records([(email, record)])
+
+    def upsert_user_records(self, records):
+        """ Insert new users and reconcile stored users with new responses, in a single transaction
+
+        The rows of a stored user are matched to the new response by natural
+        key (see reconcile.NATURAL_KEYS). Only rows whose values differ are
+        updated, rows that are new are inserted and rows that are gone are
+        deleted; update_dt is set on every row updated and on each user with
+        any change. Refreshing a user whose data did not change writes nothing
+        but the archived response.
+
+        @param records: Iterable of (email, response) tuples. The last response for an email wins.
+        @return: dict with the number of users inserted, updated and unchanged
+        """
+        now = datetime.datetime.now()
+        parsed = OrderedDict()
+        archived = []
+        for email, record in records:
+            if self.archive_responses:
+                archived.append(archive_row(email, record))
+            with PARSE_LATENCY.time():
+                parsed[email] = parse_record(email, record, now=now)
+
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        if not parsed:
+            return counts
+
+        with self.client.atomic():
+            user_ids = self._fetch_user_ids(parsed.keys())
+            new = OrderedDict((email, rows) for email, rows in parsed.items() if email not in user_ids)
+            if new:
+                self._write_parsed(new)
+
+            stored = [(user_ids[email], rows) for email, rows in parsed.items() if email in user_ids]
+            changed = self._reconcile(stored, now) if stored else set()
+            self._archive(archived, now)
+
+        counts['inserted'] = len(new)
+        counts['updated'] = len(changed)
+        counts['unchanged'] = len(stored) - len(changed)
+        logger.debug('Upserted {inserted} new, {updated} changed and {unchanged} unchanged users'.format(**counts))
+        return counts
+
+    def _reconcile(self, stored, now):
+        """ Write the difference between stored users and their newly parsed rows
+
+        @param stored: List of (user_id, (user row, child rows)) tuples
+        @param now: Time written to update_dt and to the create_dt of new rows
+        @return: set of the user_ids with any change
+        """
+        tables = OrderedDict()
+        for user_id, (user_row, child_rows) in stored:
+            tables.setdefault(User, (USER_COLUMNS, {}))[1][user_id] = [user_row]
+            for model, columns, rows in child_rows:
+                tables.setdefault(model, (columns, {}))[1][user_id] = rows
+
+        changed = set()
+        stamped = set()
+        for model, (columns, rows_by_user) in tables.items():
+            compared = [i for i, column in enumerate(columns) if column not in STAMP_COLUMNS]
+            compared_columns = [columns[i] for i in compared]
+            normalize = row_normalizer(model, compared_columns)
+            key = [compared_columns.index(column) for column in NATURAL_KEYS[model]]
+            existing = self._fetch_rows(model, compared_columns, rows_by_user.keys())
+
+            updates, inserts, deletes = [], [], []
+            for user_id, rows in rows_by_user.items():
+                values = [normalize([row[i] for i in compared]) for row in rows]
+                to_update, to_insert, to_delete = diff_rows(existing.get(user_id, []), values, key)
+                updates.extend((pk, values[index]) for pk, index in to_update)
+                inserts.extend((user_id,) + rows[index] for index in to_insert)
+                deletes.extend(to_delete)
+                if to_update or to_insert or to_delete:
+                    changed.add(user_id)
+
+            self._update_rows(model, compared_columns, updates, now)
+            if model is User:
+                stamped.update(pk for pk, _ in updates)
+            else:
+                self._insert_rows(model, ('user_id',) + columns, inserts)
+            self._delete_rows(model, deletes)
+
+        # flag users whose only changes were in their child rows
+        self._update_rows(User, (), [(user_id, ()) for user_id in changed - stamped], now)
+        return changed
+
+    def _fetch_rows(self, model, columns, user_ids):
+        """ Read the stored rows of many users, normalized for comparison with parsed rows
+
+        @param model: Model to read
+        @param columns: Names of the columns to read
+        @param user_ids: List of user_ids
+        @return: dict of user_id to a list of (primary key, row) tuples
+        """
+        pk = model._meta.primary_key.db_column
+        normalize = row_normalizer(model, columns)
+        rows = {}
+        for chunk in chunked(user_ids, SQLITE_MAX_VARIABLES):
+            cursor = self.client.execute_sql('SELECT "{}", user_id, {} FROM "{}" WHERE user_id IN ({}) ORDER BY "{}"'.format(
+                pk, ', '.join('"{}"'.format(column) for column in columns), model._meta.db_table, ', '.join('?' * len(chunk)), pk
+            ), chunk)
+            for row in cursor:
+                rows.setdefault(row[1], []).append((row[0], normalize(row[2:])))
+        return rows
+
+    def _update_rows(self, model, columns, rows, now):
+        """ Update rows by primary key, setting update_dt if the table has one
+
+        @param model: Model to update
+        @param columns: Names of the columns to set
+        @param rows: List of (primary key, values) tuples
+        @param now: Value of update_dt
+        @return: None
+        """
+        if not rows:
+            return
+
+        stamped = 'update_dt' in model._meta.fields
+        assignments = ['"{}" = ?'.format(column) for column in columns] + (['"update_dt" = ?'] if stamped else [])
+        if not assignments:
+            return
+
+        table = model._meta.db_table
+        sql = 'UPDATE "{}" SET {} WHERE "{}" = ?'.format(table, ', '.join(assignments), model._meta.primary_key.db_column)
+        params = [tuple(values) + ((now,) if stamped else ()) + (pk,) for pk, values in rows]
+        with DB_WRITE_LATENCY.time(table=table), self.client.exception_wrapper():
+            self.client.get_cursor().executemany(sql, params)
+        ROWS_WRITTEN.inc(len(rows), table=table)
+
+    def _delete_rows(self, model, pks):
+        """ Delete rows by primary key
+
+        @param model: Model to delete from
+        @param pks: List of primary keys
+        @return: None
+        """
+        for chunk in chunked(pks, SQLITE_MAX_VARIABLES):
+            self.client.execute_sql('DELETE FROM "{}" WHERE "{}" IN ({})'.format(
+                model._meta.db_table, model._meta.primary_key.db_column, ', '.join('?' * len(chunk))
+            ), chunk)
+
+    def _write_parsed(self, parsed):
+        """ Insert parsed records with one multi-row INSERT per table
+
+        @param parsed: OrderedDict of email to the (user row, child rows) returned by parse_record
+        @return: None
+        """
+        self._insert_rows(User, USER_COLUMNS, [user_row for user_row, _ in parsed.values()])
+        user_ids = self._fetch_user_ids(parsed.keys())
+
+        tables = OrderedDict()
+        for email, (_, child_rows) in parsed.items():
+            user_id = user_ids[email]
+            for model, columns, rows in child_rows:
+                table_rows = tables.setdefault(model, (columns, []))[1]
+                table_rows.extend((user_id,) + row for row in rows)
+
+        for model, (columns, rows) in tables.items():
+            self._insert_rows(model, ('user_id',) + columns, rows)
+
+    def _archive(self, entries, now):
+        """ Store compressed responses, ignoring ones already archived under the same request id
+
+        @param entries: List of tuples returned by archive_row
+        @param now: Time the responses were stored, the same as their parsed rows
+        @return: None
+        """
+        rows = [(email, request_id, status, sqlite3.Binary(body), now) for email, request_id, status, body in entries]
+        self._insert_rows(RawResponse, ARCHIVE_COLUMNS, rows, or_ignore=True)
+
+    def iter_archive(self, latest_only=True):
+        """ Stream the archived responses in the order they were stored
+
+        @param latest_only: Only return the most recent response for each email
+        @return: generator of (email, create_dt, compressed body) tuples
+        """
+        query = RawResponse.select(RawResponse.email, RawResponse.create_dt, RawResponse.body)
+        if latest_only:
+            latest = RawResponse.select(fn.MAX(RawResponse.raw_response_id)).group_by(RawResponse.email)
+            query = query.where(RawResponse.raw_response_id << latest)
+        return query.order_by(RawResponse.raw_response_id).tuples().iterator()
+
+    def reparse_archive(self, source=None, processes=None, batch_size=500):
+        """ Rebuild the parsed tables from archived responses, without calling the API
+
+        Responses are decompressed and parsed by a pool of processes while this
+        process writes. Every archived user is deleted with its rows and
+        inserted again from its latest response. A user that was already
+        stored keeps its create_dt, update_dt and scraped_on; one that was not
+        is dated by its response. Users with nothing in the archive are left
+        alone. The rebuild runs in one transaction, so an interrupted rebuild
+        changes nothing.
+
+        @param source: Connector holding the archive, e.g. a MongoDbConnector.
+            Defaults to this database.
+        @param processes: Number of parser processes. Defaults to the number of CPUs.
+        @param batch_size: Number of responses parsed and written at once
+        @return: int, number of users rebuilt
+        """
+        source = source or self
+        rebuilt = 0
+
+        with self.client.atomic():
+            for batch in parse_archive(source.iter_archive(latest_only=True), processes, batch_size):
+                parsed = OrderedDict(batch)
+                stamps = self._fetch_user_stamps(parsed.keys())
+                self._delete_users(parsed.keys())
+                self._write_parsed(parsed)
+                self._restore_user_stamps(stamps)
+                rebuilt += len(parsed)
+                logger.debug('Rebuilt {} users from the archive'.format(rebuilt))
+
+        logger.info(Colors.OKGREEN + 'Rebuilt {} users from the archive'.format(rebuilt) + Colors.ENDC)
+        return rebuilt
+
+    def _fetch_user_stamps(self, emails):
+        """ Read when users were stored and refreshed, as sqlite holds the values
+
+        @param emails: List of emails
+        @return: list of (create_dt, update_dt, scraped_on, email) tuples
+        """
+        stamps = []
+        for chunk in chunked(emails, SQLITE_MAX_VARIABLES):
+            cursor = self.client.execute_sql(
+                'SELECT u.create_dt, u.update_dt, f.scraped_on, u.email FROM "user" u '
+                'LEFT JOIN user_flat f ON f.user_id = u.user_id WHERE u.email IN ({})'.format(', '.join('?' * len(chunk))),
+                chunk
+            )
+            stamps.extend(cursor.fetchall())
+        return stamps
+
+    def _restore_user_stamps(self, stamps):
+        """ Put back the stamps read by _fetch_user_stamps on users that were inserted again
+
+        @param stamps: List of (create_dt, update_dt, scraped_on, email) tuples
+        @return: None
+        """
+        if not stamps:
+            return
+        cursor = self.client.get_cursor()
+        cursor.executemany('UPDATE "user" SET create_dt = ?, update_dt = ? WHERE email = ?',
+                           [(create_dt, update_dt, email) for create_dt, update_dt, _, email in stamps])
+        cursor.executemany('UPDATE user_flat SET scraped_on = ? WHERE user_id = (SELECT user_id FROM "user" WHERE email = ?)',
+                           [(scraped_on, email) for _, _, scraped_on, email in stamps if scraped_on is not None])
+
+    def _delete_users(self, emails):
+        """ Delete users and every parsed row that belongs to them
+
+        @param emails: List of emails
+        @return: None
+        """
+        user_ids = self._fetch_user_ids(emails).values()
+        for chunk in chunked(user_ids, SQLITE_MAX_VARIABLES):
+            for model in PARSED_MODELS:
+                self.client.execute_sql(
+                    'DELETE FROM "{}" WHERE user_id IN ({})'.format(model._meta.db_table, ', '.join('?' * len(chunk))),
+                    chunk
+                )
+
+    def _insert_many(self, model, rows):
+        """ Insert rows with as few multi-row INSERT statements as sqlite allows
+
+        @param model: Model to insert into
+        @param rows: List of dicts, all with the same keys
+        @return: None
+        """
+        if not rows:
+            return
+
+        table = model._meta.db_table
+        with DB_WRITE_LATENCY.time(table=table):
+            # each row binds at most one parameter per column
+            for chunk in chunked(rows, SQLITE_MAX_VARIABLES // len(model._meta.fields)):
+                model.insert_many(chunk).execute()
+        ROWS_WRITTEN.inc(len(rows), table=table)
+
+    def _insert_rows(self, model, columns, rows, or_ignore=False):
+        """ Insert row tuples with a single prepared statement run over every row
+
+        @param model: Model to insert into
+        @param columns: Names of the columns, in the order of the values in each row
+        @param rows: List of tuples
+        @param or_ignore: Skip rows that violate a unique constraint instead of failing
+        @return: int, rowid of the last row inserted
+        """
+        if not rows:
+            return None
+
+        table = model._meta.db_table
+        sql = '{} INTO "{}" ({}) VALUES ({})'.format(
+            'INSERT OR IGNORE' if or_ignore else 'INSERT', table, ', '.join('"{}"'.format(column) for column in columns), ', '.join('?' * len(columns))
         )
 
-        UserAddress.create(
-            user=user_obj,
-            location_general=record['demographics', 'locationGeneral'],
-            city_name=record['demographics', 'locationDeduced', 'city', 'name'],
-            city_is_deduced=record['demographics', 'locationDeduced', 'city', 'deduced'],
-            county_name=record['demographics', 'locationDeduced', 'county', 'name'],
-            county_is_deduced=record['demographics', 'locationDeduced', 'county', 'deduced'],
-            state_name=record['demographics', 'locationDeduced', 'state', 'name'],
-            state_code=record['demographics', 'locationDeduced', 'state', 'code'],
-            state_is_deduced=record['demographics', 'locationDeduced', 'state', 'deduced'],
-            country_name=record['demographics', 'locationDeduced', 'country', 'name'],
-            country_code=record['demographics', 'locationDeduced', 'country', 'code'],
-            country_is_deduced=record['demographics', 'locationDeduced', 'country', 'deduced'],
-            continent_name=record['demographics', 'locationDeduced', 'continent', 'name'],
-            continent_is_deduced=record['demographics', 'locationDeduced', 'continent', 'deduced'],
-            address_likelihood=record['demographics', 'locationDeduced', 'likelihood']
+        with DB_WRITE_LATENCY.time(table=table), self.client.exception_wrapper():
+            cursor = self.client.get_cursor()
+            if len(rows) == 1:
+                cursor.execute(sql, rows[0])
+            else:
+                cursor.executemany(sql, rows)
+        ROWS_WRITTEN.inc(len(rows), table=table)
+        return cursor.lastrowid
+
+    def _fetch_user_ids(self, emails):
+        """ Look up the user_id of every email that is already in the user table
+
+        @param emails: List of emails
+        @return: dict of email to user_id
+        """
+        user_ids = {}
+        for chunk in chunked(emails, SQLITE_MAX_VARIABLES):
+            query = User.select(User.email, User.user_id).where(User.email << chunk)
+            user_ids.update(query.tuples())
+        return user_ids
+
+    def count_users(self):
+        """ Return the number of users in the database
+
+        @return: int
+        """
+        return User.select().count()
+
+    def iter_known_emails(self):
+        """ Stream the email of every user in the database without caching the rows
+
+        @return: generator of emails
+        """
+        return (email for (email,) in User.select(User.email).tuples().iterator())
+
+    def user_exists(self, email):
+        """ Check whether a user with this email is already in the database
+
+        @param email: Email to look for
+        @return: bool
+        """
+        return User.select().where(User.email == email).exists()
+
+    def rebuild_user_flat(self):
+        """ Repopulate the user_flat table from the normalized tables
+
+        user_flat is kept up to date as records are inserted, so this is only
+        needed to backfill a database created before the table existed.
+
+        @return: int, number of rows written
+        """
+        FacebookProfile = (UserProfile
+            .select(UserProfile)
+            .where(UserProfile.network_name == 'Facebook')
+            .alias('FacebookProfile')
         )
 
-        base_age_range = record['demographics', 'ageRange']
-        if base_age_range:
-            age_min, age_max = base_age_range.split('-')[0], base_age_range.split('-')[1]
-        else:
-            age_min, age_max = None, None
-
-        UserDemography.create(
-            user=user_obj,
-            gender=record['demographics', 'gender'],
-            age=record['demographics', 'age'],
-            age_range_min=age_min,
-            age_range_max=age_max
+        TwitterProfile = (UserProfile
+            .select(UserProfile)
+            .where(UserProfile.network_name == 'Twitter')
+            .alias('TwitterProfile')
         )
 
-        organizations = record.__getitem__('organizations', default=list())
-        for org in organizations:
-            UserOrganization.create(
-                user=user_obj,
-                organization_name=org.get('name', ''),
-                title=org.get('title', ''),
-                start_date=org.get('startDate', None),
-                end_date=org.get('endDate', None),
-                is_current=org.get('current', 0),
-                is_primary=org.get('isPrimary', 0)
-            )
+        Website = (UserProfile
+            .select(UserProfile)
+            .where(UserProfile.profile_type == 'website')
+            .alias('Website')
+        )
 
-        topics = record.__getitem__(['digitalFootprint', 'topics', 'klout'], default=list())
-        for topic in topics:
-            UserTopic.create(
-                user=user_obj,
-                provider=topic.get('provider', ''),
-                topic=topic.get('value', '')
+        query = (User
+            .select(
+                User.user_id,
+                User.first_name,
+                User.last_name,
+                User.email,
+                UserAddress.location_general,
+                UserDemography.age,
+                UserDemography.age_range_min,
+                UserDemography.age_range_max,
+                UserModelScore.score_value,
+                FacebookProfile.c.profile_id,
+                FacebookProfile.c.user_name,
+                FacebookProfile.c.profile_url,
+                TwitterProfile.c.profile_id,
+                TwitterProfile.c.user_name,
+                TwitterProfile.c.followers,
+                TwitterProfile.c.following,
+                Website.c.profile_url,
+                User.create_dt
             )
+            .join(UserAddress, JOIN.LEFT_OUTER).switch(User)
+            .join(UserModelScore, JOIN.LEFT_OUTER).switch(User)
+            .join(UserDemography, JOIN.LEFT_OUTER).switch(User)
+            .join(FacebookProfile, JOIN.LEFT_OUTER, on=(User.user_id==FacebookProfile.c.user_id)).switch(User)
+            .join(TwitterProfile, JOIN.LEFT_OUTER, on=(User.user_id==TwitterProfile.c.user_id)).switch(User)
+            .join(Website, JOIN.LEFT_OUTER, on=(User.user_id==Website.c.user_id))
+            .group_by(User)
+        )
 
-        scores = record.__getitem__(['digitalFootprint', 'scores', 'klout'], default=list())
-        for score in scores:
-            UserModelScore.create(
-                user=user_obj,
-                provider=score.get('provider', ''),
-                type=score.get('general', ''),
-                score_value=score.get('value', None)
-            )
+        with self.client.atomic():
+            UserFlat.delete().execute()
+            UserFlat.insert_from(UserFlat._meta.get_fields(), query).execute()
 
-        websites = record.__getitem__(['contactInfo', 'websites'], default=list())
-        for web in websites:
-            UserProfile.create(
-                user=user_obj,
-                profile_type='website',
-                network_id='website',
-                network_name='website',
-                profile_url=web.get('url', None)
-            )
+        count = UserFlat.select().count()
+        logger.info('Rebuilt user_flat with {} rows'.format(count))
+        return count
+
+    def iter_user_flat(self, chunk_size=10000):
+        """ Stream the user_flat table in user_id order, a chunk at a time
+
+        Each chunk is fetched with a keyset query on the primary key, so reading
+        deep into the table is as cheap as reading the start of it.
 
-        profiles_raw = record.__getitem__(['socialProfiles'], default=list())
-        profiles = []
-
-        if type(profiles_raw) == dict:
-            for network, profile in profiles_raw.items():
-                profiles.extend([p for p in profile])
-        elif type(profiles_raw) == list:
-            profiles = [p for p in profiles_raw]
-
-        for profile in profiles:
-            UserProfile.create(
-                user=user_obj,
-                profile_type='social',
-                network_id=profile.get('typeId', ''),
-                network_name=profile.get('typeName'),
-                profile_id=profile.get('id', ''),
-                profile_url=profile.get('url', ''),
-                user_name=profile.get('username', ''),
-                user_bio=profile.get('bio', ''),
-                followers=profile.get('followers', 0),
-                following=profile.get('following', 0),
-                user_feed=profile.get('rss', '')
+        @param chunk_size: Number of rows per chunk
+        @return: generator of lists of tuples
+        """
+        last_id = 0
+        while True:
+            rows = list(UserFlat
+                .select()
+                .where(UserFlat.user > last_id)
+                .order_by(UserFlat.user)
+                .limit(chunk_size)
+                .tuples()
             )
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1][0]
+
+    def dump_user_data(self, outf_path, chunk_size=10000, fmt=None):
+        """ Export one row per user to the specified location
+
+        @param outf_path: Path of output file. The format is taken from its
+            extension: .csv, .jsonl, either with .gz, .npz or .parquet
+        @param chunk_size: Number of rows read from the database and written at once
+        @param fmt: One of 'csv', 'jsonl', 'npz' or 'parquet', overriding the extension
+        @return: int, number of rows written
+        """
+        return export_batches(outf_path, model_columns(UserFlat), self.iter_user_flat(chunk_size), fmt)
 
     def log_failure(self, email, failure_response):
         """ Log a failure response in the database
@@ -147,65 +688,154 @@ class SqliteConnector(AbstractDatabaseConnector):
         @param failure_response: Response from the FullContact API
         @return: None
         """
-        FailureLog.create(
+        with DB_WRITE_LATENCY.time(table=FailureLog._meta.db_table):
+            FailureLog.create(**self._failure_row(email, failure_response))
+        ROWS_WRITTEN.inc(table=FailureLog._meta.db_table)
+
+    def log_failures(self, failures):
+        """ Log many failure responses in a single transaction
+
+        @param failures: Iterable of (email, failure_response) tuples
+        @return: None
+        """
+        with self.client.atomic():
+            self._insert_many(FailureLog, [self._failure_row(email, response) for email, response in failures])
+
+    def _failure_row(self, email, failure_response):
+        return dict(
             email=email,
             initial_status=failure_response.status,
             message=failure_response.message,
-            request_id=failure_response.requestId,
-            retry_complete=(failure_response.status not in [202, 403, 500, 400, 422])
+            request_id=failure_response.get('requestId'),
+            retry_complete=self.retry_policy.is_complete(failure_response.status),
+            next_attempt_dt=self.retry_policy.next_attempt(failure_response.status)
         )
 
-    def fetch_retry_queue(self):
+    def fetch_retry_queue(self, limit=None, after_id=0, due_only=True):
+        """ Return rows from the failure_log table that still need to be retried
+
+        Rows come back in failure_log_id order, so a large queue can be read a
+        page at a time by passing the last failure_log_id seen as `after_id`.
+
+        @param limit: Maximum number of rows to return
+        @param after_id: Only return rows with a greater failure_log_id
+        @param due_only: Only return rows whose next attempt is due
+        @return: list of dicts
         """
-        Return all rows from the failure_log table that still need to be retried
+        query = self._retry_queue_query(after_id, due_only)
+        if limit:
+            query = query.limit(limit)
+
+        return list(query.dicts())
+
+    def count_retry_queue(self, due_only=True):
+        """ Return the number of failures that still need to be retried
+
+        @param due_only: Only count rows whose next attempt is due
+        @return: int
         """
+        return self._retry_queue_query(0, due_only).count()
+
+    def _retry_queue_query(self, after_id, due_only):
         query = (FailureLog
             .select()
             .where(
-                (
-                    # specific codes that indicate we need to retry
-                    #   - 202: explicit retry call
-                    #   - 403: rate limit or auth rejection
-                    #   - 500: server error, not our fault
-                    (FailureLog.initial_status == 202) |
-                    (FailureLog.initial_status == 403) |
-                    (FailureLog.initial_status == 500)
-                )
+                # only the statuses the retry policy schedules are ever retried
+                (FailureLog.initial_status << self.retry_policy.retried_statuses)
                 # a retry can complete without succeeding (i.e. if  we go from 202 -> 404)
                 & (FailureLog.retry_complete == 0)
+                & (FailureLog.failure_log_id > after_id)
             )
+            .order_by(FailureLog.failure_log_id)
         )
-        return [model_to_dict(result) for result in query]
 
-    def dump_failures(self, outf_path, include_completed=False):
-        """ Dump a CSV of failures to the specified location
+        if due_only:
+            # rows logged before scheduling was introduced have no due time
+            query = query.where(
+                (FailureLog.next_attempt_dt <= datetime.datetime.now()) |
+                (FailureLog.next_attempt_dt >> None)
+            )
+
+        return query
+
+    def iter_retry_queue(self, page_size=500, due_only=True):
+        """ Page through the failures that still need to be retried
+
+        @param page_size: Number of rows per page
+        @param due_only: Only return rows whose next attempt is due
+        @return: generator of lists of dicts
+        """
+        after_id = 0
+        while True:
+            page = self.fetch_retry_queue(limit=page_size, after_id=after_id, due_only=due_only)
+            if not page:
+                return
+            yield page
+            after_id = page[-1]['failure_log_id']
+
+    def iter_failures(self, include_completed=False, chunk_size=10000):
+        """ Stream the failure_log table in failure_log_id order, a chunk at a time
 
-        @param outf_path: Path of output file
         @param include_completed: Whether to include completed retries
-        @return: None
+        @param chunk_size: Number of rows per chunk
+        @return: generator of lists of tuples
         """
-        if include_completed:
-            q = FailureLog.select()
-        else:
-            q = FailureLog.select().where(FailureLog.retry_complete == 0)
+        last_id = 0
+        while True:
+            query = FailureLog.select().where(FailureLog.failure_log_id > last_id)
+            if not include_completed:
+                query = query.where(FailureLog.retry_complete == 0)
+            rows = list(query.order_by(FailureLog.failure_log_id).limit(chunk_size).tuples())
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1][0]
 
-        with open(outf_path, 'w') as outf:
-            dump_csv(q, outf)
+    def dump_failures(self, outf_path, include_completed=False, chunk_size=10000, fmt=None):
+        """ Export failures to the specified location
+
+        @param outf_path: Path of output file, in any format dump_user_data writes
+        @param include_completed: Whether to include completed retries
+        @param chunk_size: Number of rows read from the database and written at once
+        @param fmt: Export format, overriding the extension
+        @return: int, number of rows written
+        """
+        return export_batches(outf_path, model_columns(FailureLog), self.iter_failures(include_completed, chunk_size), fmt)
 
     def update_retry_row(self, current_row_obj, new_result):
-        # update the failure row to flag if our result has succeeded
-        fq = (FailureLog
-            .update(
-                most_recent_retry_status=new_result.status,
-                retry_count=FailureLog.retry_count + 1,
-                retry_complete=(new_result.status not in [202, 403, 500, 400, 422]),
-                most_recent_retry_dt=datetime.datetime.now()
-            )
-            .where(
-                FailureLog.request_id == current_row_obj['request_id']
-            )
-        )
-        fq.execute()
+        """ Record the result of retrying a failed lookup
+
+        @param current_row_obj: Row returned by fetch_retry_queue
+        @param new_result: Response from the FullContact API
+        @return: None
+        """
+        self.update_retry_rows([(current_row_obj, new_result)])
+
+    def update_retry_rows(self, results):
+        """ Record the results of retrying many failed lookups in a single transaction
+
+        @param results: Iterable of (row, response) tuples, where row was returned by fetch_retry_queue
+        @return: None
+        """
+        now = datetime.datetime.now()
+        params = []
+        for row, new_result in results:
+            retry_count = row['retry_count'] + 1
+            # flag the failure row as complete if our result has succeeded
+            params.append((
+                new_result.status,
+                retry_count,
+                FailureLog.retry_complete.db_value(self.retry_policy.is_complete(new_result.status, retry_count)),
+                FailureLog.most_recent_retry_dt.db_value(now),
+                FailureLog.next_attempt_dt.db_value(self.retry_policy.next_attempt(new_result.status, retry_count, now)),
+                row['failure_log_id']
+            ))
+        if not params:
+            return
+
+        sql = ('UPDATE failure_log SET most_recent_retry_status = ?, retry_count = ?, retry_complete = ?, '
+               'most_recent_retry_dt = ?, next_attempt_dt = ? WHERE failure_log_id = ?')
+        with DB_WRITE_LATENCY.time(table=FailureLog._meta.db_table), self.client.atomic(), self.client.exception_wrapper():
+            self.client.get_cursor().executemany(sql, params)
 
-        # get the updated row
-        return FailureLog.select().where(FailureLog.request_id == current_row_obj['request_id'])
+        ROWS_WRITTEN.inc(len(params), table=FailureLog._meta.db_table)
@@ -0,0 +1,35 @@
+# Named sets of PRAGMAs applied to every sqlite connection.
+#
+#   - safe:       the database's own journal mode, which for a new database is
+#                 sqlite's single-file rollback journal, and every commit synced
+#   - concurrent: WAL with NORMAL sync (durable across application crashes, may
+#                 lose the last commits on power loss), larger cache and mmap
+#                 for exports and retry passes running alongside ingestion
+#   - bulk-load:  no syncing at all and a large cache, for first-time loads
+#                 that can simply be rerun if the machine goes down
+#
+# WAL is persistent and adds -wal and -shm files next to the database, so only
+# the profiles that are asked for by name switch to it. journal_mode comes
+# first since WAL has to be in place before the others apply
+PROFILES = {
+    'safe': (
+        ('synchronous', 'full'),
+        ('busy_timeout', 30000),
+    ),
+    'concurrent': (
+        ('journal_mode', 'wal'),
+        ('synchronous', 'normal'),
+        ('cache_size', -64000),
+        ('mmap_size', 256 * 1024 * 1024),
+        ('temp_store', 'memory'),
+        ('busy_timeout', 30000),
+    ),
+    'bulk-load': (
+        ('journal_mode', 'wal'),
+        ('synchronous', 'off'),
+        ('cache_size', -512000),
+        ('mmap_size', 1024 * 1024 * 1024),
+        ('temp_store', 'memory'),
+        ('busy_timeout', 60000),
+    ),
+}
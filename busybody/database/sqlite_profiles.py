@@ -0,0 +1,43 @@
+import logging
+
+from peewee import SqliteDatabase
+
+from sqlite_pragmas import PROFILES
+
+logger = logging.getLogger(__name__)
+
+
+class ProfiledSqliteDatabase(SqliteDatabase):
+    """
+    SqliteDatabase that applies a performance profile to every connection it
+    opens, including the per-thread connections made with threadlocals=True.
+    """
+
+    def __init__(self, database, profile='safe', **kwargs):
+        """ Create a sqlite database using a named profile
+
+        @param database: Path of the sqlite database
+        @param profile: Name of a profile in PROFILES, or None for sqlite's defaults
+        @param kwargs: Options passed to SqliteDatabase
+        @return: None
+        """
+        if profile is not None and profile not in PROFILES:
+            raise ValueError('Unknown sqlite profile {}, expected one of {}'.format(profile, ', '.join(sorted(PROFILES))))
+
+        self.profile = profile
+        self.pragmas = PROFILES.get(profile, ())
+
+        # let the sqlite3 module wait out locks as long as the busy timeout does
+        busy_timeout = dict(self.pragmas).get('busy_timeout')
+        if busy_timeout:
+            kwargs.setdefault('timeout', busy_timeout / 1000.0)
+
+        super(ProfiledSqliteDatabase, self).__init__(database, **kwargs)
+
+    def _add_conn_hooks(self, conn):
+        super(ProfiledSqliteDatabase, self)._add_conn_hooks(conn)
+
+        cursor = conn.cursor()
+        for pragma, value in self.pragmas:
+            cursor.execute('PRAGMA {} = {}'.format(pragma, value))
+        logger.debug('Applied sqlite profile {} to new connection'.format(self.profile))
@@ -0,0 +1,220 @@
+import logging
+import sys
+import threading
+import time
+from Queue import Queue, Empty
+
+from ..utils import Colors
+from ..utils.concurrency import Future
+
+logger = logging.getLogger(__name__)
+
+# marker telling the writer thread to exit once the queue is drained
+_STOP = object()
+
+
+class BatchingWriter(object):
+    """
+    Write-behind wrapper around a database connector.
+
+    Any number of threads can hand results to the writer; a single background
+    thread groups them into batches and writes each batch with the connector's
+    bulk methods. Only one thread ever writes, so fetcher threads never contend
+    for sqlite's write lock, and the number of transactions depends on the batch
+    size rather than on the number of fetchers.
+
+    The write methods return a Future that resolves once the write is
+    committed. If a batch fails, its writes are tried again one at a time, so
+    only the Futures of the writes that fail on their own get the exception.
+    Every other connector method is passed through, after waiting
+    for pending writes, so reads always see what was written before them. A
+    BatchingWriter can therefore be given to BusyBody in place of the connector
+    it wraps.
+
+    with BatchingWriter(SqliteConnector('busybody.sqlite')) as db:
+        bb = BusyBody(db, api)
+        for email, response in bb.process_many(emails, concurrency=16):
+            ...
+    """
+
+    def __init__(self, database, max_batch=500, max_delay=1.0, queue_size=10000):
+        """ Start a writer thread for a database connector
+
+        @param database: Database connector to write to
+        @param max_batch: Maximum number of writes grouped into one batch
+        @param max_delay: Maximum number of seconds a write waits for its batch to fill
+        @param queue_size: Maximum number of pending writes. Callers block when
+            the queue is full, which keeps memory bounded when the database
+            falls behind.
+        @return: None
+        """
+        self.db = database
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        self._queue = Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name='busybody-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __getattr__(self, name):
+        attr = getattr(self.db, name)
+        if not callable(attr):
+            return attr
+
+        def flushed(*args, **kwargs):
+            self.flush()
+            return attr(*args, **kwargs)
+        return flushed
+
+    def _submit(self, kind, item):
+        if not self._thread.is_alive():
+            raise RuntimeError('BatchingWriter has been closed')
+        future = Future()
+        self._queue.put((kind, item, future))
+        return future
+
+    def insert_user_record(self, email, record):
+        """ Queue a user record for insertion
+
+        Emails that are already stored are skipped with a warning, as with the
+        connector's insert_user_records.
+
+        @param email: Email that was searched
+        @param record: Response returned by FullContact
+        @return: Future
+        """
+        return self._submit('record', (email, record))
+
+    def insert_user_records(self, records):
+        """ Queue many user records for insertion
+
+        @param records: Iterable of (email, response) tuples
+        @return: list of Futures
+        """
+        return [self.insert_user_record(email, record) for email, record in records]
+
+    def upsert_user_record(self, email, record):
+        """ Queue a user record to be inserted, or reconciled with the stored user
+
+        @param email: Email that was searched
+        @param record: Response returned by FullContact
+        @return: Future
+        """
+        return self._submit('upsert', (email, record))
+
+    def upsert_user_records(self, records):
+        return [self.upsert_user_record(email, record) for email, record in records]
+
+    def log_failure(self, email, failure_response):
+        """ Queue a failure response to be logged
+
+        @param email: Email that was submitted to the FullContact API
+        @param failure_response: Response from the FullContact API
+        @return: Future
+        """
+        return self._submit('failure', (email, failure_response))
+
+    def log_failures(self, failures):
+        return [self.log_failure(email, response) for email, response in failures]
+
+    def update_retry_row(self, current_row_obj, new_result):
+        """ Queue the result of a retried lookup
+
+        @param current_row_obj: Row returned by fetch_retry_queue
+        @param new_result: Response from the FullContact API
+        @return: Future
+        """
+        return self._submit('retry', (current_row_obj, new_result))
+
+    def update_retry_rows(self, results):
+        return [self.update_retry_row(row, response) for row, response in results]
+
+    def flush(self, timeout=None):
+        """ Block until every write queued so far is committed
+
+        @param timeout: Seconds to wait, or None to wait forever
+        @return: None
+        """
+        self._submit('flush', None).wait(timeout)
+
+    def close(self):
+        """ Write everything still queued and stop the writer thread
+
+        @return: None
+        """
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+
+            batch = [item]
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.max_batch and batch[-1][0] != 'flush':
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.time()))
+                except Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._write(batch)
+
+    def _write(self, batch):
+        groups = {'record': [], 'upsert': [], 'failure': [], 'retry': [], 'flush': []}
+        for kind, item, future in batch:
+            groups[kind].append((item, future))
+
+        started = time.time()
+        for kind, method in (('record', self.db.insert_user_records),
+                             ('upsert', self.db.upsert_user_records),
+                             ('failure', self.db.log_failures),
+                             ('retry', self.db.update_retry_rows)):
+            group = groups[kind]
+            if not group:
+                continue
+
+            if len(group) == 1:
+                self._write_one(kind, method, *group[0])
+                continue
+
+            try:
+                method([item for item, _ in group])
+            except Exception, e:
+                # the connector's bulk writes are atomic, so none of the group was written
+                logger.warn(Colors.WARNING + 'Failed to write a batch of {} {} rows, writing them one at a time: {}'.format(len(group), kind, e) + Colors.ENDC)
+                for item, future in group:
+                    self._write_one(kind, method, item, future)
+            else:
+                for _, future in group:
+                    future.set_result(None)
+
+        logger.debug('Wrote a batch of {} items in {:.3f}s'.format(len(batch), time.time() - started))
+
+        for _, future in groups['flush']:
+            future.set_result(None)
+
+    @staticmethod
+    def _write_one(kind, method, item, future):
+        try:
+            method([item])
+        except Exception:
+            exc_info = sys.exc_info()
+            logger.error(Colors.FAIL + 'Failed to write a {} row: {}'.format(kind, exc_info[1]) + Colors.ENDC)
+            future.set_exception(exc_info)
+        else:
+            future.set_result(None)
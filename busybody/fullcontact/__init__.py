@@ -1,3 +1,7 @@
 # busybody.fullcontact
 
-from fullcontact import FullContact
\ No newline at end of file
+from fullcontact import FullContact, RateLimiter
+from transport import HttpTransport
+from cache import ResponseCache, CachedFullContact
+from synthetic import SyntheticProfiles
+from standin import StandInServer, fixed_latency, uniform_latency, lognormal_latency
@@ -0,0 +1,159 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from tortilla.utils import bunchify
+
+from fullcontact_interface import FullContactInterface
+from ..utils.metrics import CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache(object):
+    """
+    Persistent cache of FullContact Person API responses, stored in its own
+    sqlite file so that it can be shared between runs and between databases.
+
+    Successful lookups are kept for `ttl` seconds. 404s are cached separately
+    for `negative_ttl` seconds, since FullContact may find the person later.
+    Responses that ask to be retried (202, 403, 500, ...) are never cached.
+    """
+
+    def __init__(self, path='busybody_cache.sqlite', ttl=30 * 24 * 3600, negative_ttl=7 * 24 * 3600):
+        """ Open (and if needed create) a response cache.
+
+        @param path: Path of the sqlite file backing the cache
+        @param ttl: Seconds to keep successful responses
+        @param negative_ttl: Seconds to keep 404 responses
+        @return: None
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS response_cache ('
+            '  email TEXT PRIMARY KEY,'
+            '  status INTEGER NOT NULL,'
+            '  response TEXT NOT NULL,'
+            '  expires_at REAL NOT NULL'
+            ')'
+        )
+        self._conn.commit()
+
+        logger.debug('Opened FullContact response cache {}'.format(path))
+
+    @staticmethod
+    def normalize(email):
+        """ Normalize an email for use as a cache key
+
+        @param email: Email as submitted
+        @return: str
+        """
+        return email.strip().lower()
+
+    def get(self, email):
+        """ Return the cached response for an email, or None if there isn't a fresh one
+
+        @param email: Email to look up
+        @return: tortilla response or None
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT status, response FROM response_cache WHERE email = ? AND expires_at > ?',
+                (self.normalize(email), time.time())
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                CACHE_LOOKUPS.inc(result='miss')
+                return None
+
+            if row[0] == 200:
+                self.hits += 1
+                CACHE_LOOKUPS.inc(result='hit')
+            else:
+                self.negative_hits += 1
+                CACHE_LOOKUPS.inc(result='negative_hit')
+
+        return bunchify(json.loads(row[1]))
+
+    def set(self, email, response):
+        """ Store a response if it is cacheable
+
+        @param email: Email that was looked up
+        @param response: Response returned by FullContact
+        @return: bool, whether the response was stored
+        """
+        if response.status == 200:
+            ttl = self.ttl
+        elif response.status == 404:
+            ttl = self.negative_ttl
+        else:
+            return False
+
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO response_cache (email, status, response, expires_at) VALUES (?, ?, ?, ?)',
+                (self.normalize(email), response.status, json.dumps(response), time.time() + ttl)
+            )
+            self._conn.commit()
+        return True
+
+    def purge_expired(self):
+        """ Delete expired entries from the cache
+
+        @return: int, number of entries deleted
+        """
+        with self._lock:
+            cursor = self._conn.execute('DELETE FROM response_cache WHERE expires_at <= ?', (time.time(),))
+            self._conn.commit()
+        return cursor.rowcount
+
+    def stats(self):
+        """ Return the hit and miss counters
+
+        @return: dict
+        """
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits + self.negative_hits) / lookups if lookups else 0.0
+        }
+
+
+class CachedFullContact(FullContactInterface):
+
+    def __init__(self, api, cache):
+        """ Wrap a FullContact object so that lookups are answered from a cache when possible.
+
+        @param api: FullContact object used on a cache miss
+        @param cache: ResponseCache
+        @return: None
+        """
+        self.api = api
+        self.cache = cache
+
+    def get_person(self, email):
+        """ Return the cached response for an email, or look it up and cache the result.
+
+        @param email: The email of the user to search for
+        @return: tortilla.response
+        """
+        response = self.cache.get(email)
+        if response is not None:
+            logger.info('Returning cached response with status {} for {}'.format(response.status, email))
+            return response
+
+        response = self.api.get_person(email)
+        self.cache.set(email, response)
+        return response
@@ -1,50 +1,231 @@
 import logging
+import threading
+import time
+import requests
 import tortilla
+from tortilla.wrappers import Client
 
-from fullcontact_interface import FullContactInterface
+from fullcontact_interface import FullContactInterface, unavailable_response
+from transport import HttpTransport
+from ..utils.metrics import API_IN_FLIGHT, API_LATENCY, RATE_LIMIT_WAIT
 
 
 logger = logging.getLogger(__name__)
 
+# address of the FullContact v2 API
+API_URL = 'https://api.fullcontact.com/v2'
+
+
+class RateLimiter(object):
+    """
+    Token bucket that paces requests to the FullContact API.
+
+    A single RateLimiter is safe to share between threads, and between several
+    FullContact objects using the same API key. The bucket starts at a
+    conservative rate and is retuned from the X-Rate-Limit-* headers FullContact
+    returns with every response:
+
+        X-Rate-Limit-Limit      requests allowed per rate limit window
+        X-Rate-Limit-Remaining  requests left in the current window
+        X-Rate-Limit-Reset      seconds until the current window resets
+
+    The rate is set so that what is left of the window is spread evenly until
+    it resets, keeping `reserve` requests back to absorb requests that are
+    already in flight. Once the window is used up, or FullContact answers with a
+    403, requests are held until the window resets.
+
+    Limiters in separate processes can't share a bucket. Give each of them a
+    `share` of the key, e.g. 1.0 / 8 for eight processes, and only that
+    fraction of the limits read from the headers is used.
+    """
+
+    # length of the FullContact rate limit window, in seconds
+    window = 60
+
+    # tolerance for floating point error when counting tokens
+    epsilon = 1e-9
+
+    def __init__(self, rate=1.0, burst=1, reserve=1, share=1.0, clock=time.time, sleep=time.sleep):
+        """ Create a token bucket.
+
+        @param rate: Initial number of requests per second, used until the API
+            reports the real limit
+        @param burst: Maximum number of requests that may be sent back to back
+        @param reserve: Number of requests per window to leave unused
+        @param share: Fraction of the key's reported limit this bucket may use
+        @param clock: Function returning the current time in seconds
+        @param sleep: Function used to wait for a token
+        @return: None
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.reserve = reserve
+        self.share = float(share)
+        self.tokens = float(burst)
+        self.blocked_until = 0.0
+
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._updated = clock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """ Block until a request may be sent.
+
+        @return: float, number of seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1 - self.epsilon:
+                    self.tokens = max(self.tokens - 1, 0.0)
+                    return waited
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+
+            self._sleep(wait)
+            waited += wait
+
+    def update(self, limit=None, remaining=None, reset=None):
+        """ Retune the bucket from the rate limit reported by the API.
+
+        @param limit: Requests allowed per window
+        @param remaining: Requests left in the current window
+        @param reset: Seconds until the current window resets
+        @return: None
+        """
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+
+            if limit:
+                self.rate = limit * self.share / self.window
+
+            if remaining is not None and reset is not None:
+                usable = remaining * self.share - self.reserve
+                if usable <= 0:
+                    self._block(now, reset)
+                else:
+                    self.rate = min(self.rate, float(usable) / max(reset, 1))
+                    self.tokens = min(self.tokens, usable)
+
+    def block(self, seconds):
+        """ Hold all requests for a number of seconds, e.g. after a 403.
+
+        @param seconds: Number of seconds to wait before sending another request
+        @return: None
+        """
+        with self._lock:
+            self._block(self._clock(), seconds)
+
+    def _block(self, now, seconds):
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = 0.0
+        logger.warn('Rate limit exhausted, holding requests for {} seconds'.format(seconds))
+
 
 class FullContact(FullContactInterface):
 
-    def __init__(self, fc_key, debug=False, style='dictionary'):
+    def __init__(self, fc_key, debug=False, style='dictionary', rate_limiter=None, base_url=API_URL, transport=None):
         """ Create a FullContact object.
 
         @param fc_key: API Key for the FullContact API
         @param debug: Debug mode for Tortilla
         @param style: One of 'list' or 'dictionary'. Determines what response type
             should be returned from FullContact.
+        @param rate_limiter: RateLimiter used to pace requests. Pass the same
+            RateLimiter to every FullContact object sharing an API key.
+        @param base_url: Address of the API, e.g. a StandInServer's base_url for offline testing
+        @param transport: HttpTransport whose connection pool is used for requests.
+            Pass the same HttpTransport to every FullContact object to share connections.
         @return: None
         """
         self.fc_key = fc_key
         self.style = style
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.transport = transport or HttpTransport()
+
+        # route tortilla's requests through the pooled session
+        self.client = Client(debug=debug)
+        self.client.session = self.transport.session
 
         self.api = tortilla.wrap(
-            'https://api.fullcontact.com/v2',
+            base_url,
+            parent=self.client,
             debug=debug,
-            delay=1,
             extension='json'
         )
 
-        logger.debug('Set up FullContact API to return {} using API key {}'.format(style, fc_key))
+        logger.debug('Set up FullContact API at {} to return {} using API key {}'.format(base_url, style, fc_key))
+
+    def _read_rate_limit(self, response, **kwargs):
+        """ requests response hook feeding the rate limit headers to the rate limiter
+
+        @param response: requests.Response
+        @return: None
+        """
+        def header(name):
+            try:
+                return int(response.headers[name])
+            except (KeyError, TypeError, ValueError):
+                return None
+
+        limit = header('X-Rate-Limit-Limit')
+        remaining = header('X-Rate-Limit-Remaining')
+        reset = header('X-Rate-Limit-Reset')
+
+        logger.debug('Rate limit: {} of {} remaining, resets in {}s'.format(remaining, limit, reset))
+        self.rate_limiter.update(limit=limit, remaining=remaining, reset=reset)
+
+        if response.status_code == 403:
+            self.rate_limiter.block(reset if reset is not None else self.rate_limiter.window)
 
     def get_person(self, email):
         """ Submits a request to the FullContact person API and return the result.
 
+        A request that times out or can't connect is not raised: it comes back
+        as a failed response with status 503, so a batch carries on past it and
+        the lookup is retried later.
+
         @param email: The email of the user to search for
         @return: tortilla.response
         """
+        waited = self.rate_limiter.acquire()
+        RATE_LIMIT_WAIT.observe(waited)
+        if waited:
+            logger.debug('Waited {:.2f}s for the rate limiter'.format(waited))
+
         logger.info('Submitting API Request for {}'.format(email))
 
-        response = self.api.person.get(silent=True, params={
-            'email': email,
-            'apiKey': self.fc_key,
-            'style': self.style
-        })
+        started = time.time()
+        try:
+            with API_IN_FLIGHT.track():
+                response = self.api.person.get(silent=True, params={
+                    'email': email,
+                    'apiKey': self.fc_key,
+                    'style': self.style
+                }, timeout=self.transport.timeout, hooks={'response': self._read_rate_limit})
+        except requests.RequestException, e:
+            logger.warn('Request for {} failed: {}'.format(email, e))
+            response = unavailable_response(e)
+        API_LATENCY.observe(time.time() - started, status=response.status)
 
         logger.info('API returned a response with status {}'.format(response.status))
         logger.debug(response)
 
         return response
+
+    def get_person_async(self, email):
+        """ Submits a request to the FullContact person API without waiting for the result.
+
+        The request runs on the transport's worker threads.
+
+        @param email: The email of the user to search for
+        @return: Future resolving to the tortilla.response
+        """
+        return self.transport.submit(self.get_person, email)
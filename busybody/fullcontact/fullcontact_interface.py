@@ -1,4 +1,23 @@
 
+from tortilla.utils import bunchify
+
+# status recorded for lookups that never got an answer, e.g. after a timeout
+UNAVAILABLE = 503
+
+
+def unavailable_response(error):
+    """ Build the failure response of a lookup that failed before the API answered
+
+    @param error: Exception raised while sending the request or reading the response
+    @return: response with status UNAVAILABLE, which the retry queue picks up
+    """
+    return bunchify({
+        'status': UNAVAILABLE,
+        'message': '{}: {}'.format(type(error).__name__, error),
+        'requestId': None
+    })
+
+
 class FullContactInterface:
     """
     Abstract class to implement for accessing the FullContact API
@@ -14,7 +33,8 @@ class FullContactInterface:
         405: 'METHOD NOT ALLOWED',
         410: 'GONE (ENDPOINT DEPRECATED)',
         422: 'INVALID REQUEST',
-        500: 'SERVER ERROR'
+        500: 'SERVER ERROR',
+        503: 'SERVICE UNAVAILABLE'
     }
 
     def __init__(self):
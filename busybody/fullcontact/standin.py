@@ -0,0 +1,264 @@
+import json
+import logging
+import math
+import random
+import socket
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from ..utils import Colors
+from synthetic import SyntheticProfiles
+
+logger = logging.getLogger(__name__)
+
+
+def fixed_latency(seconds):
+    """ Latency distribution that always waits the same time
+
+    @param seconds: Seconds to wait before answering
+    @return: function taking a random.Random and returning seconds
+    """
+    return lambda rng: seconds
+
+
+def uniform_latency(low, high):
+    """ Latency distribution spread evenly between two bounds
+
+    @param low: Shortest wait in seconds
+    @param high: Longest wait in seconds
+    @return: function taking a random.Random and returning seconds
+    """
+    return lambda rng: rng.uniform(low, high)
+
+
+def lognormal_latency(median, sigma=0.5, maximum=30.0):
+    """ Long-tailed latency distribution, the usual shape of real API latencies
+
+    @param median: Median wait in seconds
+    @param sigma: Shape of the tail; larger values give slower slow requests
+    @param maximum: Longest wait in seconds
+    @return: function taking a random.Random and returning seconds
+    """
+    mu = math.log(median)
+    return lambda rng: min(rng.lognormvariate(mu, sigma), maximum)
+
+
+class _StandInHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+
+    def close_connections(self):
+        # wake up handlers waiting for the next request on a kept-alive connection
+        with self.connections_lock:
+            for conn in self.connections:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+
+class _PersonHandler(BaseHTTPRequestHandler):
+    # keep connections open between requests, as the real API does
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.connections_lock:
+            self.server.connections.add(self.connection)
+
+    def finish(self):
+        with self.server.connections_lock:
+            self.server.connections.discard(self.connection)
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path.rstrip('/') != '/v2/person.json':
+            self.send_error(404)
+            return
+
+        params = dict(urlparse.parse_qsl(url.query))
+        status, body, headers = self.server.standin.respond(params)
+
+        payload = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in headers:
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, fmt, *args):
+        logger.debug('{} {}'.format(self.address_string(), fmt % args))
+
+
+class StandInServer(object):
+    """
+    Local stand-in for the FullContact Person API, for load and failure-mode
+    testing without a paid key.
+
+    Serves GET /v2/person.json with deterministic SyntheticProfiles, answers a
+    configurable share of requests with 202/403/404/500, sleeps for a latency
+    drawn from a configurable distribution and sends the X-Rate-Limit-* headers
+    of the real API, answering 403 once the window's limit is used up.
+
+    with StandInServer(latency=lognormal_latency(0.2), failure_rates={202: 0.05}) as server:
+        api = FullContact('any-key', base_url=server.base_url)
+        bb = BusyBody(db, api)
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=None, failure_rates=None, rate_limit=600,
+                 window=60, size='medium', seed=0, api_key=None):
+        """ Create a stand-in server. Call start() or use it as a context manager to serve requests.
+
+        @param host: Address to listen on
+        @param port: Port to listen on, 0 picks a free one
+        @param latency: Latency distribution, e.g. from lognormal_latency(). None answers immediately.
+        @param failure_rates: Dict of status to share of requests answered with it, for 202, 403, 404 and 500
+        @param rate_limit: Requests allowed per rate limit window, or None for no limit
+        @param window: Length of the rate limit window in seconds
+        @param size: Size of the synthetic profiles, one of the keys of PROFILE_SIZES
+        @param seed: Seed for the profiles and for picking failures and latencies
+        @param api_key: API key to require, or None to accept any key
+        @return: None
+        """
+        failure_rates = failure_rates or {}
+        unknown = set(failure_rates) - set([202, 403, 404, 500])
+        if unknown:
+            raise ValueError('Unsupported failure statuses {}'.format(', '.join(str(s) for s in sorted(unknown))))
+        if sum(failure_rates.values()) > 1:
+            raise ValueError('Failure rates add up to more than 1')
+
+        self.latency = latency
+        self.failure_rates = sorted(failure_rates.items())
+        self.rate_limit = rate_limit
+        self.window = window
+        self.size = size
+        self.api_key = api_key
+        self.profiles = SyntheticProfiles(seed)
+        self.stats = {}
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window_start = time.time()
+        self._window_used = 0
+        self._thread = None
+
+        self.httpd = _StandInHTTPServer((host, port), _PersonHandler)
+        self.httpd.standin = self
+
+    @property
+    def base_url(self):
+        """ URL to pass to FullContact as base_url """
+        host, port = self.httpd.server_address[:2]
+        return 'http://{}:{}/v2'.format(host, port)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        """ Serve requests on a background thread
+
+        @return: None
+        """
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='busybody-standin')
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info(Colors.OKBLUE + 'FullContact stand-in listening on {}'.format(self.base_url) + Colors.ENDC)
+
+    def stop(self):
+        """ Stop serving and close the socket
+
+        @return: None
+        """
+        if self._thread is not None:
+            self.httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.httpd.close_connections()
+        self.httpd.server_close()
+
+    def _draw(self):
+        # pick the status and latency of one request
+        with self._lock:
+            roll = self._rng.random()
+            delay = self.latency(self._rng) if self.latency else 0
+
+        status = 200
+        for failure_status, rate in self.failure_rates:
+            if roll < rate:
+                status = failure_status
+                break
+            roll -= rate
+        return status, delay
+
+    def _take_rate_limit(self):
+        # count a request against the current window; returns (allowed, remaining, reset)
+        with self._lock:
+            now = time.time()
+            if now - self._window_start >= self.window:
+                self._window_start, self._window_used = now, 0
+
+            reset = int(math.ceil(self._window_start + self.window - now))
+            if self.rate_limit is None:
+                return True, None, reset
+            if self._window_used >= self.rate_limit:
+                return False, 0, reset
+
+            self._window_used += 1
+            return True, self.rate_limit - self._window_used, reset
+
+    def _count(self, status):
+        with self._lock:
+            self.stats[status] = self.stats.get(status, 0) + 1
+
+    def respond(self, params):
+        """ Build the answer to one Person API request
+
+        @param params: Query string parameters of the request
+        @return: tuple of status, JSON body and list of extra headers
+        """
+        status, delay = self._draw()
+        allowed, remaining, reset = self._take_rate_limit()
+
+        headers = []
+        if self.rate_limit is not None:
+            headers = [
+                ('X-Rate-Limit-Limit', self.rate_limit),
+                ('X-Rate-Limit-Remaining', remaining),
+                ('X-Rate-Limit-Reset', reset)
+            ]
+
+        if delay:
+            time.sleep(delay)
+
+        email = params.get('email')
+        if self.api_key is not None and params.get('apiKey') != self.api_key:
+            status, body = 403, {'status': 403, 'message': 'Api key was not specified or is invalid.'}
+        elif not email:
+            status, body = 400, {'status': 400, 'message': 'Missing required parameter: email.'}
+        elif not allowed:
+            status, body = 403, self.profiles.failure(email, 403)
+        elif status == 200:
+            body = self.profiles.person(email, size=self.size)
+        else:
+            body = self.profiles.failure(email, status)
+
+        self._count(status)
+        return status, body, headers
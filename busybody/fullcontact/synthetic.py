@@ -0,0 +1,145 @@
+import hashlib
+import random
+
+from tortilla.utils import bunchify
+
+# how many of each repeated element a synthetic profile gets
+PROFILE_SIZES = {
+    'small': dict(social_profiles=1, organizations=0, websites=0, topics=0, scores=1),
+    'medium': dict(social_profiles=4, organizations=2, websites=1, topics=5, scores=1),
+    'large': dict(social_profiles=12, organizations=8, websites=4, topics=20, scores=2),
+}
+
+FIRST_NAMES = ['Bart', 'Lisa', 'Marge', 'Homer', 'Maggie', 'Ned', 'Edna', 'Seymour', 'Waylon', 'Selma']
+LAST_NAMES = ['Lorang', 'Simpson', 'Flanders', 'Krabappel', 'Skinner', 'Smithers', 'Bouvier', 'Van Houten']
+CITIES = [
+    ('Boulder', 'Colorado', 'CO'), ('Denver', 'Colorado', 'CO'), ('Austin', 'Texas', 'TX'),
+    ('Portland', 'Oregon', 'OR'), ('Chicago', 'Illinois', 'IL'), ('Seattle', 'Washington', 'WA')
+]
+NETWORKS = [
+    ('twitter', 'Twitter'), ('facebook', 'Facebook'), ('linkedin', 'LinkedIn'), ('github', 'GitHub'),
+    ('klout', 'Klout'), ('gravatar', 'Gravatar'), ('foursquare', 'Foursquare'), ('angellist', 'AngelList')
+]
+TOPICS = ['Entrepreneurship', 'Startups', 'Technology', 'Denver', 'Beer', 'Skiing', 'Venture Capital', 'APIs']
+COMPANIES = ['FullContact', 'Rally Software', 'Techstars', 'Sphere Source', 'Keane', 'Dimension Data']
+TITLES = ['CEO', 'Co-Founder', 'Engineer', 'Director', 'Board Member', 'Advisor']
+
+
+def _md5(text):
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+class SyntheticProfiles(object):
+    """
+    Generates FullContact Person API responses shaped like the bart.json
+    samples (dictionary style), for benchmarks and offline testing.
+
+    Profiles are deterministic: the same seed, email and size always produce
+    the same response, so runs can be compared with each other.
+    """
+
+    def __init__(self, seed=0):
+        self.seed = seed
+
+    def _rng(self, email):
+        digest = _md5(u'{}:{}'.format(self.seed, email))
+        return random.Random(int(digest[:16], 16))
+
+    def person(self, email, size='medium', request_id=None):
+        """ Build a successful Person API response for an email
+
+        @param email: Email the response is for
+        @param size: One of the keys of PROFILE_SIZES
+        @param request_id: Request id to put in the response, defaults to one
+            derived from the email
+        @return: tortilla response
+        """
+        counts = PROFILE_SIZES[size]
+        rng = self._rng(email)
+
+        given_name, family_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        city, state, state_code = rng.choice(CITIES)
+        age_min = rng.choice([18, 25, 35, 45, 55])
+        handle = '{}{}'.format(given_name, family_name).lower().replace(' ', '')
+
+        social_profiles = {}
+        for i in range(counts['social_profiles']):
+            type_id, type_name = NETWORKS[i % len(NETWORKS)]
+            social_profiles.setdefault(type_id, []).append({
+                'typeId': type_id,
+                'typeName': type_name,
+                'id': str(rng.randint(10 ** 5, 10 ** 9)),
+                'username': handle if i < len(NETWORKS) else '{}{}'.format(handle, i),
+                'url': 'https://{}.com/{}'.format(type_id, handle),
+                'bio': 'Synthetic {} profile for {}'.format(type_name, email),
+                'followers': rng.randint(0, 50000),
+                'following': rng.randint(0, 2000),
+                'rss': 'https://{}.com/{}/feed'.format(type_id, handle)
+            })
+
+        return bunchify({
+            'status': 200,
+            'requestId': request_id or _md5(email),
+            'likelihood': round(rng.uniform(0.5, 1.0), 2),
+            'contactInfo': {
+                'givenName': given_name,
+                'familyName': family_name,
+                'fullName': '{} {}'.format(given_name, family_name),
+                'websites': [{'url': 'http://{}{}.example.com'.format(handle, i)} for i in range(counts['websites'])]
+            },
+            'organizations': [
+                {
+                    'name': rng.choice(COMPANIES),
+                    'title': rng.choice(TITLES),
+                    'startDate': '{}-{:02d}'.format(rng.randint(1995, 2015), rng.randint(1, 12)),
+                    'current': i == 0,
+                    'isPrimary': i == 0
+                }
+                for i in range(counts['organizations'])
+            ],
+            'demographics': {
+                'locationGeneral': '{}, {}, United States'.format(city, state),
+                'locationDeduced': {
+                    'normalizedLocation': '{}, {}, United States'.format(city, state),
+                    'city': {'deduced': False, 'name': city},
+                    'state': {'deduced': False, 'name': state, 'code': state_code},
+                    'country': {'deduced': False, 'name': 'United States', 'code': 'US'},
+                    'continent': {'deduced': True, 'name': 'North America'},
+                    'likelihood': round(rng.uniform(0.5, 1.0), 2)
+                },
+                'gender': rng.choice(['Male', 'Female']),
+                'age': str(age_min + rng.randint(0, 9)),
+                'ageRange': '{}-{}'.format(age_min, age_min + 9)
+            },
+            'socialProfiles': social_profiles,
+            'digitalFootprint': {
+                'scores': {'klout': [
+                    {'provider': 'klout', 'type': 'general', 'value': rng.randint(10, 90)}
+                    for _ in range(counts['scores'])
+                ]},
+                'topics': {'klout': [
+                    {'provider': 'klout', 'value': TOPICS[i % len(TOPICS)]}
+                    for i in range(counts['topics'])
+                ]}
+            }
+        })
+
+    def failure(self, email, status, request_id=None):
+        """ Build a failed Person API response
+
+        @param email: Email the response is for
+        @param status: HTTP status of the failure
+        @param request_id: Request id to put in the response
+        @return: tortilla response
+        """
+        messages = {
+            202: 'Queued for search. Please retry your query within the next 2 minutes.',
+            403: 'Usage limits for the provided API Key have been exceeded.',
+            404: 'Searched within last 24 hours. No results found for this Id.',
+            500: 'An unexpected error occurred.'
+        }
+        return bunchify({
+            'status': status,
+            'message': messages.get(status, 'Request failed.'),
+            'requestId': request_id or _md5(u'{}:{}'.format(email, status))
+        })
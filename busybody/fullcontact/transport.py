@@ -0,0 +1,135 @@
+import logging
+import sys
+import threading
+from Queue import Queue
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ..utils.concurrency import Future
+
+logger = logging.getLogger(__name__)
+
+# marker telling a worker thread to exit
+_STOP = object()
+
+
+class HttpTransport(object):
+    """
+    Shared, sized pool of keep-alive HTTP connections for the FullContact client.
+
+    Every request made through the transport reuses a connection from one
+    requests Session, so only the first request to a host pays for the TCP and
+    TLS handshakes. The pool is blocking: when all `pool_size` connections are
+    busy, callers wait for one to come back instead of opening (and then
+    throwing away) an extra connection. Requests ask for gzip bodies and always
+    have connect and read timeouts. request() raises requests.Timeout or
+    ConnectionError when one runs out; FullContact.get_person returns those as
+    a failed lookup with status 503 instead.
+
+    A transport is safe to share between threads, and between FullContact
+    objects; give every FullContact talking to the same host the same transport
+    so they share its connections. submit() runs a call on the transport's own
+    worker threads and returns a Future, for callers that can't block.
+
+    transport = HttpTransport(pool_size=32, read_timeout=10)
+    api = FullContact(fc_key, transport=transport)
+    """
+
+    def __init__(self, pool_size=16, connect_timeout=3.05, read_timeout=30, max_retries=0, gzip=True):
+        """ Create a connection pool.
+
+        @param pool_size: Maximum number of connections kept open per host, and
+            the number of requests that can be in flight at once
+        @param connect_timeout: Seconds to wait for a connection to be established
+        @param read_timeout: Seconds to wait between bytes of the response
+        @param max_retries: Number of times to retry requests that failed to
+            connect. Requests that reached the server are never retried.
+        @param gzip: Whether to ask for compressed responses
+        @return: None
+        """
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=max_retries, pool_block=True)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'Accept-Encoding': 'gzip, deflate' if gzip else 'identity',
+            'Connection': 'keep-alive'
+        })
+
+        self._queue = None
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def request(self, method, url, **kwargs):
+        """ Send a request over a pooled connection
+
+        @param method: HTTP method
+        @param url: URL to request
+        @param kwargs: Options passed to requests.Session.request
+        @return: requests.Response
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def submit(self, func, *args, **kwargs):
+        """ Run a call on the transport's worker threads
+
+        @param func: Callable to run, typically one making requests through this transport
+        @param args: Positional arguments for func
+        @param kwargs: Keyword arguments for func
+        @return: Future resolving to the result of the call
+        """
+        self._start_workers()
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def _start_workers(self):
+        with self._lock:
+            if self._queue is not None:
+                return
+            self._queue = Queue()
+            for i in range(self.pool_size):
+                worker = threading.Thread(target=self._work, name='busybody-http-{}'.format(i))
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+
+            future, func, args, kwargs = item
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception:
+                future.set_exception(sys.exc_info())
+
+    def close(self):
+        """ Stop the worker threads once queued calls are done, and close every pooled connection
+
+        @return: None
+        """
+        with self._lock:
+            if self._queue is not None:
+                for _ in self._workers:
+                    self._queue.put(_STOP)
+                for worker in self._workers:
+                    worker.join()
+                self._queue, self._workers = None, []
+        self.session.close()
@@ -1,5 +1,22 @@
 # busybody.utils
 
-from parsers import *
-from data_structures import *
-from colors import *
+from lazy import lazy_exports
+
+lazy_exports(__name__, {
+    'EMAIL_RE': '.parsers',
+    'EmailParser': '.parsers',
+    'YamlConfigParser': '.parsers',
+    'EmailCanonicalizer': '.canonical',
+    'EmailDeduplicator': '.canonical',
+    'SeekableDict': '.data_structures',
+    'BloomFilter': '.data_structures',
+    'chunked': '.data_structures',
+    'Colors': '.colors',
+    'bounded_imap': '.concurrency',
+    'Future': '.concurrency',
+    'FutureTimeout': '.concurrency',
+    'MetricsRegistry': '.metrics',
+    'REGISTRY': '.metrics',
+    'serve_metrics': '.metrics',
+    'SnapshotWriter': '.metrics',
+})
@@ -0,0 +1,169 @@
+import logging
+
+import unicodecsv as csv
+
+logger = logging.getLogger(__name__)
+
+# Mailbox providers whose address rules are documented well enough to fold
+# spellings together:
+#
+#   - domain:        the domain the provider's aliases resolve to
+#   - ignore_dots:   dots in the local part are not significant
+#   - tag_separator: everything after this character in the local part is a
+#                    tag delivered to the same mailbox
+PROVIDERS = {
+    'gmail.com': dict(domain='gmail.com', ignore_dots=True, tag_separator='+'),
+    'googlemail.com': dict(domain='gmail.com', ignore_dots=True, tag_separator='+'),
+    'outlook.com': dict(tag_separator='+'),
+    'hotmail.com': dict(tag_separator='+'),
+    'live.com': dict(tag_separator='+'),
+    'icloud.com': dict(tag_separator='+'),
+    'me.com': dict(tag_separator='+'),
+    'fastmail.com': dict(tag_separator='+'),
+    'protonmail.com': dict(tag_separator='+'),
+    'proton.me': dict(tag_separator='+'),
+}
+
+
+class EmailCanonicalizer(object):
+    """
+    Reduces the spellings of an address to one canonical form, so that
+    Bart@X.com and ' bart@x.com' are looked up once.
+
+    Addresses are always trimmed and lowercased. The rules in `providers` are
+    applied to their domains, e.g. B.Art+news@googlemail.com becomes
+    bart@gmail.com. Plus tags on other domains are only stripped with
+    strip_tags, since a server is free to treat them as different mailboxes.
+    """
+
+    def __init__(self, strip_tags=False, providers=PROVIDERS):
+        """ Configure the canonical form
+
+        @param strip_tags: Strip '+tag' from the local part of every address
+        @param providers: dict of domain to provider rules, as PROVIDERS; None to apply none
+        @return: None
+        """
+        self.strip_tags = strip_tags
+        self.providers = providers or {}
+
+    def __call__(self, email):
+        """ Canonicalize an address
+
+        @param email: Address, as read from the input
+        @return: canonical address
+        """
+        email = email.strip().lower()
+        local, _, domain = email.rpartition('@')
+        if not local:
+            return email
+
+        rule = self.providers.get(domain)
+        if rule is not None:
+            local = self._strip_tag(local, rule.get('tag_separator'))
+            if rule.get('ignore_dots'):
+                local = local.replace('.', '') or local
+            domain = rule.get('domain', domain)
+        if self.strip_tags:
+            local = self._strip_tag(local, '+')
+        return local + '@' + domain
+
+    @staticmethod
+    def _strip_tag(local, separator):
+        # an address that starts with the separator has no name left to keep
+        if separator and separator in local[1:]:
+            return local[:local.index(separator, 1)]
+        return local
+
+
+class EmailDeduplicator(object):
+    """
+    Drops the repeats of an address from a stream of emails, after
+    canonicalization, and remembers every spelling that was folded into each
+    canonical address so results can be mapped back to the input.
+
+    Each email costs one canonicalization and one dict lookup. The spellings
+    of an address are kept as a plain string until a second one shows up.
+    """
+
+    def __init__(self, canonicalize=None):
+        """ Start an empty deduplicator
+
+        @param canonicalize: Function returning the canonical form of an email,
+            defaults to an EmailCanonicalizer with its default rules
+        @return: None
+        """
+        self.canonicalize = canonicalize or EmailCanonicalizer()
+        self.duplicates = 0
+        self._spellings = {}
+
+    def __len__(self):
+        return len(self._spellings)
+
+    def __contains__(self, email):
+        return self.canonicalize(email) in self._spellings
+
+    def add(self, email):
+        """ Record an email
+
+        @param email: Email as read from the input
+        @return: its canonical address the first time the address is seen, None for a repeat
+        """
+        canonical = self.canonicalize(email)
+        spellings = self._spellings.get(canonical)
+        if spellings is None:
+            self._spellings[canonical] = email
+            return canonical
+
+        self.duplicates += 1
+        if isinstance(spellings, list):
+            if email not in spellings:
+                spellings.append(email)
+        elif spellings != email:
+            self._spellings[canonical] = [spellings, email]
+        return None
+
+    def dedupe(self, emails):
+        """ Yield the canonical address of every email that was not seen before
+
+        @param emails: Iterable of emails
+        @return: generator of canonical addresses
+        """
+        for email in emails:
+            canonical = self.add(email)
+            if canonical is not None:
+                yield canonical
+
+    def spellings(self, canonical):
+        """ Every spelling of an address seen in the input
+
+        @param canonical: Canonical address
+        @return: list of emails, in the order they were first seen
+        """
+        spellings = self._spellings.get(canonical, [])
+        return list(spellings) if isinstance(spellings, list) else [spellings]
+
+    def iter_spellings(self):
+        """ Pair every spelling seen with its canonical address
+
+        @return: generator of (email, canonical address) tuples
+        """
+        for canonical, spellings in self._spellings.iteritems():
+            for email in (spellings if isinstance(spellings, list) else [spellings]):
+                yield email, canonical
+
+    def write_aliases(self, outf_path):
+        """ Write a CSV mapping every spelling seen to the canonical address it was looked up as
+
+        @param outf_path: Path of the CSV file
+        @return: int, number of rows written
+        """
+        rows = 0
+        with open(outf_path, 'wb') as outf:
+            writer = csv.writer(outf)
+            writer.writerow(['email', 'canonical_email'])
+            for row in self.iter_spellings():
+                writer.writerow(row)
+                rows += 1
+
+        logger.info('Wrote {} email spellings to {}'.format(rows, outf_path))
+        return rows
@@ -0,0 +1,157 @@
+import sys
+import threading
+from Queue import Queue, Full, Empty
+
+# marker placed on the queues to signal that a producer has finished
+_DONE = object()
+
+# how long blocked threads wait before re-checking whether they were cancelled
+_POLL_INTERVAL = 0.1
+
+
+def _put(queue, item, cancelled):
+    """ Put an item on a bounded queue, giving up if the pipeline is cancelled
+
+    @param queue: Queue to put the item on
+    @param item: Item to enqueue
+    @param cancelled: threading.Event set when the consumer has gone away
+    @return: bool, whether the item was enqueued
+    """
+    while not cancelled.is_set():
+        try:
+            queue.put(item, timeout=_POLL_INTERVAL)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def bounded_imap(func, iterable, concurrency=4, backlog=None):
+    """ Apply func to every item of iterable on a pool of worker threads and yield
+    (item, result) tuples in the order they complete.
+
+    Both the input and the output of the pool are bounded queues, so at most
+    `backlog` items are read ahead of the workers and at most `backlog` results
+    wait for the consumer. A slow consumer therefore stalls the workers, and slow
+    workers stall reading from `iterable`. An exception raised by func or by the
+    input iterable stops the pool and is re-raised to the consumer.
+
+    @param func: Callable taking a single item
+    @param iterable: Items to process; consumed lazily from a feeder thread
+    @param concurrency: Number of worker threads
+    @param backlog: Maximum number of queued inputs and outputs. Defaults to
+        twice the concurrency.
+    @return: generator of (item, result) tuples
+    """
+    if concurrency < 1:
+        raise ValueError('concurrency must be at least 1')
+
+    backlog = backlog or concurrency * 2
+    inbox = Queue(maxsize=backlog)
+    outbox = Queue(maxsize=backlog)
+    cancelled = threading.Event()
+
+    def feed():
+        try:
+            for item in iterable:
+                if not _put(inbox, item, cancelled):
+                    return
+        except Exception:
+            _put(outbox, (None, None, sys.exc_info()), cancelled)
+        for _ in range(concurrency):
+            _put(inbox, _DONE, cancelled)
+
+    def work():
+        while not cancelled.is_set():
+            try:
+                item = inbox.get(timeout=_POLL_INTERVAL)
+            except Empty:
+                continue
+            if item is _DONE:
+                break
+            try:
+                result = (item, func(item), None)
+            except Exception:
+                result = (item, None, sys.exc_info())
+            _put(outbox, result, cancelled)
+        _put(outbox, _DONE, cancelled)
+
+    threads = [threading.Thread(target=feed, name='bounded-imap-feeder')]
+    threads.extend(
+        threading.Thread(target=work, name='bounded-imap-worker-{}'.format(i))
+        for i in range(concurrency)
+    )
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    try:
+        finished = 0
+        while finished < concurrency:
+            result = outbox.get()
+            if result is _DONE:
+                finished += 1
+                continue
+
+            item, value, exc_info = result
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield item, value
+    finally:
+        # stops the feeder and workers if the consumer bails out early or an
+        # exception was raised, letting in-flight calls finish first. the feeder
+        # is not joined since it may be blocked reading from the input.
+        cancelled.set()
+        for t in threads[1:]:
+            t.join()
+
+
+class FutureTimeout(Exception):
+    """ Raised when waiting on a Future times out """
+
+
+class Future(object):
+    """
+    Placeholder for the result of work done on another thread. The thread doing
+    the work calls set_result or set_exception exactly once; any other thread
+    can wait on result().
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exc_info):
+        """ Store an exception raised by the work
+
+        @param exc_info: Tuple returned by sys.exc_info()
+        @return: None
+        """
+        self._exc_info = exc_info
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def exception(self, timeout=None):
+        self.wait(timeout)
+        return self._exc_info[1] if self._exc_info else None
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise FutureTimeout('Result not available after {} seconds'.format(timeout))
+
+    def result(self, timeout=None):
+        """ Wait for the work to finish and return its result, re-raising its exception if it failed
+
+        @param timeout: Seconds to wait, or None to wait forever
+        @return: result of the work
+        """
+        self.wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
@@ -1,3 +1,7 @@
+import hashlib
+import math
+import struct
+
 
 class SeekableDict(dict):
     """
@@ -46,3 +50,52 @@ class SeekableDict(dict):
                 pass
 
         dict.__setitem__(self, keys, value)
+
+
+def chunked(iterable, size):
+    """ Split an iterable into lists of at most `size` items
+
+    @param iterable: Iterable to split
+    @param size: Maximum number of items per chunk
+    @return: generator of lists
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class BloomFilter(object):
+    """
+    Space-efficient probabilistic set. Membership tests never give false
+    negatives, and give false positives at roughly `error_rate` once `capacity`
+    items have been added.
+
+    bf = BloomFilter(capacity=1000000, error_rate=0.001)
+    bf.add('bart@fullcontact.com')
+    'bart@fullcontact.com' in bf  # True
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(1, capacity)
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(float(self.num_bits) / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, item):
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        # derive all hash positions from two 64-bit halves of one digest (Kirsch-Mitzenmacher)
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(item).digest())
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
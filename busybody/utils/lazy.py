@@ -0,0 +1,53 @@
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a package whose exported names are imported on first use.
+
+    Importing the package then costs only the package itself; a name such as
+    busybody.SqliteConnector pulls in its submodule, and with it peewee, the
+    first time it is looked up. `from package import *` still imports
+    everything listed in the exports.
+    """
+
+    def __init__(self, module, exports):
+        """ Wrap a package
+
+        @param module: The package module being replaced
+        @param exports: dict of exported name to the module defining it,
+            relative to the package (e.g. '.database.sqlite_db')
+        @return: None
+        """
+        super(LazyModule, self).__init__(module.__name__, module.__doc__)
+        self.__dict__.update(module.__dict__)
+        self.__all__ = sorted(exports)
+        # python 2 clears a module's globals once the module object is freed
+        self._wrapped = module
+        self._exports = exports
+
+    def __getattr__(self, name):
+        try:
+            source = self._exports[name]
+        except KeyError:
+            raise AttributeError("'module' object has no attribute '{}'".format(name))
+
+        value = getattr(importlib.import_module(source, self.__name__), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(self._exports))
+
+
+def lazy_exports(name, exports):
+    """ Replace a package in sys.modules with a LazyModule; called at the end of its __init__
+
+    @param name: __name__ of the package
+    @param exports: dict of exported name to the module defining it, relative to the package
+    @return: LazyModule
+    """
+    module = sys.modules[name] = LazyModule(sys.modules[name], exports)
+    return module
@@ -0,0 +1,306 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from contextlib import contextmanager
+from SocketServer import ThreadingMixIn
+
+logger = logging.getLogger(__name__)
+
+# upper bounds, in seconds, of the default latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    """ Value that only goes up, e.g. rows written """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in sorted(self._values.items())]
+
+    def snapshot(self):
+        with self._lock:
+            return [{'labels': dict(key), 'value': value} for key, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    """ Value that goes up and down, e.g. requests in flight """
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    @contextmanager
+    def track(self, **labels):
+        """ Count the block as in progress while it runs """
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    """ Distribution of observed values, e.g. request latency """
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """ Observe how long the block takes, in seconds """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def count(self, **labels):
+        counts, _ = self._values.get(_label_key(labels), ([0], 0.0))
+        return sum(counts)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    samples.append((self.name + '_bucket', key + (('le', str(bound)),), cumulative))
+                samples.append((self.name + '_sum', key, total))
+                samples.append((self.name + '_count', key, cumulative))
+        return samples
+
+    def snapshot(self):
+        with self._lock:
+            return [
+                {
+                    'labels': dict(key),
+                    'count': sum(counts),
+                    'sum': total,
+                    'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], counts))
+                }
+                for key, (counts, total) in sorted(self._values.items())
+            ]
+
+
+class MetricsRegistry(object):
+    """
+    Collection of named counters, gauges and histograms.
+
+    Metrics are created on first use and shared by name afterwards, so every
+    component can ask the registry for the metric it reports into. The
+    registry renders as Prometheus text, or as a JSON snapshot.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, **kwargs)
+            elif type(metric) is not cls:
+                raise ValueError('Metric {} is already registered as a {}'.format(name, metric.kind))
+            return metric
+
+    def counter(self, name, help=''):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help=''):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def clear(self):
+        """ Reset every metric to zero, keeping the registrations
+
+        @return: None
+        """
+        for metric in self._metrics.values():
+            metric.clear()
+
+    def render_prometheus(self):
+        """ Render every metric in the Prometheus text exposition format
+
+        @return: str
+        """
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            lines.append('# HELP {} {}'.format(name, metric.help))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            for sample_name, key, value in metric.samples():
+                lines.append('{}{} {}'.format(sample_name, _format_labels(key), repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """ Return the current value of every metric as plain data
+
+        @return: dict
+        """
+        return {
+            'timestamp': time.time(),
+            'metrics': dict(
+                (name, {'type': metric.kind, 'help': metric.help, 'values': metric.snapshot()})
+                for name, metric in self._metrics.items()
+            )
+        }
+
+    def write_snapshot(self, path):
+        """ Write a JSON snapshot, replacing the file atomically
+
+        @param path: File to write
+        @return: None
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as outf:
+            json.dump(self.snapshot(), outf, indent=2, sort_keys=True)
+        os.rename(tmp_path, path)
+
+
+# registry the busybody components report into
+REGISTRY = MetricsRegistry()
+
+
+class _MetricsHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics.json':
+            payload, content_type = json.dumps(self.server.registry.snapshot()), 'application/json'
+        else:
+            payload, content_type = self.server.registry.render_prometheus(), 'text/plain; version=0.0.4'
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, fmt, *args):
+        logger.debug('{} {}'.format(self.address_string(), fmt % args))
+
+
+def serve_metrics(port=9102, host='0.0.0.0', registry=REGISTRY):
+    """ Serve the registry over HTTP on a background thread
+
+    GET /metrics returns Prometheus text and GET /metrics.json a JSON snapshot.
+
+    @param port: Port to listen on
+    @param host: Address to listen on
+    @param registry: MetricsRegistry to serve
+    @return: HTTPServer; call shutdown() on it to stop serving
+    """
+    httpd = _MetricsHTTPServer((host, port), _MetricsHandler)
+    httpd.registry = registry
+
+    thread = threading.Thread(target=httpd.serve_forever, name='busybody-metrics')
+    thread.daemon = True
+    thread.start()
+    logger.info('Serving metrics on http://{}:{}/metrics'.format(host, httpd.server_address[1]))
+    return httpd
+
+
+class SnapshotWriter(object):
+    """ Writes a JSON snapshot of a registry every `interval` seconds until stopped """
+
+    def __init__(self, path, interval=60, registry=REGISTRY):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='busybody-metrics-snapshot')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def stop(self):
+        """ Stop the writer and write one last snapshot
+
+        @return: None
+        """
+        self._stopped.set()
+        self._thread.join()
+        self.registry.write_snapshot(self.path)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.registry.write_snapshot(self.path)
+            except (IOError, OSError), e:
+                logger.error('Failed to write metrics snapshot to {}: {}'.format(self.path, e))
+
+
+# metrics reported by the enrichment pipeline
+API_LATENCY = REGISTRY.histogram('busybody_api_request_seconds', 'FullContact Person API request latency, by response status')
+API_IN_FLIGHT = REGISTRY.gauge('busybody_api_requests_in_flight', 'FullContact Person API requests waiting for a response')
+RATE_LIMIT_WAIT = REGISTRY.histogram('busybody_rate_limit_wait_seconds', 'Time requests were held by the rate limiter')
+CACHE_LOOKUPS = REGISTRY.counter('busybody_cache_lookups_total', 'Response cache lookups, by result')
+PARSE_LATENCY = REGISTRY.histogram('busybody_parse_seconds', 'Time spent turning a Person API response into rows')
+DB_WRITE_LATENCY = REGISTRY.histogram('busybody_db_write_seconds', 'Database write latency, by table')
+ROWS_WRITTEN = REGISTRY.counter('busybody_db_rows_written_total', 'Rows written to the database, by table')
+RETRY_QUEUE_DEPTH = REGISTRY.gauge('busybody_retry_queue_depth', 'Failed lookups that are due to be retried')
+PERSONS_PROCESSED = REGISTRY.histogram('busybody_process_person_seconds', 'End to end time to look up and store a person, by response status')
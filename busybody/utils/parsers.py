@@ -1,13 +1,18 @@
+import gzip
+import json
 import logging
+import os
 import re
 import sys
 import unicodecsv as csv
-import yaml
 
 from colors import Colors
+from data_structures import chunked
 
 logger = logging.getLogger(__name__)
 
+EMAIL_RE = re.compile(r"^[A-Za-z0-9\.\+_-]+@[A-Za-z0-9\._-]+\.[a-zA-Z]*$")
+
 
 class YamlConfigParser:
 
@@ -18,6 +23,9 @@ class YamlConfigParser:
         @param fname: Path to config file
         @return: dict
         """
+        # yaml is only needed by the commands that read a config file
+        import yaml
+
         logger.info('Reading configuration settings from {}'.format(fname))
         try:
             with open(fname, 'r') as inf:
@@ -32,6 +40,14 @@ class YamlConfigParser:
 
 class EmailParser:
 
+    # file extensions recognized by iter_emails, mapped to their format
+    formats = {
+        '.csv': 'csv',
+        '.txt': 'csv',
+        '.jsonl': 'jsonl',
+        '.ndjson': 'jsonl'
+    }
+
     @staticmethod
     def is_valid(email):
         """ Ensure that an email is valid, according to a simple regex
@@ -39,14 +55,167 @@ class EmailParser:
         @param email: email to validate
         @return: bool
         """
-        return re.match(r"^[A-Za-z0-9\.\+_-]+@[A-Za-z0-9\._-]+\.[a-zA-Z]*$", email)
+        return EMAIL_RE.match(email)
 
     @classmethod
-    def read_emails(cls, fname):
+    def read_emails(cls, fname, column='email'):
         """ Read and validate a file containing emails to match against the FullContact API
 
         @param fname: file containing a column named 'email'
+        @param column: name of the column holding the email
         @return: list
         """
-        with open(fname, 'rU') as inf:
-            return [r['email'] for r in csv.DictReader(inf) if EmailParser.is_valid(r['email'])]
+        return list(cls.iter_emails(fname, column=column))
+
+    @classmethod
+    def iter_emails(cls, fname, column='email', fmt=None):
+        """ Lazily read and validate emails from a file, without loading it into memory
+
+        CSV and JSON Lines files are supported, either plain or gzipped. The format
+        is taken from the file extension (ignoring a trailing .gz) unless `fmt` is
+        given. Pass '-' as the file name to read from stdin. A CSV file without
+        the column raises ValueError; rows whose email is missing, invalid or not
+        a string are skipped and counted in a warning.
+
+        @param fname: Path of the file, or '-' for stdin
+        @param column: Name of the CSV column or JSON key holding the email
+        @param fmt: One of 'csv' or 'jsonl', overriding the file extension
+        @return: generator of emails
+        """
+        fmt = fmt or cls.guess_format(fname)
+        if fmt not in ('csv', 'jsonl'):
+            raise ValueError('Unsupported input format {}'.format(fmt))
+
+        inf = cls._open(fname)
+        try:
+            if fmt == 'csv':
+                rows = csv.DictReader(inf)
+                if column not in (rows.fieldnames or []):
+                    raise ValueError('{} has no {} column'.format(fname, column))
+            else:
+                rows = cls._iter_json_lines(inf)
+
+            invalid = 0
+            for row in rows:
+                email = cls._email_value(row.get(column))
+                if email and EmailParser.is_valid(email):
+                    yield email
+                else:
+                    invalid += 1
+
+            if invalid:
+                logger.warn(Colors.WARNING + '  Skipped {} rows without a valid email in {}'.format(invalid, fname) + Colors.ENDC)
+        finally:
+            if inf is not sys.stdin:
+                inf.close()
+
+    @classmethod
+    def iter_email_offsets(cls, fname, column='email', fmt=None, start=0):
+        """ Read and validate emails along with the byte offset just past each row
+
+        Rows are read a line at a time so the file position is always known,
+        which lets a reader pick up at a saved offset with a single seek. CSV
+        rows therefore can't contain quoted line breaks. Gzipped files are
+        supported, but seeking in them decompresses everything before `start`.
+
+        @param fname: Path of the file
+        @param column: Name of the CSV column or JSON key holding the email
+        @param fmt: One of 'csv' or 'jsonl', overriding the file extension
+        @param start: Offset to start reading from, as yielded by an earlier read
+        @return: generator of (offset, email) tuples
+        """
+        fmt = fmt or cls.guess_format(fname)
+        if fmt not in ('csv', 'jsonl'):
+            raise ValueError('Unsupported input format {}'.format(fmt))
+        if fname == '-':
+            raise ValueError('Offsets can not be read from stdin')
+
+        inf = gzip.open(fname, 'rb') if fname.lower().endswith('.gz') else open(fname, 'rb')
+        try:
+            if fmt == 'csv':
+                header = next(csv.reader([inf.readline()]), [])
+                if column not in header:
+                    raise ValueError('{} has no {} column'.format(fname, column))
+                index = header.index(column)
+            if start:
+                inf.seek(start)
+
+            invalid = 0
+            while True:
+                line = inf.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+
+                if fmt == 'csv':
+                    row = next(csv.reader([line]), [])
+                    email = row[index] if len(row) > index else ''
+                else:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        row = None
+                    email = row.get(column) if isinstance(row, dict) else ''
+
+                email = cls._email_value(email)
+                if email and EmailParser.is_valid(email):
+                    yield inf.tell(), email
+                else:
+                    invalid += 1
+
+            if invalid:
+                logger.warn(Colors.WARNING + '  Skipped {} rows without a valid email in {}'.format(invalid, fname) + Colors.ENDC)
+        finally:
+            inf.close()
+
+    @classmethod
+    def iter_email_chunks(cls, fname, chunk_size=1000, **kwargs):
+        """ Lazily read and validate emails from a file in lists of at most chunk_size
+
+        @param fname: Path of the file, or '-' for stdin
+        @param chunk_size: Maximum number of emails per chunk
+        @param kwargs: Options passed to iter_emails
+        @return: generator of lists of emails
+        """
+        return chunked(cls.iter_emails(fname, **kwargs), chunk_size)
+
+    @classmethod
+    def guess_format(cls, fname):
+        """ Guess the format of an input file from its extension
+
+        @param fname: Path of the file
+        @return: str
+        """
+        root, ext = os.path.splitext(fname.lower())
+        if ext == '.gz':
+            root, ext = os.path.splitext(root)
+        return cls.formats.get(ext, 'csv')
+
+    @staticmethod
+    def _email_value(value):
+        # a JSON row can hold anything under the key; only a string can be an email
+        if not isinstance(value, basestring):
+            return ''
+        return value.strip()
+
+    @staticmethod
+    def _open(fname):
+        if fname == '-':
+            return sys.stdin
+        if fname.lower().endswith('.gz'):
+            return gzip.open(fname, 'rb')
+        return open(fname, 'rU')
+
+    @staticmethod
+    def _iter_json_lines(inf):
+        for line_number, line in enumerate(inf, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                logger.warn(Colors.WARNING + '  Skipping malformed JSON on line {}'.format(line_number) + Colors.ENDC)
+                continue
+            if isinstance(row, dict):
+                yield row
@@ -2,7 +2,8 @@ import logging
 import os
 import argparse
 
-from busybody import Colors
+from busybody import Colors, SqliteConnector
+from busybody.database import ProfiledSqliteDatabase, PROFILES
 from busybody.database.models import *
 
 # configure logging
@@ -26,31 +27,36 @@ if __name__ == '__main__':
     # parse command-line arguments
     parser = argparse.ArgumentParser(description='Initialize a busybody project database')
     parser.add_argument('-f', '--force', action='store_true', help='Remove an existing database ')
+    parser.add_argument('-u', '--upgrade', action='store_true', help='Add new columns and indexes to an existing database')
+    parser.add_argument('--defer-indexes', action='store_true', help='Create the tables without their secondary indexes, for a first bulk load')
+    parser.add_argument('--build-indexes', action='store_true', help='Build the secondary indexes left out by --defer-indexes once the load is done')
+    parser.add_argument('-p', '--profile', choices=sorted(PROFILES), default='safe', help='Sqlite performance profile to set up the database with')
     args = parser.parse_args()
 
     # check whether we can safely configure the database
     logger.info('Configuring BusyBody database...')
 
     # execute database setup
-    if os.path.exists('busybody.sqlite') and not args.force:
+    if args.build_indexes:
+        logger.info('Building busybody indexes')
+        SqliteConnector('busybody.sqlite', profile=args.profile).rebuild_secondary_indexes()
+    elif args.upgrade:
+        logger.info('Upgrading busybody database')
+        SqliteConnector('busybody.sqlite', profile=args.profile).upgrade_schema()
+        logger.info(Colors.OKGREEN + 'SUCCESS: Upgraded busybody database' + Colors.ENDC)
+    elif os.path.exists('busybody.sqlite') and not args.force:
         logger.error(Colors.FAIL + 'FAILURE: The busybody database is already initialized. Run this script with -f to force database setup' + Colors.ENDC)
     else:
         if os.path.exists('busybody.sqlite'):
             logger.warn(Colors.WARNING + 'WARNING: An existing busybody database will be overwritten' + Colors.ENDC)
             os.remove('busybody.sqlite')
 
-        db = SqliteDatabase('busybody.sqlite', threadlocals=True)
+        db = ProfiledSqliteDatabase('busybody.sqlite', profile=args.profile, threadlocals=True)
         db_proxy.initialize(db)
         logger.info('Creating busybody database')
         db.connect()
-        db.create_tables([
-            User,
-            UserAddress,
-            UserDemography,
-            UserProfile,
-            UserTopic,
-            UserOrganization,
-            UserModelScore,
-            FailureLog
-        ])
+        db.create_tables(MODELS)
+        if args.defer_indexes:
+            SqliteConnector('busybody.sqlite', profile=args.profile).drop_secondary_indexes()
+            logger.info('Secondary indexes deferred; run this script with --build-indexes once the data is loaded')
         logger.info(Colors.OKGREEN + 'SUCCESS: Initialized busybody database' + Colors.ENDC)
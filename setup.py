@@ -4,7 +4,7 @@ BusyBody
 
 A library for enriching user data using the FullContact API.
 """
-from setuptools import setup
+from setuptools import setup, find_packages
 
 with open('README.md', 'r') as inf:
     long_description = inf.read()
@@ -18,7 +18,10 @@ setup(
     author='Brendan Maione-Downing',
     author_email='b.maionedowning@gmail.com',
     license='MIT',
-    packages=['busybody'],
+    packages=find_packages(exclude=['tests', 'benchmarks']),
+    entry_points={
+        'console_scripts': ['busybody = busybody.cli:main']
+    },
     zip_safe=False,
     platforms='any',
     include_package_data=True,
@@ -28,6 +31,11 @@ setup(
         'unicodecsv',
         'pyyaml'
     ],
+    extras_require={
+        'mongo': ['pymongo>=3.0'],
+        'export': ['numpy', 'pyarrow'],
+        'analytics': ['numpy']
+    },
     tests_require=['nose>=1.0'],
     test_suite='nose.collector',
     classifiers=[
@@ -0,0 +1,41 @@
+import logging
+import argparse
+import time
+
+from busybody import Colors
+from busybody.fullcontact import StandInServer, lognormal_latency
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the FullContact Person API')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=0.0, help='Median response latency in seconds')
+    parser.add_argument('--sigma', type=float, default=0.5, help='Spread of the lognormal latency distribution')
+    parser.add_argument('--rate-limit', type=int, default=600, help='Requests allowed per 60 second window')
+    parser.add_argument('--size', default='medium', choices=['small', 'medium', 'large'], help='Size of the synthetic profiles')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for profiles, failures and latencies')
+    for status in (202, 403, 404, 500):
+        parser.add_argument('--rate-{}'.format(status), type=float, default=0.0, help='Share of requests answered with {}'.format(status))
+    args = parser.parse_args()
+
+    server = StandInServer(
+        host=args.host,
+        port=args.port,
+        latency=lognormal_latency(args.latency, args.sigma) if args.latency else None,
+        failure_rates=dict((status, getattr(args, 'rate_{}'.format(status))) for status in (202, 403, 404, 500)),
+        rate_limit=args.rate_limit,
+        size=args.size,
+        seed=args.seed
+    )
+
+    with server:
+        logger.info(Colors.OKGREEN + 'Point FullContact at base_url={}'.format(server.base_url) + Colors.ENDC)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            logger.info('Shutting down; served {}'.format(server.stats))
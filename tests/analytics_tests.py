@@ -0,0 +1,75 @@
+import collections
+import os
+import sqlite3
+import tempfile
+
+from nose.plugins.skip import SkipTest
+from nose.tools import *
+
+from busybody.analytics import UserAnalytics
+from busybody.database import SqliteConnector
+from busybody.database.models import *
+from busybody.fullcontact.synthetic import SyntheticProfiles
+
+
+class TestUserAnalytics(object):
+    """
+    Test class for the aggregates over enriched users
+    """
+    def setup(self):
+        self.db_path = tempfile.mktemp(suffix='.sqlite')
+        self.db = SqliteConnector(self.db_path)
+        self.db.client.create_tables(MODELS)
+        self.profiles = SyntheticProfiles()
+        self.responses = [self.profiles.person('user{}@example.com'.format(i)) for i in range(40)]
+        self.db.insert_user_records(('user{}@example.com'.format(i), r) for i, r in enumerate(self.responses))
+        self.analytics = UserAnalytics(self.db)
+
+    def teardown(self):
+        self.db.client.close()
+        os.remove(self.db_path)
+
+    def numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            raise SkipTest('numpy is not installed')
+        return numpy
+
+    def test_group_counts(self):
+        states = collections.Counter(r.demographics.locationDeduced.state.code for r in self.responses)
+        assert_equal(self.analytics.users_by_country(), [('US', 40)])
+        assert_equal(dict(self.analytics.users_by_state()), dict(states))
+        assert_equal(self.analytics.users_by_state(limit=1)[0][1], max(states.values()))
+        assert_equal(dict(self.analytics.users_by_network()), {'Twitter': 40, 'Facebook': 40, 'LinkedIn': 40, 'GitHub': 40, 'website': 40})
+
+    def test_age_distribution(self):
+        self.numpy()
+        ages = [int(r.demographics.age) for r in self.responses]
+        distribution = self.analytics.age_distribution()
+        assert_equal(sum(distribution.values()), 40)
+        assert_equal(distribution[(25, 35)], len([age for age in ages if 25 <= age < 35]))
+
+    def test_follower_percentiles(self):
+        np = self.numpy()
+        percentiles = self.analytics.follower_percentiles(q=(50, 90))
+        assert_equal(list(percentiles), ['Facebook', 'GitHub', 'LinkedIn', 'Twitter'])
+        followers = [p.followers for r in self.responses for p in r.socialProfiles.twitter]
+        assert_almost_equal(percentiles['Twitter'][90], np.percentile(followers, 90))
+
+    def test_cached_until_rows_arrive(self):
+        self.numpy()
+        first = self.analytics.values(UserDemography.age)
+        assert_is(self.analytics.values(UserDemography.age), first)
+
+        self.db.insert_user_record('late@example.com', self.profiles.person('late@example.com'))
+        assert_equal(len(self.analytics.values(UserDemography.age)), 41)
+
+        # commits made through another connection invalidate the cache too
+        counts = self.analytics.users_by_country()
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('UPDATE user_address SET country_code = ? WHERE user_id = 1', ('CA',))
+        conn.commit()
+        conn.close()
+        assert_not_equal(self.analytics.users_by_country(), counts)
+        assert_equal(dict(self.analytics.users_by_country()), {'US': 40, 'CA': 1})
@@ -1,5 +1,43 @@
+import datetime
+import os
+import shutil
+import tempfile
+
+import requests
 from nose.tools import *
 
+from busybody import BusyBody, EmailDeduplicator, SqliteConnector
+from busybody.busybody import RunJournal
+from busybody.database.models import *
+from busybody.fullcontact import SyntheticProfiles
+from busybody.fullcontact.fullcontact_interface import FullContactInterface
+
+
+class CountingApi(FullContactInterface):
+    def __init__(self, fail_after=None):
+        self.profiles = SyntheticProfiles()
+        self.fail_after = fail_after
+        self.emails = []
+
+    def get_person(self, email):
+        if self.fail_after is not None and len(self.emails) >= self.fail_after:
+            raise IOError('connection reset')
+        self.emails.append(email)
+        return self.profiles.person(email, size='small')
+
+
+class FlakyApi(CountingApi):
+    def __init__(self, every):
+        CountingApi.__init__(self)
+        self.every = every
+        self.calls = 0
+
+    def get_person(self, email):
+        self.calls += 1
+        if self.calls % self.every == 0:
+            raise requests.exceptions.ReadTimeout('read timed out')
+        return CountingApi.get_person(self, email)
+
 
 class TestBusyBody(object):
     """
@@ -7,3 +45,113 @@ class TestBusyBody(object):
     """
     def test_trivial_pass(self):
         assert_equal(1, 1)
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_network_errors_are_logged_failures(self):
+        db = SqliteConnector(os.path.join(self.tmpdir, 'busybody.sqlite'))
+        db.client.create_tables(MODELS)
+        bb = BusyBody(db, FlakyApi(every=5))
+
+        results = list(bb.process_many(('user{}@example.com'.format(i) for i in range(40)), concurrency=1))
+        assert_equal(len(results), 40)
+        assert_equal(db.count_users(), 32)
+        assert_equal([row['initial_status'] for row in db.fetch_retry_queue(due_only=False)], [503] * 8)
+
+        # a retry that fails on the network again is rescheduled
+        FailureLog.update(next_attempt_dt=datetime.datetime.now() - datetime.timedelta(minutes=1)).execute()
+        bb.api = FlakyApi(every=1)
+        assert_equal(bb.retry_failures(concurrency=2), 8)
+        assert_equal(FailureLog.select().where(FailureLog.most_recent_retry_status == 503, FailureLog.retry_count == 1).count(), 8)
+
+    def test_refreshing_retry_updates_stored_user(self):
+        db = SqliteConnector(os.path.join(self.tmpdir, 'busybody.sqlite'))
+        db.client.create_tables(MODELS)
+        profiles = SyntheticProfiles()
+        db.insert_user_record('bart@example.com', profiles.person('bart@example.com', size='small'))
+        db.log_failure('bart@example.com', profiles.failure('bart@example.com', 202))
+        FailureLog.update(next_attempt_dt=datetime.datetime.now() - datetime.timedelta(minutes=1)).execute()
+        stored = User.get(User.email == 'bart@example.com').profiles.count()
+
+        bb = BusyBody(db, CountingApi(), refresh=True)
+        bb.api.get_person = lambda email: profiles.person(email, size='large')
+        assert_equal(bb.retry_failures(concurrency=1), 1)
+
+        user = User.get(User.email == 'bart@example.com')
+        assert_is_not_none(user.update_dt)
+        assert_true(user.profiles.count() > stored)
+
+
+class TestRunJournal(object):
+    """
+    Test class for journaled, resumable runs
+    """
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.input = os.path.join(self.tmpdir, 'emails.csv')
+        with open(self.input, 'w') as outf:
+            outf.write('name,email\n')
+            for i in range(20):
+                outf.write('user {0},user{0}@example.com\n'.format(i))
+            outf.write('nobody,not-an-email\n')
+
+        self.db = SqliteConnector(os.path.join(self.tmpdir, 'busybody.sqlite'))
+        self.db.client.create_tables(MODELS)
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run(self, api, resume=False, dedupe=None):
+        bb = BusyBody(self.db, api)
+        return list(bb.process_file(self.input, resume=resume, concurrency=1, dedupe=dedupe, checkpoint_every=3))
+
+    def test_resume_skips_processed_rows(self):
+        interrupted = CountingApi(fail_after=7)
+        assert_raises(IOError, self.run, interrupted)
+
+        resumed = CountingApi()
+        self.run(resumed, resume=True)
+        assert_equal(len(resumed.emails), 13)
+        assert_equal(set(interrupted.emails + resumed.emails), set('user{}@example.com'.format(i) for i in range(20)))
+        assert_equal(self.db.count_users(), 20)
+
+        # a finished run has nothing left to do
+        again = CountingApi()
+        self.run(again, resume=True)
+        assert_equal(again.emails, [])
+
+    def test_repeated_emails_looked_up_once(self):
+        with open(self.input, 'a') as outf:
+            outf.write('again,USER3@example.com\nagain, user5@Example.com \n')
+
+        api = CountingApi()
+        dedupe = EmailDeduplicator()
+        self.run(api, dedupe=dedupe)
+        assert_equal(len(api.emails), 20)
+        assert_equal(dedupe.spellings('user3@example.com'), ['user3@example.com', 'USER3@example.com'])
+
+        # the repeats count as done, so the finished journal covers every row
+        journal = RunJournal(self.input + '.journal', self.input, resume=True)
+        assert_true(journal.complete)
+        assert_equal(journal.rows_done, 22)
+
+    def test_changed_input_is_refused(self):
+        RunJournal(self.input + '.journal', self.input).close()
+        with open(self.input, 'a') as outf:
+            outf.write('late,late@example.com\n')
+        assert_raises(ValueError, RunJournal, self.input + '.journal', self.input, resume=True)
+
+    def test_torn_checkpoint_is_ignored(self):
+        journal = RunJournal(self.input + '.journal', self.input, checkpoint_every=1)
+        for offset, email in journal.pending([(30, 'a@example.com'), (60, 'b@example.com')]):
+            journal.done(offset, email)
+        with open(self.input + '.journal', 'ab') as outf:
+            outf.write('{"type": "checkpoint", "offs')
+
+        resumed = RunJournal(self.input + '.journal', self.input, resume=True)
+        assert_equal(resumed.offset, 60)
+        assert_equal(resumed.rows_done, 2)
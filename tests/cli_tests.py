@@ -0,0 +1,74 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from nose.tools import *
+
+from busybody.cli import main
+from busybody.fullcontact import StandInServer
+
+
+class TestCli(object):
+    """
+    Test class for the busybody command
+    """
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.database = self.path('busybody.sqlite')
+        with open(self.path('config.yaml'), 'w') as outf:
+            outf.write('fc_api_key: abcd1234\n')
+        with open(self.path('emails.csv'), 'w') as outf:
+            outf.write('email\n')
+            for i in range(10):
+                outf.write('user{}@example.com\n'.format(i))
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def run(self, *args):
+        return main(['-q', '--database', self.database, '--config', self.path('config.yaml')] + list(args))
+
+    def test_startup_is_lazy(self):
+        # nothing but the package and the parser should load for the command to start
+        loaded = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, busybody.cli; print(" ".join(sorted(sys.modules)))'
+        ]).split()
+        for heavy in ('peewee', 'requests', 'tortilla', 'pymongo', 'yaml'):
+            assert_not_in(heavy, loaded)
+
+    def test_ingest_export_and_stats(self):
+        with StandInServer(api_key='abcd1234', failure_rates={404: 0.3}, seed=4) as server:
+            assert_equal(self.run('--base-url', server.base_url, 'ingest', self.path('emails.csv'), '-c', '2'), 0)
+
+        assert_equal(self.run('export', 'users', self.path('users.csv')), 0)
+        with open(self.path('users.csv'), 'rb') as inf:
+            exported = len(inf.readlines()) - 1
+
+        stdout = sys.stdout
+        sys.stdout = captured = tempfile.TemporaryFile()
+        try:
+            assert_equal(self.run('stats', '--json'), 0)
+        finally:
+            sys.stdout = stdout
+        captured.seek(0)
+        counts = json.load(captured)
+        assert_equal(counts['users'], exported)
+        assert_true(0 < exported < 10)
+
+    def test_unknown_profile_is_a_usage_error(self):
+        stderr = sys.stderr
+        sys.stderr = tempfile.TemporaryFile()
+        try:
+            with assert_raises(SystemExit) as exit:
+                self.run('ingest', self.path('emails.csv'), '--profile', 'typo')
+        finally:
+            sys.stderr = stderr
+        assert_equal(exit.exception.code, 2)
+        assert_false(os.path.exists(self.database))
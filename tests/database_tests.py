@@ -0,0 +1,584 @@
+import copy
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import unicodecsv as csv
+
+from nose.tools import *
+from peewee import IntegrityError
+from tortilla.utils import bunchify
+
+from busybody.busybody import KnownEmailFilter, ShardedIngest
+from busybody.database import decompress_response, SqliteConnector, RetryPolicy, ProfiledSqliteDatabase, BatchingWriter, merge_shards, shard_for
+from busybody.database.models import *
+from busybody.fullcontact.fullcontact_interface import FullContactInterface
+from busybody.database.record_parser import parse_record, USER_COLUMNS
+from busybody.utils.metrics import ROWS_WRITTEN
+
+SAMPLE_RESPONSE = {
+    'status': 200,
+    'likelihood': 0.95,
+    'requestId': 'a1b2c3',
+    'contactInfo': {
+        'givenName': 'Bart',
+        'familyName': 'Lorang',
+        'websites': [{'url': 'http://fullcontact.com'}]
+    },
+    'demographics': {
+        'locationGeneral': 'Boulder, Colorado, United States',
+        'locationDeduced': {
+            'city': {'name': 'Boulder', 'deduced': False},
+            'state': {'name': 'Colorado', 'code': 'CO', 'deduced': False},
+            'country': {'name': 'United States', 'code': 'US', 'deduced': False},
+            'continent': {'name': 'North America', 'deduced': True},
+            'likelihood': 1.0
+        },
+        'gender': 'Male',
+        'ageRange': '25-34'
+    },
+    'organizations': [
+        {'name': 'FullContact', 'title': 'CEO', 'startDate': '2010-01', 'current': True, 'isPrimary': True}
+    ],
+    'digitalFootprint': {
+        'scores': [{'provider': 'klout', 'type': 'general', 'value': 54}],
+        'topics': [{'provider': 'klout', 'value': 'Entrepreneurship'}]
+    },
+    'socialProfiles': {
+        'twitter': [{
+            'typeId': 'twitter', 'typeName': 'Twitter', 'id': '5998422', 'url': 'https://twitter.com/bartlorang',
+            'username': 'bartlorang', 'bio': 'CEO', 'followers': 5454, 'following': 741
+        }],
+        'facebook': [{
+            'typeId': 'facebook', 'typeName': 'Facebook', 'url': 'https://facebook.com/bart.lorang',
+            'username': 'bart.lorang'
+        }]
+    }
+}
+
+
+def sample_response():
+    return copy.deepcopy(SAMPLE_RESPONSE)
+
+
+class TestRecordParser(object):
+    """
+    Test class for mapping responses onto rows
+    """
+    def test_user_row(self):
+        user_row, _ = parse_record('bart@fullcontact.com', sample_response())
+        user = dict(zip(USER_COLUMNS, user_row))
+        assert_equal(user['email'], 'bart@fullcontact.com')
+        assert_equal(user['first_name'], 'Bart')
+
+    def test_missing_sections(self):
+        _, child_rows = parse_record('nobody@example.com', bunchify({'status': 200, 'demographics': 'unexpected'}))
+        rows = dict((model, rows) for model, _, rows in child_rows)
+        assert_equal(rows[UserProfile], [])
+        assert_equal(rows[UserDemography][0][:4], (None, None, None, None))
+
+    def test_score_type(self):
+        response = sample_response()
+        response['digitalFootprint'] = {'scores': {'klout': [{'provider': 'klout', 'type': 'general', 'value': 42}]}}
+        _, child_rows = parse_record('bart@fullcontact.com', response)
+        columns, rows = [(columns, rows) for model, columns, rows in child_rows if model is UserModelScore][0]
+        assert_equal(dict(zip(columns, rows[0]))['type'], 'general')
+
+    def test_social_profile_list_style(self):
+        response = sample_response()
+        response['socialProfiles'] = [{'typeId': 'twitter', 'typeName': 'Twitter', 'username': 'bartlorang'}]
+        _, child_rows = parse_record('bart@fullcontact.com', response)
+        flat_columns, flat_rows = [(columns, rows) for model, columns, rows in child_rows if model is UserFlat][0]
+        assert_equal(dict(zip(flat_columns, flat_rows[0]))['twitter_screen_name'], 'bartlorang')
+
+
+class TestSqliteConnector(object):
+    """
+    Test class for the sqlite backend
+    """
+    def setup(self):
+        self.db = SqliteConnector(':memory:')
+        self.db.client.create_tables(MODELS)
+
+    def test_insert_user_record(self):
+        self.db.insert_user_record('bart@fullcontact.com', sample_response())
+        user = User.get(User.email == 'bart@fullcontact.com')
+        assert_equal(user.first_name, 'Bart')
+        assert_equal(user.addresses.get().state_code, 'CO')
+        assert_equal(user.demographics.get().age_range_max, 34)
+        assert_equal(user.profiles.count(), 3)
+
+    def test_insert_reports_metrics(self):
+        before = ROWS_WRITTEN.value(table='user_profile')
+        self.db.insert_user_records([('user{}@example.com'.format(i), sample_response()) for i in range(3)])
+        assert_equal(ROWS_WRITTEN.value(table='user_profile') - before, 9)
+
+    @raises(IntegrityError)
+    def test_insert_user_record_duplicate(self):
+        self.db.insert_user_record('bart@fullcontact.com', sample_response())
+        self.db.insert_user_record('bart@fullcontact.com', sample_response())
+
+    def test_dump_user_data(self):
+        self.db.insert_user_records([('user{}@example.com'.format(i), sample_response()) for i in range(25)])
+        outf_path = tempfile.mktemp(suffix='.csv')
+        try:
+            self.db.dump_user_data(outf_path, chunk_size=10)
+            with open(outf_path, 'rb') as inf:
+                rows = list(csv.DictReader(inf))
+        finally:
+            os.remove(outf_path)
+
+        assert_equal(len(rows), 25)
+        assert_equal(rows[0]['email'], 'user0@example.com')
+        assert_equal(rows[0]['twitter_screen_name'], 'bartlorang')
+        assert_equal(rows[0]['website'], 'http://fullcontact.com')
+
+    def test_dump_failures(self):
+        for i in range(5):
+            self.db.log_failure('user{}@example.com'.format(i), bunchify({'status': 404 if i % 2 else 202, 'message': 'x', 'requestId': str(i)}))
+        outf_path = tempfile.mktemp(suffix='.jsonl.gz')
+        try:
+            assert_equal(self.db.dump_failures(outf_path, chunk_size=2), 3)
+            assert_equal(self.db.dump_failures(outf_path, include_completed=True, chunk_size=2), 5)
+        finally:
+            os.remove(outf_path)
+
+    def test_rebuild_user_flat(self):
+        self.db.insert_user_records([('user{}@example.com'.format(i), sample_response()) for i in range(5)])
+        maintained = list(UserFlat.select().order_by(UserFlat.user).tuples())
+        assert_equal(self.db.rebuild_user_flat(), 5)
+        assert_equal(list(UserFlat.select().order_by(UserFlat.user).tuples()), maintained)
+
+    def test_insert_user_records(self):
+        self.db.insert_user_record('existing@example.com', sample_response())
+        records = [('user{}@example.com'.format(i), sample_response()) for i in range(200)]
+        records.append(('existing@example.com', sample_response()))
+        records.append(('user0@example.com', sample_response()))
+
+        assert_equal(self.db.insert_user_records(records), 200)
+        assert_equal(User.select().count(), 201)
+        assert_equal(UserProfile.select().count(), 201 * 3)
+        assert_equal(UserOrganization.select().where(UserOrganization.is_current == True).count(), 201)
+
+
+class TestResponseArchive(object):
+    """
+    Test class for archiving raw responses and rebuilding tables from them
+    """
+    def setup(self):
+        self.db = SqliteConnector(':memory:')
+        self.db.client.create_tables(MODELS)
+        self.db.insert_user_records([('user{}@example.com'.format(i), sample_response()) for i in range(30)])
+
+    def test_responses_are_archived(self):
+        assert_equal(RawResponse.select().count(), 30)
+        email, create_dt, body = next(self.db.iter_archive())
+        assert_equal(email, 'user0@example.com')
+        assert_equal(decompress_response(body), SAMPLE_RESPONSE)
+
+    def test_reparse_archive(self):
+        created = User.get(User.email == 'user3@example.com').create_dt
+        UserProfile.delete().execute()
+        User.update(first_name='stale').execute()
+
+        # a newer response for an existing user is archived even though the user is not replaced
+        response = sample_response()
+        response['requestId'] = 'd4e5f6'
+        response['contactInfo']['givenName'] = 'Barty'
+        self.db.insert_user_records([('user0@example.com', response)])
+
+        self.db.archive_responses = False
+        self.db.insert_user_record('unarchived@example.com', sample_response())
+
+        assert_equal(self.db.reparse_archive(processes=2, batch_size=7), 30)
+        assert_equal(User.select().count(), 31)
+        assert_equal(UserProfile.select().count(), 31 * 3)
+        assert_equal(User.get(User.email == 'user0@example.com').first_name, 'Barty')
+        assert_equal(User.get(User.email == 'user1@example.com').first_name, 'Bart')
+        assert_equal(User.get(User.email == 'unarchived@example.com').first_name, 'Bart')
+        assert_equal(User.get(User.email == 'user3@example.com').create_dt, created)
+        assert_equal(UserFlat.select().where(UserFlat.first_name == 'Bart').count(), 30)
+
+    def test_reparse_keeps_stamps_of_refreshed_users(self):
+        before = User.get(User.email == 'user0@example.com')
+        response = sample_response()
+        response['requestId'] = 'd4e5f6'
+        response['contactInfo']['givenName'] = 'Barty'
+        self.db.upsert_user_records([('user0@example.com', response)])
+        refreshed = User.get(User.email == 'user0@example.com')
+        scraped_on = UserFlat.get(UserFlat.email == 'user0@example.com').scraped_on
+        assert_is_not_none(refreshed.update_dt)
+
+        self.db.reparse_archive(processes=1)
+        after = User.get(User.email == 'user0@example.com')
+        assert_equal(after.first_name, 'Barty')
+        assert_equal(after.create_dt, before.create_dt)
+        assert_equal(after.update_dt, refreshed.update_dt)
+        assert_equal(UserFlat.get(UserFlat.email == 'user0@example.com').scraped_on, scraped_on)
+
+
+class TestUpsert(object):
+    """
+    Test class for refreshing stored users with new responses
+    """
+    def setup(self):
+        self.db = SqliteConnector(':memory:')
+        self.db.client.create_tables(MODELS)
+        self.db.insert_user_records([('user{}@example.com'.format(i), sample_response()) for i in range(3)])
+
+    def test_unchanged_refresh_writes_nothing(self):
+        before = ROWS_WRITTEN.value(table='user_profile')
+        counts = self.db.upsert_user_records([('user{}@example.com'.format(i), sample_response()) for i in range(3)])
+        assert_equal(counts, {'inserted': 0, 'updated': 0, 'unchanged': 3})
+        assert_equal(ROWS_WRITTEN.value(table='user_profile'), before)
+        assert_equal(User.select().where(User.update_dt >> None).count(), 3)
+
+    def test_refresh_writes_the_difference(self):
+        response = sample_response()
+        response['contactInfo']['givenName'] = 'Barton'
+        response['demographics']['ageRange'] = '35-44'
+        response['organizations'].append({'name': 'Rainmaker', 'title': 'Founder', 'startDate': '2008-03'})
+        del response['socialProfiles']['facebook']
+        response['socialProfiles']['twitter'][0]['followers'] = 6000
+        twitter_id = UserProfile.get(UserProfile.network_name == 'Twitter', UserProfile.user == 1).user_profile_id
+
+        counts = self.db.upsert_user_records([('user0@example.com', response), ('new@example.com', sample_response())])
+        assert_equal(counts, {'inserted': 1, 'updated': 1, 'unchanged': 0})
+
+        user = User.get(User.email == 'user0@example.com')
+        assert_equal(user.first_name, 'Barton')
+        assert_is_not_none(user.update_dt)
+        assert_equal(user.demographics.get().age_range_min, 35)
+        assert_equal(sorted(o.organization_name for o in user.organizations), ['FullContact', 'Rainmaker'])
+        assert_equal(user.profiles.count(), 2)
+
+        twitter = UserProfile.get(UserProfile.user_profile_id == twitter_id)
+        assert_equal(twitter.followers, 6000)
+        assert_is_not_none(twitter.update_dt)
+        assert_is_none(user.addresses.get().update_dt)
+        assert_equal(user.flat.get().first_name, 'Barton')
+        assert_is_none(User.get(User.email == 'user1@example.com').update_dt)
+
+
+class TestKnownEmailFilter(object):
+    """
+    Test class for skipping emails that are already stored
+    """
+    def setup(self):
+        self.db = SqliteConnector(':memory:')
+        self.db.client.create_tables(MODELS)
+        self.db.insert_user_records([('user{}@example.com'.format(i), sample_response()) for i in range(50)])
+        self.emails = ['user{}@example.com'.format(i) for i in range(40, 60)] + ['user55@example.com']
+
+    def test_filter_with_set(self):
+        known = KnownEmailFilter(self.db)
+        assert_equal(list(known.filter(self.emails)), ['user{}@example.com'.format(i) for i in range(50, 60)])
+        assert_equal(known.skipped, 11)
+
+    def test_filter_with_bloom_filter(self):
+        known = KnownEmailFilter(self.db, bloom_threshold=10)
+        assert_false(known.exact)
+        bits = str(known.index.bits)
+        assert_equal(list(known.filter(self.emails)), ['user{}@example.com'.format(i) for i in range(50, 60)])
+        assert_equal(known.skipped, 11)
+        # new emails are not added to the filter of stored users
+        assert_equal(str(known.index.bits), bits)
+
+    def test_untracked_repeats_are_passed_on(self):
+        known = KnownEmailFilter(self.db, bloom_threshold=10, track_repeats=False)
+        emails = list(known.filter(self.emails))
+        assert_equal(emails, ['user{}@example.com'.format(i) for i in range(50, 60)] + ['user55@example.com'])
+        assert_equal(known.skipped, 10)
+        assert_is_none(known.seen)
+
+
+def failure_response(status, request_id):
+    return bunchify({'status': status, 'message': 'failed', 'requestId': request_id})
+
+
+class TestRetryQueue(object):
+    """
+    Test class for scheduling failed lookups
+    """
+    def setup(self):
+        self.db = SqliteConnector(':memory:', retry_policy=RetryPolicy(jitter=0))
+        self.db.client.create_tables(MODELS)
+
+    def test_failures_are_scheduled(self):
+        self.db.log_failure('pending@example.com', failure_response(202, 'r1'))
+        self.db.log_failure('missing@example.com', failure_response(404, 'r2'))
+        row = FailureLog.get(FailureLog.request_id == 'r1')
+        assert_true(row.next_attempt_dt > datetime.datetime.now())
+        assert_equal(self.db.fetch_retry_queue(), [])
+        assert_equal(len(self.db.fetch_retry_queue(due_only=False)), 1)
+
+    def test_paged_retrieval_of_due_rows(self):
+        for i in range(25):
+            self.db.log_failure('user{}@example.com'.format(i), failure_response(500, str(i)))
+        FailureLog.update(next_attempt_dt=datetime.datetime.now() - datetime.timedelta(minutes=1)).execute()
+        pages = list(self.db.iter_retry_queue(page_size=10))
+        assert_equal([len(p) for p in pages], [10, 10, 5])
+
+    def test_batched_update_backs_off(self):
+        self.db.log_failure('pending@example.com', failure_response(202, 'r1'))
+        self.db.log_failure('done@example.com', failure_response(202, 'r2'))
+        rows = self.db.fetch_retry_queue(due_only=False)
+        self.db.update_retry_rows([(rows[0], failure_response(202, 'r1')), (rows[1], failure_response(404, 'r2'))])
+
+        pending = FailureLog.get(FailureLog.request_id == 'r1')
+        delay = pending.next_attempt_dt - pending.most_recent_retry_dt
+        assert_equal(pending.retry_count, 1)
+        assert_almost_equal(delay.total_seconds(), 600, delta=1)
+        assert_true(FailureLog.get(FailureLog.request_id == 'r2').retry_complete)
+
+    def test_open_failures_are_never_due_at_once(self):
+        # a pending lookup that later comes back unprocessable stays open
+        self.db.log_failure('invalid@example.com', failure_response(202, 'r1'))
+        for _ in range(3):
+            FailureLog.update(next_attempt_dt=datetime.datetime.now() - datetime.timedelta(minutes=1)).execute()
+            rows = self.db.fetch_retry_queue()
+            self.db.update_retry_rows([(rows[0], failure_response(422, 'r1'))])
+            assert_equal(self.db.count_retry_queue(due_only=True), 0)
+
+        row = FailureLog.get(FailureLog.request_id == 'r1')
+        assert_false(row.retry_complete)
+        assert_true(row.next_attempt_dt > datetime.datetime.now())
+
+    def test_every_scheduled_status_is_queued(self):
+        self.db.log_failure('invalid@example.com', failure_response(422, 'r1'))
+        self.db.log_failure('missing@example.com', failure_response(404, 'r2'))
+        assert_equal([row['request_id'] for row in self.db.fetch_retry_queue(due_only=False)], ['r1'])
+
+        self.db.update_retry_rows([])
+        rows = self.db.fetch_retry_queue(due_only=False)
+        self.db.update_retry_rows([(rows[0], failure_response(200, 'r1'))])
+        row = FailureLog.get(FailureLog.request_id == 'r1')
+        assert_equal((row.most_recent_retry_status, row.retry_count, row.retry_complete, row.next_attempt_dt), (200, 1, True, None))
+
+    def test_upgrade_schema(self):
+        self.db.client.execute_sql('DROP INDEX failure_log_retry_complete_next_attempt_dt')
+        self.db.client.execute_sql('CREATE TABLE failure_log_old AS SELECT failure_log_id, email, initial_status, '
+                                   'message, request_id, create_dt, most_recent_retry_dt, most_recent_retry_status, '
+                                   'retry_count, retry_complete FROM failure_log')
+        self.db.client.execute_sql('DROP TABLE failure_log')
+        self.db.client.execute_sql('ALTER TABLE failure_log_old RENAME TO failure_log')
+        self.db.upgrade_schema()
+        assert_in('failure_log_retry_complete_next_attempt_dt', self.db._index_names('failure_log'))
+        self.db.log_failure('pending@example.com', failure_response(202, 'r1'))
+
+    def test_upgrade_allows_missing_request_ids(self):
+        self.db.client.execute_sql('DROP TABLE failure_log')
+        self.db.client.execute_sql(
+            'CREATE TABLE "failure_log" ("failure_log_id" INTEGER NOT NULL PRIMARY KEY, "email" VARCHAR(255) NOT NULL, '
+            '"initial_status" INTEGER NOT NULL, "message" TEXT NOT NULL, "request_id" VARCHAR(255) NOT NULL, '
+            '"create_dt" DATETIME NOT NULL, "most_recent_retry_dt" DATETIME, "most_recent_retry_status" INTEGER, '
+            '"retry_count" INTEGER NOT NULL, "retry_complete" SMALLINT NOT NULL, "next_attempt_dt" DATETIME)'
+        )
+        self.db.upgrade_schema()
+        self.db.log_failure('limited@example.com', failure_response(403, None))
+        assert_equal(FailureLog.get(FailureLog.email == 'limited@example.com').request_id, None)
+        assert_in('failure_log_retry_complete_next_attempt_dt', self.db._index_names('failure_log'))
+
+
+class TestSqliteProfiles(object):
+    """
+    Test class for sqlite performance profiles
+    """
+    def setup(self):
+        self.path = tempfile.mktemp(suffix='.sqlite')
+
+    def teardown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def pragma(self, db, name):
+        return db.execute_sql('PRAGMA {}'.format(name)).fetchone()[0]
+
+    def test_profile_applied_to_every_thread(self):
+        db = ProfiledSqliteDatabase(self.path, profile='concurrent', threadlocals=True)
+        results = {}
+        thread = threading.Thread(target=lambda: results.update(sync=self.pragma(db, 'synchronous')))
+        thread.start()
+        thread.join()
+        assert_equal(self.pragma(db, 'journal_mode'), 'wal')
+        assert_equal(results['sync'], 1)
+
+    def test_safe_profile_keeps_rollback_journal(self):
+        db = ProfiledSqliteDatabase(self.path, profile='safe')
+        db.execute_sql('CREATE TABLE t (x INTEGER)')
+        assert_equal(self.pragma(db, 'journal_mode'), 'delete')
+        assert_equal(self.pragma(db, 'synchronous'), 2)
+        assert_false(os.path.exists(self.path + '-wal'))
+
+    @raises(ValueError)
+    def test_unknown_profile(self):
+        ProfiledSqliteDatabase(self.path, profile='fast')
+
+
+class TestDeferredIndexes(object):
+    """
+    Test class for dropping and rebuilding the secondary indexes around a bulk load
+    """
+    def setup(self):
+        self.db = SqliteConnector(':memory:')
+        self.db.client.create_tables(MODELS)
+        self.indexes = self.index_names()
+
+    def index_names(self):
+        return set(self.db._index_names('user')) | set(self.db._index_names('user_profile')) | set(self.db._index_names('failure_log'))
+
+    def test_deferred_indexes(self):
+        with self.db.deferred_indexes():
+            remaining = self.index_names()
+            self.db.insert_user_records([('user{}@example.com'.format(i), sample_response()) for i in range(5)])
+        assert_equal(remaining, set(['user_email', 'user_profile_user_id']))
+        assert_equal(self.index_names(), self.indexes)
+        assert_equal(UserProfile.select().where(UserProfile.network_name == 'Twitter').count(), 5)
+
+    @raises(IntegrityError)
+    def test_unique_email_still_enforced(self):
+        with self.db.deferred_indexes():
+            self.db.insert_user_record('bart@fullcontact.com', sample_response())
+            self.db.insert_user_record('bart@fullcontact.com', sample_response())
+
+    def test_rebuilt_after_failed_load(self):
+        try:
+            with self.db.deferred_indexes():
+                raise RuntimeError('load failed')
+        except RuntimeError:
+            pass
+        assert_equal(self.index_names(), self.indexes)
+        assert_equal(self.db.rebuild_secondary_indexes(), 0)
+
+
+class TestBatchingWriter(object):
+    """
+    Test class for the write-behind database writer
+    """
+    def setup(self):
+        self.path = tempfile.mktemp(suffix='.sqlite')
+        self.db = SqliteConnector(self.path)
+        self.db.client.create_tables(MODELS)
+
+    def teardown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_writes_from_many_threads(self):
+        with BatchingWriter(self.db, max_batch=50, max_delay=0.05) as writer:
+            def fetch(i):
+                writer.insert_user_record('user{}@example.com'.format(i), sample_response())
+                writer.log_failure('missing{}@example.com'.format(i), failure_response(404, str(i)))
+
+            threads = [threading.Thread(target=fetch, args=(i,)) for i in range(100)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            assert_equal(writer.count_users(), 100)
+        assert_equal(FailureLog.select().count(), 100)
+
+    def test_future_resolves_after_commit(self):
+        with BatchingWriter(self.db, max_delay=0.01) as writer:
+            future = writer.insert_user_record('bart@fullcontact.com', sample_response())
+            assert_is_none(future.result(timeout=5))
+            assert_true(self.db.user_exists('bart@fullcontact.com'))
+
+    def test_failed_batch_sets_exception(self):
+        with BatchingWriter(self.db, max_delay=0.01) as writer:
+            future = writer.log_failure('broken@example.com', bunchify({'status': 500}))
+            assert_is_not_none(future.exception(timeout=5))
+
+    def test_only_the_bad_write_of_a_batch_fails(self):
+        with BatchingWriter(self.db, max_delay=0.5) as writer:
+            futures = writer.log_failures([('missing{}@example.com'.format(i), failure_response(404, str(i))) for i in range(3)])
+            broken = writer.log_failure('broken@example.com', bunchify({'status': 500}))
+            futures.extend(writer.log_failures([('missing3@example.com', failure_response(404, '3'))]))
+
+            assert_is_not_none(broken.exception(timeout=5))
+            assert_equal([future.result(timeout=5) for future in futures], [None] * 4)
+        assert_equal(FailureLog.select().count(), 4)
+
+
+class SampleApi(FullContactInterface):
+    def __init__(self):
+        pass
+
+    def get_person(self, email):
+        if email.startswith('missing'):
+            return failure_response(404, email)
+        return bunchify(sample_response())
+
+
+class TestSharding(object):
+    """
+    Test class for sharded ingestion and merging
+    """
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def test_shard_for_is_stable(self):
+        assert_equal(shard_for('Bart@FullContact.com', 8), shard_for('bart@fullcontact.com', 8))
+        assert_equal(len(set(shard_for('user{}@example.com'.format(i), 4) for i in range(100))), 4)
+
+    def test_merge_remaps_keys(self):
+        for name, prefix in (('a.sqlite', 'a'), ('b.sqlite', 'b')):
+            db = SqliteConnector(self.path(name))
+            db.client.create_tables(MODELS)
+            db.insert_user_records([('{}{}@example.com'.format(prefix, i), sample_response()) for i in range(3)])
+            db.log_failure('{}-missing@example.com'.format(prefix), failure_response(404, prefix))
+
+        counts = merge_shards(self.path('merged.sqlite'), [self.path('a.sqlite'), self.path('b.sqlite')])
+        assert_equal(counts, {'users': 6, 'failures': 2})
+        # the models are still bound to the last shard opened
+        assert_is(db_proxy.obj, db.client)
+        assert_equal(User.select().count(), 3)
+
+        SqliteConnector(self.path('merged.sqlite'))
+        assert_equal(User.select().count(), 6)
+        assert_equal(UserProfile.select().count(), 18)
+        user = User.get(User.email == 'b2@example.com')
+        assert_equal(user.flat.get().email, 'b2@example.com')
+        assert_equal(user.profiles.count(), 3)
+
+        # merging a shard again skips the users and failures it already holds
+        assert_equal(merge_shards(self.path('merged.sqlite'), [self.path('a.sqlite')]), {'users': 0, 'failures': 0})
+        assert_equal(User.select().count(), 6)
+        assert_equal(FailureLog.select().count(), 2)
+
+    def test_remerge_skips_rows_without_request_id(self):
+        db = SqliteConnector(self.path('a.sqlite'))
+        db.client.create_tables(MODELS)
+        response = sample_response()
+        del response['requestId']
+        db.insert_user_records([('a0@example.com', bunchify(response))])
+        db.log_failure('limited@example.com', failure_response(403, None))
+        db.log_failure('broken@example.com', failure_response(500, None))
+
+        assert_equal(merge_shards(self.path('merged.sqlite'), [self.path('a.sqlite')]), {'users': 1, 'failures': 2})
+        assert_equal(merge_shards(self.path('merged.sqlite'), [self.path('a.sqlite')]), {'users': 0, 'failures': 0})
+
+        SqliteConnector(self.path('merged.sqlite'))
+        assert_equal(FailureLog.select().count(), 2)
+        assert_equal(RawResponse.select().count(), 1)
+
+    def test_sharded_ingest(self):
+        ingest = ShardedIngest(self.path('shards'), 3, SampleApi, profile='safe', concurrency=2)
+        emails = ['user{}@example.com'.format(i) for i in range(30)] + ['missing@example.com']
+        stats = ingest.run(emails)
+        assert_equal(sum(s['processed'] for s in stats), 31)
+
+        ingest.merge(self.path('merged.sqlite'))
+        SqliteConnector(self.path('merged.sqlite'))
+        assert_equal(User.select().count(), 30)
+        assert_equal(FailureLog.select().count(), 1)
@@ -0,0 +1,168 @@
+from nose.tools import *
+
+from tortilla.utils import bunchify
+
+from busybody.fullcontact import FullContact, RateLimiter, ResponseCache, CachedFullContact, StandInServer, HttpTransport, fixed_latency
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestRateLimiter(object):
+    """
+    Test class for the FullContact token bucket
+    """
+    def setup(self):
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(rate=1.0, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_paces_at_initial_rate(self):
+        for _ in range(5):
+            self.limiter.acquire()
+        assert_almost_equal(self.clock.now, 4.0)
+
+    def test_speeds_up_from_headers(self):
+        self.limiter.update(limit=600, remaining=600, reset=60)
+        self.limiter.acquire()
+        for _ in range(10):
+            self.limiter.acquire()
+        assert_almost_equal(self.clock.now, 1.0, places=2)
+
+    def test_slows_down_when_remaining_is_low(self):
+        self.limiter.update(limit=600, remaining=11, reset=10)
+        assert_almost_equal(self.limiter.rate, 1.0)
+
+    def test_shard_keeps_to_its_share(self):
+        limiter = RateLimiter(rate=0.25, share=0.25, clock=self.clock, sleep=self.clock.sleep)
+        limiter.update(limit=600)
+        assert_almost_equal(limiter.rate, 2.5)
+        limiter.update(limit=600, remaining=44, reset=10)
+        assert_almost_equal(limiter.rate, 1.0)
+
+    def test_holds_requests_until_reset(self):
+        self.limiter.update(limit=600, remaining=0, reset=30)
+        self.limiter.acquire()
+        assert_true(self.clock.now >= 30)
+
+
+class StubApi(object):
+    def __init__(self, status):
+        self.status = status
+        self.calls = 0
+
+    def get_person(self, email):
+        self.calls += 1
+        return bunchify({'status': self.status, 'requestId': str(self.calls)})
+
+
+class TestCachedFullContact(object):
+    """
+    Test class for the FullContact response cache
+    """
+    def setup(self):
+        self.cache = ResponseCache(':memory:')
+
+    def test_repeat_lookup_is_cached(self):
+        api = CachedFullContact(StubApi(200), self.cache)
+        api.get_person('Bart@FullContact.com ')
+        response = api.get_person('bart@fullcontact.com')
+        assert_equal(api.api.calls, 1)
+        assert_equal(response.requestId, '1')
+        assert_equal(self.cache.stats()['hits'], 1)
+
+    def test_not_found_is_cached_separately(self):
+        api = CachedFullContact(StubApi(404), self.cache)
+        api.get_person('nobody@example.com')
+        api.get_person('nobody@example.com')
+        assert_equal(api.api.calls, 1)
+        assert_equal(self.cache.stats()['negative_hits'], 1)
+
+    def test_retryable_responses_are_not_cached(self):
+        api = CachedFullContact(StubApi(202), self.cache)
+        api.get_person('pending@example.com')
+        api.get_person('pending@example.com')
+        assert_equal(api.api.calls, 2)
+        assert_equal(self.cache.stats()['misses'], 2)
+
+    def test_expired_entries_are_ignored(self):
+        self.cache.ttl = -1
+        api = CachedFullContact(StubApi(200), self.cache)
+        api.get_person('bart@fullcontact.com')
+        api.get_person('bart@fullcontact.com')
+        assert_equal(api.api.calls, 2)
+        assert_equal(self.cache.purge_expired(), 1)
+
+
+class TestStandInServer(object):
+    """
+    Test class for the local FullContact stand-in
+    """
+    def fullcontact(self, server):
+        return FullContact('key', base_url=server.base_url, rate_limiter=RateLimiter(rate=1000, burst=100))
+
+    def test_serves_deterministic_profiles(self):
+        with StandInServer(rate_limit=None) as server:
+            api = self.fullcontact(server)
+            first = api.get_person('bart@fullcontact.com')
+            second = api.get_person('bart@fullcontact.com')
+        assert_equal(first.status, 200)
+        assert_equal(first.contactInfo.fullName, second.contactInfo.fullName)
+        assert_equal(server.stats, {200: 2})
+
+    def test_failure_rates(self):
+        with StandInServer(failure_rates={202: 1.0}, rate_limit=None) as server:
+            response = self.fullcontact(server).get_person('pending@example.com')
+        assert_equal(response.status, 202)
+
+    def test_rate_limit_headers_and_exhaustion(self):
+        with StandInServer(rate_limit=3, window=60) as server:
+            api = self.fullcontact(server)
+            statuses = [api.get_person('user{}@example.com'.format(i)).status for i in range(2)]
+            # one request left, which the limiter keeps in reserve
+            assert_true(api.rate_limiter.blocked_until > 0)
+
+            status, _, headers = server.respond({'email': 'user2@example.com'})
+            assert_equal(dict(headers)['X-Rate-Limit-Remaining'], 0)
+            assert_equal(server.respond({'email': 'user3@example.com'})[0], 403)
+        assert_equal(statuses + [status], [200, 200, 200])
+
+
+class TestHttpTransport(object):
+    """
+    Test class for the pooled FullContact transport
+    """
+    def test_connections_are_reused(self):
+        with StandInServer(rate_limit=None) as server, HttpTransport(pool_size=2) as transport:
+            api = FullContact('key', base_url=server.base_url, rate_limiter=RateLimiter(rate=1000, burst=100), transport=transport)
+            statuses = [api.get_person('user{}@example.com'.format(i)).status for i in range(5)]
+            pool = transport.session.get_adapter(server.base_url).poolmanager.connection_from_url(server.base_url)
+            assert_equal(pool.num_connections, 1)
+        assert_equal(statuses, [200] * 5)
+
+    def test_get_person_async(self):
+        with StandInServer(rate_limit=None) as server, HttpTransport(pool_size=4) as transport:
+            api = FullContact('key', base_url=server.base_url, rate_limiter=RateLimiter(rate=1000, burst=100), transport=transport)
+            futures = [api.get_person_async('user{}@example.com'.format(i)) for i in range(8)]
+            statuses = [future.result(timeout=10).status for future in futures]
+        assert_equal(statuses, [200] * 8)
+
+    def test_timeouts_are_failed_lookups(self):
+        with StandInServer(latency=fixed_latency(0.5), rate_limit=None) as server, HttpTransport(read_timeout=0.1) as transport:
+            api = FullContact('key', base_url=server.base_url, rate_limiter=RateLimiter(rate=1000, burst=100), transport=transport)
+            response = api.get_person('slow@example.com')
+        assert_equal(response.status, 503)
+        assert_true(response.message.startswith('ReadTimeout'))
+        assert_equal(response.requestId, None)
+
+        # nothing is listening on the stopped server's port
+        with HttpTransport(connect_timeout=0.5) as transport:
+            api = FullContact('key', base_url=server.base_url, rate_limiter=RateLimiter(rate=1000, burst=100), transport=transport)
+            assert_equal(api.get_person('offline@example.com').status, 503)
@@ -0,0 +1,115 @@
+from nose.plugins.skip import SkipTest
+from nose.tools import *
+
+from database_tests import sample_response, failure_response
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+class TestMongoDbConnector(object):
+    """
+    Test class for the MongoDb backend, run against mongomock when it is installed
+    """
+    def setup(self):
+        if mongomock is None:
+            raise SkipTest('mongomock is not installed')
+
+        import pymongo
+        self._client = pymongo.MongoClient
+        pymongo.MongoClient = lambda *args, **kwargs: mongomock.MongoClient()
+
+        from busybody.database import MongoDbConnector
+        self.db = MongoDbConnector('mongodb://localhost', 'people', buffer_size=3, flush_interval=60)
+
+    def teardown(self):
+        import pymongo
+        self.db.close()
+        pymongo.MongoClient = self._client
+
+    def test_buffered_inserts_skip_duplicates(self):
+        for i in range(5):
+            self.db.insert_user_record('user{}@example.com'.format(i), sample_response())
+        self.db.insert_user_record('user1@example.com', sample_response())
+        assert_equal(self.db.count_users(), 5)
+        assert_true(self.db.user_exists('user4@example.com'))
+
+    def test_paged_retry_queue(self):
+        for i in range(4):
+            self.db.log_failure('user{}@example.com'.format(i), failure_response(202, str(i)))
+        assert_equal(self.db.fetch_retry_queue(), [])
+
+        pages = list(self.db.iter_retry_queue(page_size=3, due_only=False))
+        assert_equal([len(page) for page in pages], [3, 1])
+
+        self.db.update_retry_rows([(row, failure_response(404, 'x')) for row in pages[0]])
+        assert_equal(len(self.db.fetch_retry_queue(due_only=False)), 1)
+
+    def test_archive_keeps_latest_response(self):
+        from busybody.database import decompress_response
+
+        self.db.insert_user_record('user0@example.com', sample_response())
+        response = sample_response()
+        response['requestId'] = 'd4e5f6'
+        self.db.insert_user_record('user0@example.com', response)
+        self.db.insert_user_record('user1@example.com', sample_response())
+
+        entries = list(self.db.iter_archive())
+        assert_equal([email for email, _, _ in entries], ['user0@example.com', 'user1@example.com'])
+        assert_equal(decompress_response(entries[0][2])['requestId'], 'd4e5f6')
+        assert_equal(len(list(self.db.iter_archive(latest_only=False))), 3)
+
+
+class FlakyCollection(object):
+    """ Passes writes through to a collection, failing the first `failures` bulk writes """
+
+    def __init__(self, collection, failures):
+        self.collection = collection
+        self.name = collection.name
+        self.failures = failures
+
+    def bulk_write(self, ops, ordered=True):
+        from pymongo.errors import AutoReconnect
+
+        if self.failures:
+            self.failures -= 1
+            raise AutoReconnect('connection reset')
+        return self.collection.bulk_write(ops, ordered=ordered)
+
+
+class TestBulkBuffer(object):
+    """
+    Test class for the buffered MongoDb writes
+    """
+    def setup(self):
+        if mongomock is None:
+            raise SkipTest('mongomock is not installed')
+        self.collection = mongomock.MongoClient().busybody.people
+
+    def buffer(self, failures):
+        from busybody.database.mongo_db import BulkBuffer
+        return BulkBuffer(FlakyCollection(self.collection, failures), size=100, interval=60)
+
+    def test_failed_flush_keeps_operations(self):
+        from pymongo import InsertOne
+        from pymongo.errors import AutoReconnect
+
+        buf = self.buffer(failures=1)
+        for i in range(3):
+            buf.add(InsertOne({'email': 'user{}@example.com'.format(i)}))
+        assert_raises(AutoReconnect, buf.flush)
+        buf.add(InsertOne({'email': 'late@example.com'}))
+        buf.close()
+        assert_equal(self.collection.count(), 4)
+
+    def test_close_reports_unwritten_operations(self):
+        from pymongo import InsertOne
+        from pymongo.errors import AutoReconnect
+
+        buf = self.buffer(failures=2)
+        buf.add(InsertOne({'email': 'user0@example.com'}))
+        assert_raises(AutoReconnect, buf.flush)
+        assert_raises(AutoReconnect, buf.close)
+        assert_equal(self.collection.count(), 0)
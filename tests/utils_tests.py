@@ -0,0 +1,216 @@
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+from nose.plugins.skip import SkipTest
+from nose.tools import *
+
+from busybody.utils.canonical import EmailCanonicalizer, EmailDeduplicator
+from busybody.utils.concurrency import bounded_imap
+from busybody.utils.data_structures import BloomFilter
+from busybody.utils.exporters import export_batches, guess_format, iter_npz_batches
+from busybody.utils.metrics import MetricsRegistry
+from busybody.utils.parsers import EmailParser
+
+
+class TestBoundedImap(object):
+    """
+    Test class for the bounded worker pool
+    """
+    def test_yields_every_item(self):
+        results = dict(bounded_imap(lambda x: x * 2, xrange(100), concurrency=8))
+        assert_equal(results, dict((x, x * 2) for x in xrange(100)))
+
+    def test_reads_input_lazily(self):
+        results = bounded_imap(lambda x: x, iter(xrange(10 ** 9)), concurrency=2, backlog=4)
+        assert_equal(len([r for _, r in zip(range(10), results)]), 10)
+
+    @raises(ZeroDivisionError)
+    def test_worker_exception_is_raised(self):
+        list(bounded_imap(lambda x: 1 / x, [1, 2, 0, 3], concurrency=2))
+
+
+class TestBloomFilter(object):
+    """
+    Test class for the bloom filter
+    """
+    def test_no_false_negatives(self):
+        bf = BloomFilter(1000)
+        emails = ['user{}@example.com'.format(i) for i in xrange(1000)]
+        for email in emails:
+            bf.add(email)
+        assert_true(all(email in bf for email in emails))
+
+    def test_false_positive_rate(self):
+        bf = BloomFilter(1000, error_rate=0.01)
+        for i in xrange(1000):
+            bf.add('user{}@example.com'.format(i))
+        false_positives = sum(1 for i in xrange(10000) if 'other{}@example.com'.format(i) in bf)
+        assert_true(false_positives < 300)
+
+
+class TestEmailParser(object):
+    """
+    Test class for reading input files
+    """
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def test_read_csv(self):
+        with open(self.path('in.csv'), 'w') as outf:
+            outf.write('name,address\nbart,bart@fullcontact.com\nnobody,not-an-email\n')
+        assert_equal(EmailParser.read_emails(self.path('in.csv'), column='address'), ['bart@fullcontact.com'])
+
+    def test_read_gzipped_json_lines(self):
+        outf = gzip.open(self.path('in.jsonl.gz'), 'wb')
+        for i in range(5):
+            outf.write(json.dumps({'email': 'user{}@example.com'.format(i)}) + '\n')
+        outf.write('\n{broken\n')
+        outf.close()
+        chunks = list(EmailParser.iter_email_chunks(self.path('in.jsonl.gz'), chunk_size=2))
+        assert_equal([len(c) for c in chunks], [2, 2, 1])
+
+    def test_non_string_values_are_skipped(self):
+        with open(self.path('in.jsonl'), 'w') as outf:
+            for value in (123, None, ['bart@fullcontact.com'], {'a': 1}, 'lisa@fullcontact.com'):
+                outf.write(json.dumps({'email': value}) + '\n')
+        assert_equal(EmailParser.read_emails(self.path('in.jsonl')), ['lisa@fullcontact.com'])
+        assert_equal([email for _, email in EmailParser.iter_email_offsets(self.path('in.jsonl'))], ['lisa@fullcontact.com'])
+
+    def test_missing_csv_column_is_an_error(self):
+        with open(self.path('in.csv'), 'w') as outf:
+            outf.write('name,address\nbart,bart@fullcontact.com\n')
+        assert_raises(ValueError, EmailParser.read_emails, self.path('in.csv'))
+        assert_raises(ValueError, list, EmailParser.iter_email_offsets(self.path('in.csv')))
+
+
+class TestEmailCanonicalizer(object):
+    """
+    Test class for email canonicalization and deduplication
+    """
+    def test_canonical_forms(self):
+        canonicalize = EmailCanonicalizer()
+        assert_equal(canonicalize(' Bart@X.com '), 'bart@x.com')
+        assert_equal(canonicalize('bart+news@x.com'), 'bart+news@x.com')
+        assert_equal(canonicalize('B.Art+news@GoogleMail.com'), 'bart@gmail.com')
+        assert_equal(canonicalize('bart+news@outlook.com'), 'bart@outlook.com')
+        assert_equal(canonicalize('+news@outlook.com'), '+news@outlook.com')
+        assert_equal(EmailCanonicalizer(strip_tags=True)('bart+news@x.com'), 'bart@x.com')
+        assert_equal(EmailCanonicalizer(providers=None)('b.art@gmail.com'), 'b.art@gmail.com')
+
+    def test_dedupe_keeps_every_spelling(self):
+        dedupe = EmailDeduplicator(EmailCanonicalizer(strip_tags=True))
+        emails = ['Bart@X.com', 'lisa@x.com', 'bart@x.com', 'bart+news@x.com', 'bart@x.com']
+        assert_equal(list(dedupe.dedupe(emails)), ['bart@x.com', 'lisa@x.com'])
+        assert_equal(dedupe.duplicates, 3)
+        assert_equal(dedupe.spellings('bart@x.com'), ['Bart@X.com', 'bart@x.com', 'bart+news@x.com'])
+        assert_equal(dedupe.spellings('lisa@x.com'), ['lisa@x.com'])
+        assert_in('BART+promo@x.com', dedupe)
+        assert_equal(len(list(dedupe.iter_spellings())), 4)
+
+
+class TestMetricsRegistry(object):
+    """
+    Test class for the pipeline metrics
+    """
+    def setup(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter_labels(self):
+        rows = self.registry.counter('rows_total', 'Rows written')
+        rows.inc(3, table='user')
+        rows.inc(table='user')
+        assert_equal(self.registry.counter('rows_total').value(table='user'), 4)
+        assert_equal(rows.value(table='user_topic'), 0)
+
+    def test_kind_conflict(self):
+        self.registry.counter('requests')
+        assert_raises(ValueError, self.registry.gauge, 'requests')
+
+    def test_prometheus_text(self):
+        latency = self.registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+        latency.observe(0.05, status=200)
+        latency.observe(0.5, status=200)
+        text = self.registry.render_prometheus()
+        assert_true('# TYPE latency_seconds histogram' in text)
+        assert_true('latency_seconds_bucket{status="200",le="0.1"} 1.0' in text)
+        assert_true('latency_seconds_bucket{status="200",le="+Inf"} 2.0' in text)
+        assert_true('latency_seconds_count{status="200"} 2.0' in text)
+
+    def test_json_snapshot(self):
+        self.registry.gauge('in_flight').set(2)
+        snapshot = json.loads(json.dumps(self.registry.snapshot()))
+        assert_equal(snapshot['metrics']['in_flight']['values'], [{'labels': {}, 'value': 2}])
+
+
+class TestExporters(object):
+    """
+    Test class for the streaming export formats
+    """
+    columns = [('id', 'int'), ('name', 'str'), ('score', 'float'), ('active', 'bool'), ('seen', 'datetime')]
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        seen = datetime.datetime(2015, 6, 1, 12, 30)
+        self.rows = [(i, u'user {}'.format(i) if i % 3 else None, i / 2.0, i % 2 == 0, seen) for i in range(25)]
+        self.batches = [self.rows[i:i + 10] for i in range(0, 25, 10)]
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def export(self, name, **kwargs):
+        path = os.path.join(self.tmpdir, name)
+        assert_equal(export_batches(path, self.columns, iter(self.batches), **kwargs), 25)
+        return path
+
+    def test_guess_format(self):
+        assert_equal(guess_format('users.csv.gz'), ('csv', True))
+        assert_equal(guess_format('users.json'), ('jsonl', False))
+        assert_equal(guess_format('users.parquet'), ('parquet', False))
+
+    def test_gzip_csv(self):
+        with gzip.open(self.export('users.csv.gz'), 'rb') as inf:
+            lines = inf.read().splitlines()
+        assert_equal(lines[0], 'id,name,score,active,seen')
+        assert_equal(lines[2], '1,user 1,0.5,False,2015-06-01 12:30:00')
+        assert_equal(len(lines), 26)
+
+    def test_gzip_json_lines(self):
+        with gzip.open(self.export('users.jsonl.gz'), 'rb') as inf:
+            records = [json.loads(line) for line in inf]
+        assert_equal(len(records), 25)
+        assert_equal(records[0], {'id': 0, 'name': None, 'score': 0.0, 'active': True, 'seen': '2015-06-01T12:30:00'})
+
+    def test_npz(self):
+        try:
+            import numpy
+        except ImportError:
+            raise SkipTest('numpy is not installed')
+
+        batches = list(iter_npz_batches(self.export('users.npz')))
+        assert_equal([len(batch['id']) for batch in batches], [10, 10, 5])
+        assert_equal(batches[0]['id'].dtype, numpy.int64)
+        assert_equal(batches[0]['score'][3], 1.5)
+        assert_equal(list(batches[0]['name'][:3]), [None, u'user 1', u'user 2'])
+        assert_equal(batches[2]['seen'][0], numpy.datetime64('2015-06-01T12:30'))
+
+    def test_parquet(self):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise SkipTest('pyarrow is not installed')
+
+        parquet = pyarrow.parquet.ParquetFile(self.export('users.parquet'))
+        assert_equal(parquet.metadata.num_row_groups, 3)
+        table = parquet.read()
+        assert_equal(table.num_rows, 25)
+        assert_equal(table.column('name').to_pylist()[:2], [None, u'user 1'])